@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Offline performance benchmarks of DID-Comm-API.
+
+Measures Peer DID creation and resolution, DIDComm pack/unpack (including messages with large attachments),
+packing a message for N recipients (N single-recipient packs vs. one N-recipient pack), secrets lookups (json and
+sqlite backends) at different store sizes and a full round trip on the /did_comm/inbox/ API against a local stub
+webhook. Results (p50/p95/p99 latency and ops/sec per benchmark) are written as JSON, so runs of different commits
+can be compared. With --baseline, the run fails if a benchmark's p50 latency regressed by more than --threshold.
+
+Usage:
+  python benchmarks/run_benchmarks.py --output bench.json
+  python benchmarks/run_benchmarks.py --output bench-new.json --baseline bench.json --threshold 0.2
+"""
+
+import argparse
+import base64
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+SECRETS_STORE_SIZES = (10, 1000, 100000)
+# Recent authlib versions reject JWE segments larger than 256 kB, which bounds the attachment size
+ATTACHMENT_SIZES = (16 * 1024, 128 * 1024)
+# Numbers of recipients of a message packed once per recipient vs. once for all recipients
+RECIPIENT_COUNTS = (4, 16)
+
+
+def measure(name, operation, iterations, warmup=3):
+  """
+  Runs the operation warmup + iterations times and returns its latency statistics.
+
+  :param name: Name of the benchmark
+  :param operation: Function without arguments
+  :param iterations: Number of measured runs
+  :param warmup: Number of runs before measuring
+  :return: dict with the statistics of the benchmark
+  """
+  for _ in range(warmup):
+    operation()
+  latencies = []
+  for _ in range(iterations):
+    started = time.perf_counter()
+    operation()
+    latencies.append(time.perf_counter() - started)
+  return summarize(name, latencies)
+
+
+def summarize(name, latencies):
+  latencies = sorted(latencies)
+  total = sum(latencies)
+  return {
+    'name': name,
+    'iterations': len(latencies),
+    'p50_ms': percentile(latencies, 50) * 1000,
+    'p95_ms': percentile(latencies, 95) * 1000,
+    'p99_ms': percentile(latencies, 99) * 1000,
+    'mean_ms': statistics.mean(latencies) * 1000,
+    'ops_per_sec': len(latencies) / total if total else None,
+  }
+
+
+def percentile(sorted_values, percent):
+  # Nearest-rank percentile
+  rank = math.ceil(percent / 100 * len(sorted_values))
+  return sorted_values[min(len(sorted_values), max(1, rank)) - 1]
+
+
+def run_sync(coroutine):
+  from did_communication_api import utils
+  return utils.get_or_create_eventloop().run_until_complete(coroutine)
+
+
+def bench_peer_dids(results, iterations):
+  from did_communication_api.did_comm.did_comm import DIDComm
+  from did_communication_api.did_comm.did_resolver_peer_dids import DIDResolverPeerDID
+  from did_communication_api.did_comm.secret_resolver import SecretsResolverLocal
+
+  did_comm = DIDComm(SecretsResolverLocal('peer_dids_secrets.json'))
+  results.append(measure('create_peer_did', lambda: did_comm.create_peer_did('http://localhost/'), iterations))
+
+  did = did_comm.create_peer_did('http://localhost/')
+  uncached_resolver = DIDResolverPeerDID(cache_size=0)
+  results.append(measure('resolve_peer_did_uncached', lambda: run_sync(uncached_resolver.resolve(did)), iterations))
+  cached_resolver = DIDResolverPeerDID()
+  results.append(measure('resolve_peer_did_cached', lambda: run_sync(cached_resolver.resolve(did)), iterations))
+
+
+def bench_pack_unpack(results, iterations):
+  from did_communication_api.did_comm.did_comm import DIDComm
+  from did_communication_api.did_comm.secret_resolver import SecretsResolverLocal
+
+  sender = DIDComm(SecretsResolverLocal('sender_secrets.json'))
+  receiver = DIDComm(SecretsResolverLocal('receiver_secrets.json'))
+  sender_did = sender.create_peer_did('http://sender/')
+  receiver_did = receiver.create_peer_did('http://receiver/')
+
+  msg_body = {'request': 'GET /resource', 'nonce': '0123456789'}
+  results.append(measure(
+    'pack', lambda: sender.pack(msg_body, receiver_did, sender_did, 'https://example.org/benchmark'), iterations))
+  packed_msg = sender.pack(msg_body, receiver_did, sender_did, 'https://example.org/benchmark')
+  results.append(measure('unpack', lambda: receiver.unpack(packed_msg), iterations))
+
+  for attachment_size in ATTACHMENT_SIZES:
+    attachments = [{
+      'id': 'attachment-1',
+      'media_type': 'application/json',
+      'data': {'base64': base64.b64encode(os.urandom(attachment_size)).decode('ascii')}
+    }]
+    packed_msg = sender.pack(
+      msg_body, receiver_did, sender_did, 'https://example.org/benchmark', attachments=attachments)
+    results.append(measure(
+      'unpack_attachment_{}kb'.format(attachment_size // 1024), lambda: receiver.unpack(packed_msg),
+      max(5, iterations // 10)))
+
+
+def bench_multi_recipient_pack(results, iterations):
+  from did_communication_api.did_comm.did_comm import DIDComm
+  from did_communication_api.did_comm.secret_resolver import SecretsResolverLocal
+
+  sender = DIDComm(SecretsResolverLocal('sender_secrets.json'))
+  receiver = DIDComm(SecretsResolverLocal('receivers_secrets.json'))
+  sender_did = sender.create_peer_did('http://sender/')
+  receiver_dids = [receiver.create_peer_did('http://receiver/') for _ in range(max(RECIPIENT_COUNTS))]
+  msg_body = {'decision': 'revoked', 'credential': 'urn:uuid:0123456789', 'reason': 'x' * 1024}
+
+  for recipient_count in RECIPIENT_COUNTS:
+    recipients = receiver_dids[:recipient_count]
+    results.append(measure(
+      'pack_{}x_single_recipient'.format(recipient_count),
+      lambda: [sender.pack(msg_body, recipient, sender_did, 'https://example.org/benchmark')
+               for recipient in recipients],
+      max(5, iterations // 10)))
+    results.append(measure(
+      'pack_{}_recipients'.format(recipient_count),
+      lambda: sender.pack(msg_body, recipients, sender_did, 'https://example.org/benchmark'),
+      max(5, iterations // 10)))
+
+
+def bench_secrets_lookups(results, iterations, store_sizes):
+  from didcomm.secrets.secrets_util import generate_x25519_keys_as_jwk_dict
+  from did_communication_api.did_comm.secret_resolver import SecretsResolverLocal
+  from did_communication_api.did_comm.secret_resolver_sqlite import SecretsResolverSQLite
+
+  private_key = generate_x25519_keys_as_jwk_dict()[0]
+  for store_size in store_sizes:
+    # Synthetic store: the same key material under store_size different kids
+    file_path = 'secrets_{}.json'.format(store_size)
+    with open(file_path, 'w') as f:
+      json.dump([dict(private_key, kid='did:example:{}#key-1'.format(index)) for index in range(store_size)], f)
+    resolver = SecretsResolverLocal(file_path)
+    started = time.perf_counter()
+    run_sync(resolver.get_kids())
+    results.append(summarize('secrets_load_{}_keys'.format(store_size), [time.perf_counter() - started]))
+
+    kid = 'did:example:{}#key-1'.format(store_size // 2)
+    results.append(measure(
+      'secrets_get_key_{}_keys'.format(store_size), lambda: run_sync(resolver.get_key(kid)), iterations))
+    kids = ['did:example:{}#key-1'.format(index) for index in (0, store_size - 1)] + ['did:example:missing#key-1']
+    results.append(measure(
+      'secrets_get_keys_{}_keys'.format(store_size), lambda: run_sync(resolver.get_keys(kids)), iterations))
+
+    sqlite_resolver = SecretsResolverSQLite('secrets_{}.db'.format(store_size))
+    sqlite_resolver.import_json(file_path)
+    results.append(measure(
+      'secrets_sqlite_get_key_{}_keys'.format(store_size), lambda: run_sync(sqlite_resolver.get_key(kid)), iterations))
+    results.append(measure(
+      'secrets_sqlite_get_keys_{}_keys'.format(store_size), lambda: run_sync(sqlite_resolver.get_keys(kids)),
+      iterations))
+
+
+class _StubWebhook(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Headers and body are written separately; with Nagle's algorithm every response would wait for a delayed ACK
+  disable_nagle_algorithm = True
+
+  def do_POST(self):
+    request_data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+    response_data = json.dumps({
+      'response': {
+        'http_code': 200,
+        'type': 'DIDComm',
+        'message': {
+          'id': None,
+          'type': 'https://example.org/benchmark-response',
+          'body': {'received': request_data['request']['message']['id']}
+        }
+      }
+    }).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(response_data)))
+    self.end_headers()
+    self.wfile.write(response_data)
+
+  def log_message(self, *args):
+    pass
+
+
+def bench_inbox_round_trip(results, iterations):
+  webhook_server = ThreadingHTTPServer(('127.0.0.1', 0), _StubWebhook)
+  threading.Thread(target=webhook_server.serve_forever, daemon=True).start()
+  webhook_url = 'http://127.0.0.1:{}/webhook/'.format(webhook_server.server_port)
+
+  config_path = os.path.join(PROJECT_ROOT, 'did_communication_api', 'config', 'config.yml')
+  with open(config_path) as f:
+    config = f.read()
+  config = config.replace('http://access_decision_point:5002/webhook/message/', webhook_url)
+  config = config.replace('level: DEBUG', 'level: WARNING')
+  with open('config.yml', 'w') as f:
+    f.write(config)
+  os.environ['CONFIG_PATH'] = os.path.abspath('config.yml')
+
+  from did_communication_api import __main__ as service
+  from did_communication_api.did_comm.did_comm import DIDComm
+  from did_communication_api.did_comm.secret_resolver import SecretsResolverLocal
+
+  client = DIDComm(SecretsResolverLocal('client_secrets.json'))
+  client_did = client.create_peer_did('http://client/')
+  test_client = service.flask_app.test_client()
+
+  def round_trip():
+    packed_msg = client.pack({'request': 'GET /resource'}, service.server_did, client_did, 'https://example.org/bench')
+    response = test_client.post('/did_comm/inbox/', data={'didcomm_msg': packed_msg})
+    assert response.status_code == 200, response.data
+    client.unpack(response.get_json()['didcomm_msg'])
+
+  results.append(measure('inbox_round_trip', round_trip, iterations))
+
+  packed_msg = client.pack({'request': 'GET /resource'}, service.server_did, client_did, 'https://example.org/bench')
+  results.append(measure(
+    'inbox_server_side', lambda: test_client.post('/did_comm/inbox/', data={'didcomm_msg': packed_msg}), iterations))
+  webhook_server.shutdown()
+
+
+def check_regressions(results, baseline, threshold):
+  """
+  :return: List of (benchmark name, baseline p50, current p50) whose p50 latency grew by more than threshold
+  """
+  baseline_by_name = {result['name']: result for result in baseline['results']}
+  regressions = []
+  for result in results:
+    baseline_result = baseline_by_name.get(result['name'])
+    if baseline_result and result['p50_ms'] > baseline_result['p50_ms'] * (1 + threshold):
+      regressions.append((result['name'], baseline_result['p50_ms'], result['p50_ms']))
+  return regressions
+
+
+def git_revision():
+  try:
+    return subprocess.check_output(
+      ['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_ROOT, stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--output', help='Write the results as JSON to this file')
+  parser.add_argument('--baseline', help='JSON results of a previous run to compare against')
+  parser.add_argument('--threshold', type=float, default=0.2, help='Allowed relative p50 regression (default 0.2)')
+  parser.add_argument('--iterations', type=int, default=200, help='Measured runs per benchmark (default 200)')
+  parser.add_argument('--max-store-size', type=int, default=max(SECRETS_STORE_SIZES),
+                      help='Largest secrets store size to benchmark')
+  args = parser.parse_args()
+  # Relative to the caller's working directory, as the benchmarks run in a temporary one
+  output_path = os.path.abspath(args.output) if args.output else None
+  baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+  results = []
+  with tempfile.TemporaryDirectory() as work_dir:
+    os.chdir(work_dir)
+    bench_peer_dids(results, args.iterations)
+    bench_pack_unpack(results, args.iterations)
+    bench_multi_recipient_pack(results, args.iterations)
+    bench_secrets_lookups(
+      results, args.iterations, [size for size in SECRETS_STORE_SIZES if size <= args.max_store_size])
+    bench_inbox_round_trip(results, args.iterations)
+    os.chdir(PROJECT_ROOT)
+
+  report = {
+    'revision': git_revision(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'iterations': args.iterations,
+    'results': results,
+  }
+  for result in results:
+    print('{name:<32} p50 {p50_ms:9.3f} ms  p95 {p95_ms:9.3f} ms  p99 {p99_ms:9.3f} ms  {ops_per_sec:10.1f} ops/s'
+          .format(**result))
+  if output_path:
+    with open(output_path, 'w') as f:
+      json.dump(report, f, indent=2)
+
+  if baseline_path:
+    with open(baseline_path) as f:
+      regressions = check_regressions(results, json.load(f), args.threshold)
+    for name, baseline_p50, current_p50 in regressions:
+      print('REGRESSION {}: p50 {:.3f} ms -> {:.3f} ms'.format(name, baseline_p50, current_p50))
+    if regressions:
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -2,28 +2,80 @@
 
 """Main module."""
 
+# Imported first, so the startup report includes the imports of the service and its dependencies
+from did_communication_api import startup
+
+import functools
+import io
+import json
 import logging
+import os
 
-from flask import request
+from flask import request, Response, send_file
+from werkzeug.formparser import FormDataParser
 
-from did_communication_api import app_configurer, utils, constants
+from did_communication_api import app_configurer, compression, utils, constants, metrics, webhook_client
 from did_communication_api.api_handler import ApiHandler
 from did_communication_api.did_comm.did_comm import DIDComm
-from did_communication_api.did_comm.secret_resolver import SecretsResolverLocal
+from did_communication_api.prewarm import prewarm_worker
+
+# Chunk size when reading raw request bodies
+BODY_CHUNK_SIZE = 65536
+startup.mark(startup.PHASE_IMPORTS)
 
 # Initialize Flask Application
 flask_app = app_configurer.initialize_flask_app(__name__)
+startup.mark(startup.PHASE_CONFIGURATION)
 
 # Initialize Secret Resolver and DIDComm
-secret_resolver = SecretsResolverLocal()
-did_comm = DIDComm(secret_resolver)
+secret_resolver = app_configurer.create_secret_resolver()
+did_resolver_config = utils.load_component_configuration('did_resolver')
+did_comm = DIDComm(secret_resolver, did_cache_size=did_resolver_config['cache_size'])
+startup.mark(startup.PHASE_SECRETS)
 
-# Generate the Server's Peer DID
+# Load (or create) the Server's Peer DID
 server_did = app_configurer.create_server_did(did_comm)
 logging.info(f'Server DID: {server_did}')
+startup.mark(startup.PHASE_SERVER_IDENTITY)
 
 # Initialize the API Handler
-api_handler = ApiHandler(did_comm, server_did)
+api_handler = ApiHandler(app_configurer.create_crypto_backend(did_comm, server_did), server_did)
+message_pickup_handler = app_configurer.configure_async_delivery(api_handler)
+replay_store = app_configurer.configure_replay_cache(api_handler)
+decision_cache = app_configurer.configure_decision_cache(api_handler)
+attachment_store = app_configurer.configure_attachment_offload(api_handler)
+tenants_handler = app_configurer.configure_tenants(api_handler, did_comm)
+app_configurer.configure_jwe_precheck(api_handler, secret_resolver)
+outbox_handler = app_configurer.configure_outbox(api_handler, did_comm)
+admission_controller = app_configurer.configure_admission(api_handler)
+
+# Report the hits and misses of the in-memory caches
+metrics.register_cache('did_resolver', did_comm.did_resolver.cache.stats)
+if hasattr(secret_resolver, 'stats'):
+  metrics.register_cache('secrets', secret_resolver.stats)
+if replay_store is not None:
+  metrics.register_cache('replay', replay_store.stats)
+if decision_cache is not None:
+  metrics.register_cache('decision', decision_cache.stats)
+startup.mark(startup.PHASE_COMPONENTS)
+metrics.observe_startup_phases(startup.phases())
+startup.log_report('Service booted')
+
+
+def admission_controlled(view):
+  """ Sheds requests with HTTP 503 (Retry-After) while the admission controller of this worker is saturated """
+  @functools.wraps(view)
+  def admission_controlled_view(*args, **kwargs):
+    if admission_controller is None:
+      return view(*args, **kwargs)
+    if not admission_controller.acquire():
+      response_data, http_code = utils.overloaded_resp(admission_controller.retry_after)
+      return response_data, http_code, utils.retry_after_headers(response_data)
+    try:
+      return view(*args, **kwargs)
+    finally:
+      admission_controller.release()
+  return admission_controlled_view
 
 
 @flask_app.route('/-system/liveness')
@@ -31,18 +83,200 @@ def check_system_liveness():
   return 'ok', constants.HTTP_SUCCESS_STATUS
 
 
+@flask_app.route('/-system/readiness')
+def check_system_readiness():
+  # Ready once this worker process is pre-warmed; reports the durations of the startup phases
+  if not startup.is_ready():
+    return startup.report(), constants.HTTP_SERVICE_UNAVAILABLE
+  return startup.report(), constants.HTTP_SUCCESS_STATUS
+
+
+@flask_app.route('/-system/webhook/stats')
+def get_webhook_pool_stats():
+  # Connection pool statistics of the webhook client of this worker process
+  return {'pid': os.getpid(), 'pool': webhook_client.get_webhook_client().stats.as_dict()}, \
+    constants.HTTP_SUCCESS_STATUS
+
+
+@flask_app.route('/-system/metrics')
+def get_metrics():
+  # Prometheus metrics of the inbox (of all worker processes if PROMETHEUS_MULTIPROC_DIR is set)
+  metrics_data, content_type = metrics.generate_metrics()
+  return metrics_data, constants.HTTP_SUCCESS_STATUS, {'Content-Type': content_type}
+
+
+@flask_app.route(constants.API_INTERNAL_ATTACHMENTS + '<digest>')
+def get_attachment(digest):
+  # Used by the webhook to retrieve the data of offloaded attachments
+  file_path = attachment_store.get_path(digest) if attachment_store is not None else None
+  if file_path is None:
+    return utils.generate_err_resp('Attachment not found', constants.HTTP_NOT_FOUND)
+  return send_file(os.path.abspath(file_path), mimetype='application/octet-stream')
+
+
+@flask_app.route(constants.API_INTERNAL_DECISION_CACHE, methods=['DELETE'])
+def invalidate_decisions():
+  # Used by the webhook to invalidate stored decisions, e.g. after a policy change or a revocation
+  if decision_cache is None:
+    return utils.generate_err_resp('Decision cache is disabled', constants.HTTP_NOT_FOUND)
+  sender, msg_type = request.args.get('sender'), request.args.get('msg_type')
+  decision_cache.invalidate(sender=sender, msg_type=msg_type)
+  return {'sender': sender, 'msg_type': msg_type, 'status': 'invalidated'}, constants.HTTP_SUCCESS_STATUS
+
+
+@flask_app.route(constants.API_INTERNAL_OUTBOX, methods=['POST'])
+def send_messages():
+  # Used by other services to send DIDComm messages to Peer DIDs
+  if outbox_handler is None:
+    return utils.generate_err_resp('Outbox is disabled', constants.HTTP_NOT_FOUND)
+  return outbox_handler.handle_send_request(request.get_json(silent=True))
+
+
+@flask_app.route(constants.API_INTERNAL_TENANTS + '<tenant>', methods=['GET', 'PUT'])
+def manage_tenant(tenant):
+  # Used by other services to register tenants and their webhooks
+  if tenants_handler is None:
+    return utils.generate_err_resp('Tenants are disabled', constants.HTTP_NOT_FOUND)
+  if request.method == 'PUT':
+    return tenants_handler.handle_put_tenant(tenant, request.get_json(silent=True))
+  return tenants_handler.handle_get_tenant(tenant)
+
+
+@flask_app.route(constants.API_INTERNAL_TENANTS + '<tenant>/dids', methods=['POST'])
+def create_tenant_did(tenant):
+  # Used by other services to create a new server DID of a tenant (e.g. one per connection)
+  if tenants_handler is None:
+    return utils.generate_err_resp('Tenants are disabled', constants.HTTP_NOT_FOUND)
+  return tenants_handler.handle_create_identity(tenant)
+
+
 @flask_app.route(constants.API_EXTERNAL_INBOX, methods=['GET', 'POST', 'PUT', 'DELETE'])
+@admission_controlled
 def receive_message():
   # Used by other systems to send HTTP Requests with encrypted (DIDComm) Payload
   http_method = request.method
-  packed_msg = request.form.get('didcomm_msg')
+  deadline = utils.request_deadline(request.headers.get)
+  with metrics.stage(metrics.STAGE_FORM_PARSING):
+    packed_msg, error_response = get_packed_msg()
+  if error_response:
+    return error_response
+
+  return didcomm_response(*api_handler.handle_message_received(packed_msg, http_method, deadline))
+
+
+@flask_app.route(constants.API_EXTERNAL_INBOX_BATCH, methods=['GET', 'POST', 'PUT', 'DELETE'])
+@admission_controlled
+def receive_message_batch():
+  # Used by other systems to send several encrypted (DIDComm) messages in a single HTTP Request
+  deadline = utils.request_deadline(request.headers.get)
+  request_data, error_response = get_json_body()
+  if error_response:
+    return error_response
+  packed_msgs, error_response = utils.get_batch_messages(request_data)
+  if error_response:
+    return error_response
+
+  return api_handler.handle_batch_received(packed_msgs, request.method, deadline)
+
+
+@flask_app.route(constants.API_EXTERNAL_PICKUP, methods=['POST'])
+def receive_pickup_message():
+  # Used by other systems to collect the responses to their requests in the asynchronous delivery mode
+  if message_pickup_handler is None:
+    return utils.generate_err_resp('Asynchronous delivery mode is disabled', constants.HTTP_NOT_FOUND)
+  packed_msg, error_response = get_packed_msg()
+  if error_response:
+    return error_response
+
+  return didcomm_response(*message_pickup_handler.handle_pickup_message(packed_msg))
+
+
+def get_packed_msg():
+  """
+  Reads the packed DIDComm message of the request: either the raw body (media type
+  application/didcomm-encrypted+json) or the didcomm_msg field of a form.
+
+  :return: (packed message, None) or (None, error response)
+  """
+  body, error_response = read_request_body()
+  if error_response:
+    return None, error_response
+  if utils.is_raw_didcomm_body(request.content_type):
+    packed_msg = body.decode('utf-8', errors='replace')
+  else:
+    # Parsed from the read body, so the size limit applies to forms as well (also to chunked requests)
+    _, form, _ = FormDataParser().parse(io.BytesIO(body), request.mimetype, len(body), request.mimetype_params)
+    packed_msg = form.get('didcomm_msg')
   if not packed_msg:
     logging.warning("Received HTTP Request with invalid body structure. Missing didcomm_msg attribute")
-    return utils.generate_err_resp('Missing didcomm_msg', constants.HTTP_BAD_REQUEST)
+    return None, utils.generate_err_resp('Missing didcomm_msg', constants.HTTP_BAD_REQUEST)
+  return packed_msg, None
+
+
+def get_json_body():
+  """ :return: (parsed JSON body, or None if the body is no valid JSON, None) or (None, error response) """
+  if not request.is_json and not compression.is_encoded(request.headers.get('Content-Encoding')):
+    return None, None
+  body, error_response = read_request_body()
+  if error_response:
+    return None, error_response
+  try:
+    return json.loads(body), None
+  except ValueError:
+    return None, None
+
+
+def read_request_body():
+  """
+  Reads the (decompressed) body of an inbox request, at most inbox.max_body_size bytes.
+
+  :return: (body, None) or (None, error response)
+  """
+  max_body_size = utils.load_component_configuration('inbox')['max_body_size']
+  if request.content_length is not None and request.content_length > max_body_size:
+    return None, utils.payload_too_large_resp()
+  body = read_body(max_body_size)
+  if body is None:
+    return None, utils.payload_too_large_resp()
+  return compression.decode_request_body(body, request.headers.get('Content-Encoding'))
+
+
+def read_body(max_body_size):
+  """ :return: The request body, or None as soon as it exceeds max_body_size bytes """
+  chunks = []
+  body_size = 0
+  while True:
+    chunk = request.stream.read(BODY_CHUNK_SIZE)
+    if not chunk:
+      return b''.join(chunks)
+    body_size += len(chunk)
+    if body_size > max_body_size:
+      return None
+    chunks.append(chunk)
+
+
+def didcomm_response(response_data, http_code):
+  # Clients accepting application/didcomm-encrypted+json get the packed response message as raw body
+  if 'didcomm_msg' in response_data and utils.accepts_raw_didcomm(request.headers.get('Accept')):
+    return Response(response_data['didcomm_msg'], status=http_code, mimetype=constants.DIDCOMM_ENCRYPTED_MEDIA_TYPE)
+  return response_data, http_code, utils.retry_after_headers(response_data)
+
 
-  return api_handler.handle_message_received(packed_msg, http_method)
+@flask_app.after_request
+def compress_response(response):
+  # Compresses the response if the client accepts a configured encoding (Accept-Encoding)
+  if response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers:
+    return response
+  body, encoding = compression.encode_response_body(response.get_data(), request.headers.get('Accept-Encoding'))
+  if encoding is not None:
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+  return response
 
 
 if __name__ == '__main__':
+  app_configurer.start_worker_threads(api_handler)
+  prewarm_worker(did_comm, api_handler.did_comm, server_did)
   server_config = utils.load_component_configuration('server')
   flask_app.run(debug=server_config['debug'], port=server_config['port'], host=server_config['host'])
@@ -0,0 +1,153 @@
+"""
+Admission control of the inbox: bounds the requests a worker process handles concurrently and sheds the excess
+early with 503 (Retry-After), instead of letting every request queue on the webhook and the secrets store.
+"""
+
+import asyncio
+import math
+import threading
+import time
+
+from did_communication_api import metrics
+from did_communication_api.lru_cache import LRUCache
+
+
+class AdmissionController:
+  """
+  Admits at most max_in_flight requests at a time. Further requests wait in a queue of at most max_queued requests
+  for at most queue_timeout seconds; requests finding the queue full or waiting too long are shed.
+
+  acquire/release serve the WSGI application (threads or green threads), acquire_async/release_async the ASGI
+  application (the event loop of the worker process).
+  """
+
+  def __init__(self, max_in_flight, max_queued, queue_timeout, retry_after=1):
+    """
+    :param max_in_flight: Maximum number of requests handled concurrently
+    :param max_queued: Maximum number of requests waiting for admission (0: shed immediately)
+    :param queue_timeout: Maximum seconds a request waits for admission
+    :param retry_after: Seconds after which shed clients should retry (Retry-After header)
+    """
+    self.max_in_flight = max_in_flight
+    self.max_queued = max_queued
+    self.queue_timeout = queue_timeout
+    self.retry_after = retry_after
+    self.in_flight = 0
+    self.queued = 0
+    self._condition = threading.Condition()
+    self._async_condition = None
+
+  def acquire(self):
+    """ :return: True iff the request is admitted; it must call release() when done """
+    with self._condition:
+      if self.in_flight < self.max_in_flight and not self.queued:
+        self._admit()
+        return True
+      if not self._enqueue():
+        return False
+      deadline = time.monotonic() + self.queue_timeout
+      try:
+        while self.in_flight >= self.max_in_flight:
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            metrics.observe_shed(metrics.SHED_QUEUE_TIMEOUT)
+            # Pass on a wakeup this request may have consumed
+            self._condition.notify()
+            return False
+          self._condition.wait(remaining)
+      finally:
+        self._dequeue()
+      self._admit()
+      return True
+
+  def release(self):
+    with self._condition:
+      self._release()
+      self._condition.notify()
+
+  async def acquire_async(self):
+    """ Same as acquire, but waits without blocking the event loop. """
+    condition = self._get_async_condition()
+    async with condition:
+      if self.in_flight < self.max_in_flight and not self.queued:
+        self._admit()
+        return True
+      if not self._enqueue():
+        return False
+      deadline = time.monotonic() + self.queue_timeout
+      try:
+        while self.in_flight >= self.max_in_flight:
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            metrics.observe_shed(metrics.SHED_QUEUE_TIMEOUT)
+            condition.notify()
+            return False
+          try:
+            await asyncio.wait_for(condition.wait(), remaining)
+          except asyncio.TimeoutError:
+            pass
+      finally:
+        self._dequeue()
+      self._admit()
+      return True
+
+  async def release_async(self):
+    condition = self._get_async_condition()
+    async with condition:
+      self._release()
+      condition.notify()
+
+  def _get_async_condition(self):
+    # Created on first use, as it must be bound to the event loop of the worker process
+    if self._async_condition is None:
+      self._async_condition = asyncio.Condition()
+    return self._async_condition
+
+  def _admit(self):
+    self.in_flight += 1
+    metrics.INBOX_IN_FLIGHT.inc()
+
+  def _release(self):
+    self.in_flight -= 1
+    metrics.INBOX_IN_FLIGHT.dec()
+
+  def _enqueue(self):
+    if self.queued >= self.max_queued:
+      metrics.observe_shed(metrics.SHED_QUEUE_FULL)
+      return False
+    self.queued += 1
+    metrics.INBOX_QUEUED.inc()
+    return True
+
+  def _dequeue(self):
+    self.queued -= 1
+    metrics.INBOX_QUEUED.dec()
+
+
+class SenderRateLimiter:
+  """
+  Token bucket per sender DID: a sender may send burst messages at once and rate messages per second on average.
+  The buckets of the max_senders most recent senders are kept (in the memory of this worker process).
+  """
+
+  def __init__(self, rate, burst, max_senders=100000):
+    self.rate = rate
+    self.burst = burst
+    # Sender DID -> [tokens, time of the last update]
+    self.buckets = LRUCache(max_senders)
+    self._lock = threading.Lock()
+
+  def acquire(self, sender):
+    """ :return: 0 if the sender may send a message now, otherwise the seconds until it may """
+    now = time.monotonic()
+    with self._lock:
+      bucket = self.buckets.get(sender)
+      if bucket is None:
+        bucket = [float(self.burst), now]
+        self.buckets.put(sender, bucket)
+      bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+      bucket[1] = now
+      if bucket[0] >= 1:
+        bucket[0] -= 1
+        return 0
+      return max(1, math.ceil((1 - bucket[0]) / self.rate))
@@ -1,76 +1,535 @@
+import asyncio
+import concurrent.futures
 import logging
+import time
+
 import requests
-import sys
 
-from did_communication_api import utils, constants
-from did_communication_api.errors import MyDIDCommError
+from did_communication_api import utils, constants, metrics, webhook_client
+from did_communication_api.decision_cache import decision_key, ttl_of
+from did_communication_api.errors import MyDIDCommError, CryptoExecutorBusyError
+from did_communication_api.tenants import Identity
+
+# Only used in the asynchronous serving mode (ASGI)
+httpx = utils.lazy_import('httpx')
 
 
 class ApiHandler:
+  """
+  Handles received DIDComm requests: unpack, notify the webhook and pack the response it instructs.
+
+  handle_message_received serves the WSGI application, handle_message_received_async the ASGI application.
+  Both run the same steps; the async variant awaits the DIDComm operations and the webhook call on the running
+  event loop instead of blocking.
+  """
 
   def __init__(self, did_comm, server_did):
     self.did_comm = did_comm
     self.server_did = server_did
+    # Asynchronous delivery mode, see enable_async_delivery
+    self.message_queue = None
+    self.message_dispatcher = None
+    # Responses to completed requests, see enable_replay_cache
+    self.replay_cache = None
+    # Offloads large attachments, see enable_attachment_offload
+    self.attachment_offloader = None
+    # Validates messages before unpacking, see enable_jwe_precheck
+    self.jwe_precheck = None
+    # Server DIDs of tenants, see enable_tenants
+    self.tenant_registry = None
+    # Limits the messages per sender, see enable_sender_rate_limit
+    self.sender_rate_limiter = None
+    # Decisions of the webhook on repeatable requests, see enable_decision_cache
+    self.decision_cache = None
+
+  def enable_async_delivery(self, message_queue, message_dispatcher):
+    """
+    Switches to the asynchronous delivery mode: received messages are unpacked and persisted in the message queue,
+    the client gets HTTP 202 immediately and the dispatcher notifies the webhook in the background. The packed
+    responses are collected by the client through the Message Pickup protocol.
+    """
+    self.message_queue = message_queue
+    self.message_dispatcher = message_dispatcher
+
+  def enable_replay_cache(self, replay_cache):
+    """
+    Answers retries of a request (same sender and message id) with the response to the original request instead of
+    notifying the webhook again. Duplicates received while the original is handled wait for its response.
+    """
+    self.replay_cache = replay_cache
+
+  def enable_attachment_offload(self, attachment_offloader):
+    """
+    Replaces large attachments of received messages by references to the attachment store before the webhook is
+    notified (or the message is queued), so their data is not embedded in the notification.
+    """
+    self.attachment_offloader = attachment_offloader
+
+  def enable_jwe_precheck(self, jwe_precheck):
+    """ Rejects messages failing the JWEPreCheck before unpacking them. """
+    self.jwe_precheck = jwe_precheck
+
+  def enable_tenants(self, tenant_registry):
+    """
+    Answers messages sent to a server DID of a tenant from that DID (instead of the server DID) and notifies the
+    tenant's webhook, if it has one.
+    """
+    self.tenant_registry = tenant_registry
+
+  def enable_sender_rate_limit(self, sender_rate_limiter):
+    """
+    Answers messages of senders exceeding their rate limit with HTTP 429 (Retry-After) instead of notifying the
+    webhook. Retries of answered requests are still served by the replay cache.
+    """
+    self.sender_rate_limiter = sender_rate_limiter
+
+  def enable_decision_cache(self, decision_cache):
+    """
+    Answers requests equal to an earlier request whose response the webhook allowed to be cached with the stored
+    response (as a new message) instead of notifying the webhook again.
+    """
+    self.decision_cache = decision_cache
+
+  def _decision_key(self, message_unpacked_dict, http_method, recipient):
+    """ :return: (key of the request in the decision cache, generation of the cache at lookup) or None """
+    if self.decision_cache is None or not message_unpacked_dict['frm']:
+      return None
+    key = decision_key(message_unpacked_dict, http_method, recipient.did)
+    return (key, self.decision_cache.generation()) if key is not None else None
+
+  def _cached_decision(self, key):
+    """ :return: The response instructed by the webhook for an equal earlier request, or None """
+    if key is None:
+      return None
+    response = self.decision_cache.get(key[0])
+    if response is None:
+      return None
+    # Sent as a new message (with a new message id) on every hit
+    return dict(response, message=dict(response['message'], msg_id=None), outcome=metrics.OUTCOME_DECISION_CACHED)
+
+  def _cache_decision(self, key, webhook_response, response):
+    if key is not None and response['outcome'] == metrics.OUTCOME_SUCCESS:
+      self.decision_cache.put(key[0], response, ttl_of(webhook_response), key[1])
+
+  def _rate_limit(self, message_unpacked_dict):
+    """ :return: None if the sender may send the message now, otherwise the response to the message """
+    sender = message_unpacked_dict['frm']
+    if self.sender_rate_limiter is None or not sender:
+      return None
+    retry_after = self.sender_rate_limiter.acquire(sender)
+    if not retry_after:
+      return None
+    metrics.observe_shed(metrics.SHED_RATE_LIMITED)
+    logging.warning('Sender {} exceeded its rate limit. Responding with HTTP 429'.format(sender))
+    return utils.retry_later_resp('Too Many Requests', constants.HTTP_TOO_MANY_REQUESTS, retry_after)
+
+  def _recipient_of(self, message_unpacked_dict):
+    """ :return: The Identity the message was sent to """
+    recipient_did = message_unpacked_dict.get('to')
+    if self.tenant_registry is not None and recipient_did and recipient_did != self.server_did:
+      identity = self.tenant_registry.lookup(recipient_did)
+      if identity is not None:
+        metrics.observe_tenant_request(identity.tenant)
+        return identity
+    # Messages to the server DID (or a retired server DID) are answered from the server DID
+    return Identity(self.server_did, None)
+
+  def _precheck(self, didcomm_packed_msg):
+    """ :return: None if the message may be unpacked, otherwise the reason to reject it """
+    if self.jwe_precheck is None:
+      return None
+    with metrics.stage(metrics.STAGE_PRECHECK):
+      reject_reason = self.jwe_precheck.check(didcomm_packed_msg)
+    if reject_reason is not None:
+      metrics.observe_precheck_reject(reject_reason)
+    return reject_reason
+
+  def _offload_attachments(self, message_unpacked_dict):
+    if self.attachment_offloader is None:
+      return message_unpacked_dict
+    return self.attachment_offloader.offload(message_unpacked_dict)
+
+  def handle_message_received(self, didcomm_packed_msg, http_method, deadline=None):
+    """
+    :param deadline: Time (time.monotonic()) by which the client needs the response, see utils.request_deadline.
+      The webhook call is cut short (and fails) when it is reached.
+    """
+    started = time.perf_counter()
+    try:
+      response, outcome = self._handle_message_received(didcomm_packed_msg, http_method, deadline)
+    except CryptoExecutorBusyError:
+      response, outcome = _crypto_busy_response(), metrics.OUTCOME_BUSY
+    return _observed(response, outcome, started, didcomm_packed_msg)
+
+  async def handle_message_received_async(self, didcomm_packed_msg, http_method, deadline=None):
+    started = time.perf_counter()
+    try:
+      response, outcome = await self._handle_message_received_async(didcomm_packed_msg, http_method, deadline)
+    except CryptoExecutorBusyError:
+      response, outcome = _crypto_busy_response(), metrics.OUTCOME_BUSY
+    return _observed(response, outcome, started, didcomm_packed_msg)
+
+  def _handle_message_received(self, didcomm_packed_msg, http_method, deadline):
+    reject_reason = self._precheck(didcomm_packed_msg)
+    if reject_reason is not None:
+      return _rejected_message_response(reject_reason), metrics.OUTCOME_REJECTED
 
-  def __respond_with_error_encrypted(self, error_msg, http_code, didcomm_receiver):
-    response_message_encrypted = self.did_comm.pack(
-      msg_body={'error': error_msg},
-      to=didcomm_receiver,
-      frm=self.server_did,
-      msg_type=constants.DIDCOMM_ERROR_MSG_TYPE,
-      msg_id=None
-    )
-    return {'didcomm_msg': response_message_encrypted}, http_code
-
-  def handle_message_received(self, didcomm_packed_msg, http_method):
     # Unpack message
     try:
-      message_unpacked_dict = self.did_comm.unpack(didcomm_packed_msg)
+      with metrics.stage(metrics.STAGE_UNPACK):
+        message_unpacked_dict = self.did_comm.unpack(didcomm_packed_msg)
     except MyDIDCommError:
-      logging.warning(constants.INVALID_REQUEST_RECEIVED.format(
-        "Could not decrypt/authenticate DIDComm Message"))
-      return utils.generate_err_resp('Invalid DIDComm Message', constants.HTTP_BAD_REQUEST)
-
-    # logging.info(constants.DIDCOMM_MESSAGE_RECEIVED.format(
-    #   msg_id=message_unpacked_dict['msg_id'], msg_type=message_unpacked_dict['msg_type']
-    # ))
-
-    # Notify ADP
-    webhook_response = webhook_new_request_received(
-      sender=message_unpacked_dict['frm'],
-      http_request_method=http_method,
-      msg_body=message_unpacked_dict['msg_body'],
-      msg_type=message_unpacked_dict['msg_type'],
-      msg_id=message_unpacked_dict['msg_id'],
-      attachments=message_unpacked_dict['attachments']
-    )
-
-    if not is_webhook_response_valid(webhook_response):
-      logging.error("Received an invalid response from Webhook. Responding to client with HTTP 500")
-      return self.__respond_with_error_encrypted(
-        'Internal Server Error', constants.HTTP_INTERNAL_ERROR, message_unpacked_dict['frm'])
-
-    if 'error' in webhook_response:
-      logging.error("Received an Error response from Webhook. Responding to client with HTTP 500")
-      return self.__respond_with_error_encrypted(
-        'Internal Server Error', constants.HTTP_INTERNAL_ERROR, message_unpacked_dict['frm'])
+      return _invalid_message_response(), metrics.OUTCOME_INVALID_MESSAGE
+    message_unpacked_dict = self._offload_attachments(message_unpacked_dict)
+
+    if self.replay_cache is not None and message_unpacked_dict['frm']:
+      (response, outcome), replayed = self.replay_cache.get_or_compute(
+        _replay_key(message_unpacked_dict), lambda: self._respond(message_unpacked_dict, http_method, deadline),
+        _is_replayable)
+      return tuple(response), metrics.OUTCOME_REPLAYED if replayed else outcome
+    return self._respond(message_unpacked_dict, http_method, deadline)
+
+  def _respond(self, message_unpacked_dict, http_method, deadline):
+    rate_limited_response = self._rate_limit(message_unpacked_dict)
+    if rate_limited_response is not None:
+      return rate_limited_response, metrics.OUTCOME_RATE_LIMITED
+    if self.message_queue is not None:
+      return self._enqueue(message_unpacked_dict, http_method), metrics.OUTCOME_QUEUED
+
+    recipient = self._recipient_of(message_unpacked_dict)
+    key = self._decision_key(message_unpacked_dict, http_method, recipient)
+    response = self._cached_decision(key)
+    if response is None:
+      # Notify ADP
+      with metrics.stage(metrics.STAGE_WEBHOOK):
+        webhook_response = webhook_new_request_received(
+          **_notification_of(message_unpacked_dict, http_method, recipient), deadline=deadline)
+      with metrics.stage(metrics.STAGE_PARSE_WEBHOOK_RESPONSE):
+        response = _response_instructed_by(webhook_response, message_unpacked_dict['msg_id'])
+      self._cache_decision(key, webhook_response, response)
 
     # Encrypt + Authenticate Response
-    response_didcomm_parsed = parse_didcomm_webhook_response(webhook_response)
-    response_message_encrypted = self.did_comm.pack(
-      msg_body=response_didcomm_parsed['body'],
-      to=message_unpacked_dict['frm'],
-      frm=self.server_did,
-      msg_type=response_didcomm_parsed['type'],
-      msg_id=response_didcomm_parsed['id']
-    )
-
-    # logging.info(constants.SENDING_RESPONSE.format(
-    #   req_msg_id=message_unpacked_dict['msg_id'],
-    #   resp_msg_type=response_didcomm_parsed['type'],
-    #   resp_http_code=response_didcomm_parsed['http_code']
-    # ))
-    return {'didcomm_msg': response_message_encrypted}, response_didcomm_parsed['http_code']
+    with metrics.stage(metrics.STAGE_PACK):
+      response_message_encrypted = self.did_comm.pack(
+        to=message_unpacked_dict['frm'], frm=recipient.did, thid=utils.reply_thread_id(message_unpacked_dict),
+        **response['message'])
+    return ({'didcomm_msg': response_message_encrypted}, response['http_code']), response['outcome']
+
+  async def _handle_message_received_async(self, didcomm_packed_msg, http_method, deadline):
+    reject_reason = self._precheck(didcomm_packed_msg)
+    if reject_reason is not None:
+      return _rejected_message_response(reject_reason), metrics.OUTCOME_REJECTED
+
+    # Unpack message
+    try:
+      with metrics.stage(metrics.STAGE_UNPACK):
+        message_unpacked_dict = await self.did_comm.unpack_async(didcomm_packed_msg)
+    except MyDIDCommError:
+      return _invalid_message_response(), metrics.OUTCOME_INVALID_MESSAGE
+    message_unpacked_dict = self._offload_attachments(message_unpacked_dict)
+
+    if self.replay_cache is not None and message_unpacked_dict['frm']:
+      (response, outcome), replayed = await self.replay_cache.get_or_compute_async(
+        _replay_key(message_unpacked_dict), lambda: self._respond_async(message_unpacked_dict, http_method, deadline),
+        _is_replayable)
+      return tuple(response), metrics.OUTCOME_REPLAYED if replayed else outcome
+    return await self._respond_async(message_unpacked_dict, http_method, deadline)
+
+  async def _respond_async(self, message_unpacked_dict, http_method, deadline):
+    rate_limited_response = self._rate_limit(message_unpacked_dict)
+    if rate_limited_response is not None:
+      return rate_limited_response, metrics.OUTCOME_RATE_LIMITED
+    if self.message_queue is not None:
+      return self._enqueue(message_unpacked_dict, http_method), metrics.OUTCOME_QUEUED
+
+    recipient = self._recipient_of(message_unpacked_dict)
+    key = self._decision_key(message_unpacked_dict, http_method, recipient)
+    response = self._cached_decision(key)
+    if response is None:
+      # Notify ADP
+      with metrics.stage(metrics.STAGE_WEBHOOK):
+        webhook_response = await webhook_new_request_received_async(
+          **_notification_of(message_unpacked_dict, http_method, recipient), deadline=deadline)
+      with metrics.stage(metrics.STAGE_PARSE_WEBHOOK_RESPONSE):
+        response = _response_instructed_by(webhook_response, message_unpacked_dict['msg_id'])
+      self._cache_decision(key, webhook_response, response)
+
+    # Encrypt + Authenticate Response
+    with metrics.stage(metrics.STAGE_PACK):
+      response_message_encrypted = await self.did_comm.pack_async(
+        to=message_unpacked_dict['frm'], frm=recipient.did, thid=utils.reply_thread_id(message_unpacked_dict),
+        **response['message'])
+    return ({'didcomm_msg': response_message_encrypted}, response['http_code']), response['outcome']
+
+  def handle_batch_received(self, didcomm_packed_msgs, http_method, deadline=None):
+    """
+    Handles DIDComm messages received in a single HTTP request. Every message is unpacked and answered
+    independently; the webhook is notified of all valid messages at once.
+
+    :param didcomm_packed_msgs: List of packed DIDComm messages
+    :param http_method: The HTTP Request Method of the Client's Request
+    :param deadline: Time (time.monotonic()) by which the client needs the response, see handle_message_received
+    :return: ({'results': [<result per message>]}, HTTP 200) where a result is either
+      {'http_code': <code>, 'didcomm_msg': <packed response>} or {'http_code': <code>, 'error': <error>}
+    """
+    results = [None] * len(didcomm_packed_msgs)
+    unpacked_msgs = {}
+    for index, packed_msg in enumerate(didcomm_packed_msgs):
+      reject_reason = self._precheck(packed_msg)
+      if reject_reason is not None:
+        results[index] = _batch_item(_rejected_message_response(reject_reason))
+        continue
+      try:
+        unpacked_msgs[index] = self._offload_attachments(self.did_comm.unpack(packed_msg))
+      except Exception as error:
+        results[index] = _batch_unpack_error(error)
+    self._rate_limit_batch(unpacked_msgs, results)
+
+    if self.message_queue is not None:
+      for index, unpacked_msg in unpacked_msgs.items():
+        results[index] = _batch_item(self._enqueue(unpacked_msg, http_method))
+      return {'results': results}, constants.HTTP_SUCCESS_STATUS
+
+    recipients = {index: self._recipient_of(unpacked_msg) for index, unpacked_msg in unpacked_msgs.items()}
+    keys, responses, notified = self._cached_batch_decisions(unpacked_msgs, recipients, http_method)
+    if notified:
+      webhook_responses = webhook_new_requests_received([
+        _notification_of(unpacked_msgs[index], http_method, recipients[index]) for index in notified
+      ], deadline)
+      for index, webhook_response in zip(notified, webhook_responses):
+        responses[index] = _response_instructed_by(webhook_response, unpacked_msgs[index]['msg_id'])
+        self._cache_decision(keys[index], webhook_response, responses[index])
+
+    for index in unpacked_msgs:
+      response = responses[index]
+      try:
+        response_message_encrypted = self.did_comm.pack(
+          to=unpacked_msgs[index]['frm'], frm=recipients[index].did, thid=utils.reply_thread_id(unpacked_msgs[index]),
+          **response['message'])
+      except Exception as error:
+        results[index] = _batch_pack_error(error)
+        continue
+      results[index] = {'http_code': response['http_code'], 'didcomm_msg': response_message_encrypted}
+    return {'results': results}, constants.HTTP_SUCCESS_STATUS
+
+  async def handle_batch_received_async(self, didcomm_packed_msgs, http_method, deadline=None):
+    """ Same as handle_batch_received, but unpacks, notifies and packs the messages concurrently. """
+    results = [None] * len(didcomm_packed_msgs)
+    unpacked_msgs = {}
+    accepted = []
+    for index, packed_msg in enumerate(didcomm_packed_msgs):
+      reject_reason = self._precheck(packed_msg)
+      if reject_reason is not None:
+        results[index] = _batch_item(_rejected_message_response(reject_reason))
+      else:
+        accepted.append(index)
+    unpack_results = await asyncio.gather(
+      *[self.did_comm.unpack_async(didcomm_packed_msgs[index]) for index in accepted], return_exceptions=True)
+    for index, unpack_result in zip(accepted, unpack_results):
+      if isinstance(unpack_result, Exception):
+        results[index] = _batch_unpack_error(unpack_result)
+      else:
+        unpacked_msgs[index] = self._offload_attachments(unpack_result)
+    self._rate_limit_batch(unpacked_msgs, results)
+
+    if self.message_queue is not None:
+      for index, unpacked_msg in unpacked_msgs.items():
+        results[index] = _batch_item(self._enqueue(unpacked_msg, http_method))
+      return {'results': results}, constants.HTTP_SUCCESS_STATUS
+
+    recipients = {index: self._recipient_of(unpacked_msg) for index, unpacked_msg in unpacked_msgs.items()}
+    keys, responses, notified = self._cached_batch_decisions(unpacked_msgs, recipients, http_method)
+    if notified:
+      webhook_responses = await webhook_new_requests_received_async([
+        _notification_of(unpacked_msgs[index], http_method, recipients[index]) for index in notified
+      ], deadline)
+      for index, webhook_response in zip(notified, webhook_responses):
+        responses[index] = _response_instructed_by(webhook_response, unpacked_msgs[index]['msg_id'])
+        self._cache_decision(keys[index], webhook_response, responses[index])
+
+    pack_results = await asyncio.gather(*[
+      self.did_comm.pack_async(
+        to=unpacked_msgs[index]['frm'], frm=recipients[index].did, thid=utils.reply_thread_id(unpacked_msgs[index]),
+        **responses[index]['message'])
+      for index in unpacked_msgs
+    ], return_exceptions=True)
+    for index, pack_result in zip(unpacked_msgs, pack_results):
+      if isinstance(pack_result, Exception):
+        results[index] = _batch_pack_error(pack_result)
+      else:
+        results[index] = {'http_code': responses[index]['http_code'], 'didcomm_msg': pack_result}
+    return {'results': results}, constants.HTTP_SUCCESS_STATUS
+
+  def _cached_batch_decisions(self, unpacked_msgs, recipients, http_method):
+    """
+    :return: (decision keys, cached responses, indices of the messages the webhook must be notified of); keys and
+      responses are dicts by index of the message in the batch
+    """
+    keys = {index: self._decision_key(unpacked_msg, http_method, recipients[index])
+            for index, unpacked_msg in unpacked_msgs.items()}
+    responses = {}
+    for index, key in keys.items():
+      response = self._cached_decision(key)
+      if response is not None:
+        responses[index] = response
+    return keys, responses, [index for index in unpacked_msgs if index not in responses]
+
+  def _rate_limit_batch(self, unpacked_msgs, results):
+    """ Removes the messages of senders exceeding their rate limit from unpacked_msgs and sets their results """
+    for index in list(unpacked_msgs):
+      rate_limited_response = self._rate_limit(unpacked_msgs[index])
+      if rate_limited_response is not None:
+        results[index] = _batch_item(rate_limited_response)
+        del unpacked_msgs[index]
+
+  def dispatch_queued_request(self, queued_request, give_up=False):
+    """
+    Notifies the webhook of a queued request (asynchronous delivery mode) and packs the response it instructs.
+    The response's thread id is the id of the request message.
+
+    :param queued_request: QueuedRequest claimed from the message queue
+    :param give_up: If True, respond with an Internal Server Error if the webhook cannot be reached
+    :return: The packed response, or None if the webhook could not be reached and the request should be retried
+    """
+    message_unpacked_dict = queued_request.message
+    recipient = self._recipient_of(message_unpacked_dict)
+    key = self._decision_key(message_unpacked_dict, queued_request.http_method, recipient)
+    response = self._cached_decision(key)
+    if response is None:
+      webhook_response = webhook_new_request_received(
+        **_notification_of(message_unpacked_dict, queued_request.http_method, recipient))
+      if webhook_response is None and not give_up:
+        return None
+      response = _response_instructed_by(webhook_response, message_unpacked_dict['msg_id'])
+      self._cache_decision(key, webhook_response, response)
+    return self.did_comm.pack(
+      to=message_unpacked_dict['frm'], frm=recipient.did, thid=utils.reply_thread_id(message_unpacked_dict),
+      **response['message'])
+
+  def _enqueue(self, message_unpacked_dict, http_method):
+    self.message_queue.enqueue_request(message_unpacked_dict['frm'], http_method, message_unpacked_dict)
+    self.message_dispatcher.notify()
+    return {'msg_id': message_unpacked_dict['msg_id'], 'status': 'queued'}, constants.HTTP_ACCEPTED
+
+
+def _replay_key(message_unpacked_dict):
+  return message_unpacked_dict['frm'], message_unpacked_dict['msg_id']
+
+
+def _is_replayable(result):
+  # Only responses instructed by the webhook (or the acknowledgement of a queued request) are replayed.
+  # After webhook errors, a retry notifies the webhook again.
+  _, outcome = result
+  return outcome in (metrics.OUTCOME_SUCCESS, metrics.OUTCOME_DECISION_CACHED, metrics.OUTCOME_QUEUED)
+
+
+def _observed(response, outcome, started, didcomm_packed_msg):
+  response_data, http_code = response
+  response_didcomm_msg = response_data.get('didcomm_msg')
+  metrics.observe_request(
+    outcome, time.perf_counter() - started, request_size=len(didcomm_packed_msg),
+    response_size=len(response_didcomm_msg) if response_didcomm_msg is not None else None)
+  return response
+
+
+def _batch_item(response):
+  response_data, http_code = response
+  return dict(response_data, http_code=http_code)
+
+
+def _batch_unpack_error(error):
+  if isinstance(error, CryptoExecutorBusyError):
+    return _batch_item(_crypto_busy_response())
+  if not isinstance(error, MyDIDCommError):
+    logging.exception('Unexpected error when unpacking a message of a batch', exc_info=error)
+  return _batch_item(_invalid_message_response())
+
+
+def _batch_pack_error(error):
+  if isinstance(error, CryptoExecutorBusyError):
+    return _batch_item(_crypto_busy_response())
+  logging.error('Could not pack the response to a message of a batch: {}'.format(str(error)))
+  return _batch_item(utils.generate_err_resp('Internal Server Error', constants.HTTP_INTERNAL_ERROR))
+
+
+def _crypto_busy_response():
+  logging.warning("Crypto executor is saturated. Responding to client with HTTP 503")
+  return utils.generate_err_resp('Service Unavailable', constants.HTTP_SERVICE_UNAVAILABLE)
+
+
+def _rejected_message_response(reject_reason):
+  logging.warning(constants.INVALID_REQUEST_RECEIVED.format(
+    "DIDComm Message rejected before unpacking: {}".format(reject_reason)))
+  return utils.generate_err_resp('Invalid DIDComm Message', constants.HTTP_BAD_REQUEST)
+
+
+def _invalid_message_response():
+  logging.warning(constants.INVALID_REQUEST_RECEIVED.format(
+    "Could not decrypt/authenticate DIDComm Message"))
+  return utils.generate_err_resp('Invalid DIDComm Message', constants.HTTP_BAD_REQUEST)
+
+
+def _notification_of(message_unpacked_dict, http_method, recipient=None):
+  # Formatted only if enabled, as this runs for every request
+  if logging.getLogger().isEnabledFor(logging.DEBUG):
+    logging.debug(constants.DIDCOMM_MESSAGE_RECEIVED.format(
+      msg_id=message_unpacked_dict['msg_id'], msg_type=message_unpacked_dict['msg_type']))
+  return {
+    'recipient': recipient,
+    'sender': message_unpacked_dict['frm'],
+    'http_request_method': http_method,
+    'msg_body': message_unpacked_dict['msg_body'],
+    'msg_type': message_unpacked_dict['msg_type'],
+    'msg_id': message_unpacked_dict['msg_id'],
+    'attachments': message_unpacked_dict['attachments']
+  }
+
+
+def _response_instructed_by(webhook_response, request_msg_id):
+  """
+  Determines the DIDComm response to the client from the webhook's response.
+  Invalid and error responses of the webhook are answered with an encrypted Internal Server Error.
+
+  :param webhook_response: The webhook response
+  :param request_msg_id: The id of the message the webhook responded to
+  :return: {'http_code': <response_http_code>, 'message': <pack() arguments of the response message>,
+    'outcome': <metrics outcome of the request>}
+  """
+  if not is_webhook_response_valid(webhook_response):
+    logging.error("Received an invalid response from Webhook. Responding to client with HTTP 500")
+    return _error_response('Internal Server Error', constants.HTTP_INTERNAL_ERROR, metrics.OUTCOME_WEBHOOK_INVALID)
+
+  if 'error' in webhook_response:
+    logging.error("Received an Error response from Webhook. Responding to client with HTTP 500")
+    return _error_response('Internal Server Error', constants.HTTP_INTERNAL_ERROR, metrics.OUTCOME_WEBHOOK_ERROR)
+
+  response_didcomm_parsed = parse_didcomm_webhook_response(webhook_response)
+  if logging.getLogger().isEnabledFor(logging.DEBUG):
+    logging.debug(constants.SENDING_RESPONSE.format(
+      req_msg_id=request_msg_id,
+      resp_msg_type=response_didcomm_parsed['type'],
+      resp_http_code=response_didcomm_parsed['http_code']))
+  return {
+    'http_code': response_didcomm_parsed['http_code'],
+    'message': {
+      'msg_body': response_didcomm_parsed['body'],
+      'msg_type': response_didcomm_parsed['type'],
+      'msg_id': response_didcomm_parsed['id']
+    },
+    'outcome': metrics.OUTCOME_SUCCESS
+  }
+
+
+def _error_response(error_msg, http_code, outcome):
+  return {
+    'http_code': http_code,
+    'message': {
+      'msg_body': {'error': error_msg},
+      'msg_type': constants.DIDCOMM_ERROR_MSG_TYPE,
+      'msg_id': None
+    },
+    'outcome': outcome
+  }
 
 
 def is_webhook_response_valid(webhook_response):
@@ -87,7 +546,8 @@ def is_webhook_response_valid(webhook_response):
         'type': <Response DIDComm Message Type>,
         'body': <Response DIDComm Message Body>
       }
-    }
+    },
+    'cache_ttl': <Optional: seconds the response may be reused for equal requests, see DecisionCache>
   }
   or
   {
@@ -152,7 +612,8 @@ def parse_didcomm_webhook_response(webhook_response):
   }
 
 
-def webhook_new_request_received(sender, http_request_method, msg_body, msg_type, msg_id, attachments):
+def webhook_new_request_received(sender, http_request_method, msg_body, msg_type, msg_id, attachments,
+                                 recipient=None, deadline=None):
   """
   Sends a POST Request to the configured webhook for received requests.
   The body of the request is:
@@ -168,6 +629,7 @@ def webhook_new_request_received(sender, http_request_method, msg_body, msg_type
         'attachments': <List of DIDComm attachments>
       }
     },
+    'recipient': {'did': <server DID of the tenant>, 'tenant': <tenant>}  (only for messages to a tenant)
   }
 
   :param sender: sender_peer_did
@@ -176,16 +638,94 @@ def webhook_new_request_received(sender, http_request_method, msg_body, msg_type
   :param msg_type: Message Type
   :param msg_id: Message ID
   :param attachments: List of DIDComm attachments
+  :param recipient: The Identity the message was sent to; the webhook of its tenant is notified if it has one
+  :param deadline: Time (time.monotonic()) by which the webhook must have responded (None: the configured timeouts)
+  :return: Webhook's response json data, or None if the webhook could not be notified
+  """
+
+  webhook_url = _webhook_url_of(recipient)
+  received_request_data = _request_received_data(
+    sender, http_request_method, msg_body, msg_type, msg_id, attachments, recipient)
+  return __post_to_webhook(webhook_url, received_request_data, deadline)
+
+
+async def webhook_new_request_received_async(sender, http_request_method, msg_body, msg_type, msg_id, attachments,
+                                             recipient=None, deadline=None):
+  """
+  Same as webhook_new_request_received, but sends the notification without blocking the running event loop.
+
   :return: Webhook's response json data
   """
+  webhook_url = _webhook_url_of(recipient)
+  received_request_data = _request_received_data(
+    sender, http_request_method, msg_body, msg_type, msg_id, attachments, recipient)
+  return await __post_to_webhook_async(webhook_url, received_request_data, deadline)
+
+
+def webhook_new_requests_received(notifications, deadline=None):
+  """
+  Notifies the webhook of several received requests.
 
+  If a batch webhook (webhooks.request_received_batch) is configured, all notifications are sent in one POST Request
+  with the body {'requests': [<notification>, ...]} and the webhook responds with {'responses': [<response>, ...]}
+  in the same order. Otherwise, or if a notification is for a tenant with its own webhook, the notifications are
+  sent one after another over the pooled connections.
+
+  :param notifications: List of keyword arguments of webhook_new_request_received
+  :param deadline: Time (time.monotonic()) by which the webhook must have responded (None: the configured timeouts)
+  :return: List of the webhook's responses (None for every failed notification)
+  """
+  if not notifications:
+    return []
   webhooks_configuration = utils.load_component_configuration("webhooks")
-  if not webhooks_configuration or 'request_received' not in webhooks_configuration:
-    logging.error("Invalid Configuration: Missing webhooks configuration")
-    sys.exit(1)
-  webhook_url = webhooks_configuration['request_received']
+  if not webhooks_configuration['request_received_batch'] or _any_tenant_webhook(notifications):
+    return [webhook_new_request_received(**notification, deadline=deadline) for notification in notifications]
+
+  batch_data = {'requests': [_request_received_data(**notification) for notification in notifications]}
+  return _batch_webhook_responses(
+    __post_to_webhook(webhooks_configuration['request_received_batch'], batch_data, deadline), len(notifications))
+
+
+async def webhook_new_requests_received_async(notifications, deadline=None):
+  """ Same as webhook_new_requests_received, but sends individual notifications concurrently. """
+  if not notifications:
+    return []
+  webhooks_configuration = utils.load_component_configuration("webhooks")
+  if not webhooks_configuration['request_received_batch'] or _any_tenant_webhook(notifications):
+    return await asyncio.gather(
+      *[webhook_new_request_received_async(**notification, deadline=deadline) for notification in notifications])
+
+  batch_data = {'requests': [_request_received_data(**notification) for notification in notifications]}
+  return _batch_webhook_responses(
+    await __post_to_webhook_async(webhooks_configuration['request_received_batch'], batch_data, deadline),
+    len(notifications))
+
+
+def _batch_webhook_responses(batch_response, expected_count):
+  if (
+    not isinstance(batch_response, dict) or
+    not isinstance(batch_response.get('responses'), list) or
+    len(batch_response['responses']) != expected_count
+  ):
+    logging.error('Unexpected response from Received_message batch webhook!')
+    return [None] * expected_count
+  return batch_response['responses']
+
+
+def _webhook_url_of(recipient):
+  if recipient is not None and recipient.webhook_url:
+    return recipient.webhook_url
+  # The configuration snapshot is validated at boot, so the webhook is always configured
+  return utils.load_component_configuration("webhooks")['request_received']
+
 
-  received_request_data = {
+def _any_tenant_webhook(notifications):
+  return any(notification.get('recipient') is not None and notification['recipient'].webhook_url
+             for notification in notifications)
+
+
+def _request_received_data(sender, http_request_method, msg_body, msg_type, msg_id, attachments, recipient=None):
+  request_received_data = {
     'sender': sender,
     'request': {
       'type': constants.REQUEST_DIDCOMM,
@@ -198,14 +738,155 @@ def webhook_new_request_received(sender, http_request_method, msg_body, msg_type
       }
     }
   }
+  if recipient is not None and recipient.tenant is not None:
+    request_received_data['recipient'] = {'did': recipient.did, 'tenant': recipient.tenant}
+  return request_received_data
+
+
+def __post_to_webhook(url, request_data, deadline=None):
+  hedge_url = _hedge_url_of(url)
+  if hedge_url is None:
+    return _post_to_webhook_once(url, request_data, deadline)
+  return _post_to_webhooks_hedged(url, hedge_url, request_data, deadline)
+
 
-  return __post_to_webhook(webhook_url, received_request_data)
+async def __post_to_webhook_async(url, request_data, deadline=None):
+  hedge_url = _hedge_url_of(url)
+  if hedge_url is None:
+    return await _post_to_webhook_once_async(url, request_data, deadline)
+  return await _post_to_webhooks_hedged_async(url, hedge_url, request_data, deadline)
 
 
-def __post_to_webhook(url, request_data):
+def _post_to_webhook_once(url, request_data, deadline):
+  breaker = webhook_client.get_circuit_breaker(url)
+  if not _webhook_call_allowed(url, breaker, deadline):
+    return None
+  read_timeout = _webhook_read_timeout(deadline, webhook_client.get_webhook_client().read_timeout)
+  started = time.perf_counter()
+  success, conclusive = False, False
   try:
-    response = requests.post(url, json=request_data)
+    response = webhook_client.get_webhook_client().post(url, request_data, read_timeout)
+    response_data = _webhook_response_data(url, response.status_code, response)
+    success, conclusive = response.status_code < 500 and response_data is not None, True
+    return response_data
   except requests.exceptions.RequestException as requests_error:
     logging.error(f'Got RequestException when posting to webhook: {str(requests_error)}')
+    # A read timeout cut short by the client's deadline says nothing about the webhook
+    conclusive = read_timeout is None or not isinstance(requests_error, requests.exceptions.ReadTimeout)
+    return None
+  finally:
+    _record_webhook_call(breaker, success, conclusive, started)
+
+
+async def _post_to_webhook_once_async(url, request_data, deadline):
+  breaker = webhook_client.get_circuit_breaker(url)
+  if not _webhook_call_allowed(url, breaker, deadline):
+    return None
+  read_timeout = _webhook_read_timeout(deadline, webhook_client.get_async_webhook_client().read_timeout)
+  started = time.perf_counter()
+  success, conclusive = False, False
+  try:
+    response = await webhook_client.get_async_webhook_client().post(url, request_data, read_timeout)
+    response_data = _webhook_response_data(url, response.status_code, response)
+    success, conclusive = response.status_code < 500 and response_data is not None, True
+    return response_data
+  except httpx.HTTPError as http_error:
+    logging.error(f'Got HTTPError when posting to webhook: {str(http_error)}')
+    conclusive = read_timeout is None or not isinstance(http_error, httpx.ReadTimeout)
+    return None
+  finally:
+    _record_webhook_call(breaker, success, conclusive, started)
+
+
+def _post_to_webhooks_hedged(url, hedge_url, request_data, deadline):
+  """
+  Notifies the webhook and, unless it responded within webhooks.hedge_delay seconds, also the secondary webhook.
+  Returns the first successful response (or None if both failed), so both webhooks must handle a notification
+  idempotently.
+  """
+  executor = webhook_client.get_hedge_executor()
+  primary = executor.submit(_post_to_webhook_once, url, request_data, deadline)
+  done, _ = concurrent.futures.wait([primary], timeout=utils.load_component_configuration('webhooks')['hedge_delay'])
+  if done and primary.result() is not None:
+    return primary.result()
+
+  metrics.observe_webhook_hedge()
+  hedge = executor.submit(_post_to_webhook_once, hedge_url, request_data, deadline)
+  try:
+    for future in concurrent.futures.as_completed([primary, hedge], timeout=_remaining_time(deadline)):
+      if future.result() is not None:
+        return future.result()
+  except concurrent.futures.TimeoutError:
+    logging.error('Deadline of the request exceeded while waiting for the webhooks')
+  return None
+
+
+async def _post_to_webhooks_hedged_async(url, hedge_url, request_data, deadline):
+  """ Same as _post_to_webhooks_hedged, but the slower webhook call is cancelled once one succeeded. """
+  primary = asyncio.ensure_future(_post_to_webhook_once_async(url, request_data, deadline))
+  done, _ = await asyncio.wait([primary], timeout=utils.load_component_configuration('webhooks')['hedge_delay'])
+  if done and primary.result() is not None:
+    return primary.result()
+
+  metrics.observe_webhook_hedge()
+  pending = {primary, asyncio.ensure_future(_post_to_webhook_once_async(hedge_url, request_data, deadline))}
+  while pending:
+    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+      if task.result() is not None:
+        for pending_task in pending:
+          pending_task.cancel()
+        return task.result()
+  return None
+
+
+def _hedge_url_of(url):
+  webhooks_configuration = utils.load_component_configuration('webhooks')
+  # Only notifications to the configured webhook are hedged, not those to tenant or batch webhooks
+  if url != webhooks_configuration['request_received']:
     return None
-  return response.json()
+  return webhooks_configuration['request_received_hedge']
+
+
+def _remaining_time(deadline):
+  return None if deadline is None else deadline - time.monotonic()
+
+
+def _webhook_call_allowed(url, breaker, deadline):
+  """ Fails the webhook call fast if the deadline is exceeded or the circuit breaker of the webhook is open """
+  remaining = _remaining_time(deadline)
+  if remaining is not None and remaining <= 0:
+    logging.error('Deadline of the request exceeded before notifying the webhook {}'.format(url))
+    metrics.observe_webhook_fast_failure(metrics.WEBHOOK_DEADLINE_EXCEEDED)
+    return False
+  if breaker is not None and not breaker.allow():
+    logging.error('Circuit breaker of webhook {} is open. Not notifying the webhook'.format(url))
+    metrics.observe_webhook_fast_failure(metrics.WEBHOOK_BREAKER_OPEN)
+    return False
+  return True
+
+
+def _webhook_read_timeout(deadline, configured_read_timeout):
+  """ :return: The remaining time if the deadline is nearer than the configured read timeout, otherwise None """
+  remaining = _remaining_time(deadline)
+  if remaining is None or remaining >= configured_read_timeout:
+    return None
+  # The deadline may have been reached since the call was allowed
+  return max(remaining, constants.MIN_WEBHOOK_READ_TIMEOUT)
+
+
+def _webhook_response_data(url, status_code, response):
+  try:
+    return response.json()
+  except ValueError:
+    logging.error('Webhook {} responded with HTTP {} and an invalid JSON body'.format(url, status_code))
+    return None
+
+
+def _record_webhook_call(breaker, success, conclusive, started):
+  if breaker is None:
+    return
+  if conclusive:
+    breaker.record(success, time.perf_counter() - started)
+  else:
+    breaker.cancel()
@@ -1,17 +1,34 @@
 # -*- coding: utf-8 -*-
 
+import functools
 import os
 import logging
 import logging.config
 
 from flask import Flask
 
-from did_communication_api import utils, constants
+from did_communication_api import configuration, utils, constants
+from did_communication_api.admission import AdmissionController, SenderRateLimiter
+from did_communication_api.attachment_store import AttachmentStore, AttachmentOffloader
+from did_communication_api.decision_cache import DecisionCache
+from did_communication_api.did_comm.crypto_executor import CryptoExecutor
+from did_communication_api.did_comm.jwe_precheck import JWEPreCheck
+from did_communication_api.did_comm.secret_resolver import SecretsResolverLocal
+from did_communication_api.did_comm.secret_resolver_sqlite import SecretsResolverSQLite
+from did_communication_api.message_dispatcher import MessageDispatcher
+from did_communication_api.message_pickup import MessagePickupHandler
+from did_communication_api.message_queue import MessageQueue
+from did_communication_api.outbox import Outbox, OutboxHandler
+from did_communication_api.replay_cache import ReplayCache, MemoryReplayStore, SQLiteReplayStore
+from did_communication_api.server_identity import ServerIdentity
+from did_communication_api.tenants import TenantRegistry, TenantsHandler
+from did_communication_api.websocket_inbox import WebSocketInbox
 
 
 def initialize_flask_app(name):
-  # Do not use server configuration from this service config!
+  # Loads and validates the configuration once - an invalid configuration fails here, at boot
   service_config = utils.load_service_config()
+  configuration.install_reload_signal_handler()
 
   flask_app = Flask(name)
   configure_logging(service_config)
@@ -29,13 +46,262 @@ def configure_logging(service_config):
   logging.config.dictConfig(logging_config)
 
 
-def create_server_did(did_comm):
-  # The Service Endpoint used for the Peer DID of this DID_Communication_API
+def secret_resolver_factory():
+  """ Returns a function creating a secrets resolver on the configured secrets store. """
+  secrets_config = utils.load_component_configuration('secrets')
+  if secrets_config['backend'] == 'sqlite':
+    return functools.partial(SecretsResolverSQLite, secrets_config['database_path'])
+  return functools.partial(SecretsResolverLocal, secrets_config['file_path'])
+
+
+def create_secret_resolver():
+  """
+  Creates the secrets resolver of the configured secrets store.
+  An empty SQLite secrets store is initialized with the keys of the secrets file (migration from the json backend).
+  """
+  secret_resolver = secret_resolver_factory()()
+  secrets_config = utils.load_component_configuration('secrets')
+  if isinstance(secret_resolver, SecretsResolverSQLite) and os.path.exists(secrets_config['file_path']) and \
+     secret_resolver.count_keys() == 0:
+    migrated_keys = secret_resolver.import_json(secrets_config['file_path'])
+    logging.info('Migrated {} keys of {} into the secrets database'.format(migrated_keys, secrets_config['file_path']))
+  return secret_resolver
+
+
+def server_service_endpoint():
+  # The Service Endpoint used for the Peer DIDs of this DID_Communication_API
   server_config = utils.load_component_configuration('server')
-  my_service_endpoint = 'http://{}:{}{}'.format(
-    server_config['host'], server_config['port'], constants.API_EXTERNAL_INBOX)
+  return 'http://{}:{}{}'.format(server_config['host'], server_config['port'], constants.API_EXTERNAL_INBOX)
+
+
+def create_server_did(did_comm):
+  my_service_endpoint = server_service_endpoint()
+
+  identity_config = utils.load_component_configuration('server_identity')
+  if identity_config['persistent']:
+    # Created once, reused on later boots and by all worker processes
+    return ServerIdentity(identity_config['file_path']).load_or_create(did_comm, my_service_endpoint)
 
   # Create new Peer DID
   my_new_did = did_comm.create_peer_did(my_service_endpoint)
 
   return my_new_did
+
+
+def create_crypto_backend(did_comm, server_did):
+  """
+  Returns the object performing pack/unpack for the API Handler:
+  the given DIDComm, or a CryptoExecutor offloading the operations to worker processes if enabled.
+  """
+  executor_config = utils.load_component_configuration('crypto_executor')
+  if not executor_config['enabled']:
+    return did_comm
+
+  executor = CryptoExecutor(
+    secret_resolver_factory=secret_resolver_factory(),
+    did_cache_size=utils.load_component_configuration('did_resolver')['cache_size'],
+    pool_size=executor_config['pool_size'],
+    queue_depth=executor_config['queue_depth'],
+    warm_dids=[server_did],
+  )
+  logging.info('Offloading DIDComm operations to {} crypto worker processes'.format(executor.pool_size))
+  return executor
+
+
+def configure_async_delivery(api_handler):
+  """
+  Enables the asynchronous delivery mode of the API Handler, if configured.
+
+  :return: The MessagePickupHandler serving the stored responses, or None if the mode is disabled
+  """
+  delivery_config = utils.load_component_configuration('async_delivery')
+  if not delivery_config['enabled']:
+    return None
+
+  message_queue = MessageQueue(
+    delivery_config['queue_path'], lease_seconds=delivery_config['lease_seconds'],
+    response_ttl=delivery_config['response_ttl'],
+    max_responses_per_recipient=delivery_config['max_responses_per_recipient'])
+  message_dispatcher = MessageDispatcher(
+    api_handler, message_queue,
+    poll_interval=delivery_config['poll_interval'],
+    batch_size=delivery_config['batch_size'],
+    max_attempts=delivery_config['max_attempts'],
+  )
+  api_handler.enable_async_delivery(message_queue, message_dispatcher)
+  logging.info('Asynchronous delivery mode enabled. Message queue: {}'.format(delivery_config['queue_path']))
+  return MessagePickupHandler(api_handler.did_comm, api_handler.server_did, message_queue)
+
+
+def start_worker_threads(api_handler):
+  """ Starts the background threads of the current worker process (after fork, never in the gunicorn master). """
+  if api_handler.message_dispatcher is not None:
+    api_handler.message_dispatcher.ensure_started()
+
+
+def configure_replay_cache(api_handler):
+  """
+  Enables the replay cache of the API Handler, if configured.
+
+  :return: The store of the replay cache, or None if the cache is disabled
+  """
+  cache_config = utils.load_component_configuration('replay_cache')
+  if not cache_config['enabled']:
+    return None
+
+  if cache_config['shared_path']:
+    store = SQLiteReplayStore(cache_config['shared_path'], cache_config['max_entries'])
+  else:
+    store = MemoryReplayStore(cache_config['max_entries'])
+  api_handler.enable_replay_cache(
+    ReplayCache(store, cache_config['ttl_seconds'], wait_timeout=cache_config['wait_timeout']))
+  logging.info('Replay cache enabled. Responses are stored for {} seconds'.format(cache_config['ttl_seconds']))
+  return store
+
+
+def configure_decision_cache(api_handler):
+  """
+  Enables the cache of webhook decisions of the API Handler, if configured.
+
+  :return: The DecisionCache, or None if the cache is disabled
+  """
+  cache_config = utils.load_component_configuration('decision_cache')
+  if not cache_config['enabled']:
+    return None
+
+  decision_cache = DecisionCache(
+    cache_config['max_entries'], cache_config['max_ttl'], invalidations_path=cache_config['invalidations_path'],
+    invalidation_check_interval=cache_config['invalidation_check_interval'])
+  api_handler.enable_decision_cache(decision_cache)
+  logging.info('Decision cache enabled. Webhook responses are reused for at most {} seconds'.format(
+    cache_config['max_ttl']))
+  return decision_cache
+
+
+def configure_attachment_offload(api_handler):
+  """
+  Enables the offloading of large attachments by the API Handler, if configured.
+
+  :return: The AttachmentStore serving the offloaded attachments, or None if offloading is disabled
+  """
+  offload_config = utils.load_component_configuration('attachment_offload')
+  if not offload_config['enabled']:
+    return None
+
+  base_url = offload_config['base_url']
+  if not base_url:
+    server_config = utils.load_component_configuration('server')
+    base_url = 'http://{}:{}'.format(server_config['host'], server_config['port'])
+  attachment_store = AttachmentStore(offload_config['directory'], offload_config['ttl_seconds'])
+  api_handler.enable_attachment_offload(AttachmentOffloader(
+    attachment_store, offload_config['min_size'], base_url.rstrip('/') + constants.API_INTERNAL_ATTACHMENTS))
+  logging.info('Offloading attachments of at least {} bytes to {}'.format(
+    offload_config['min_size'], offload_config['directory']))
+  return attachment_store
+
+
+def configure_jwe_precheck(api_handler, secret_resolver):
+  """ Enables the validation of messages before unpacking by the API Handler, if configured. """
+  precheck_config = utils.load_component_configuration('jwe_precheck')
+  if not precheck_config['enabled']:
+    return
+  tenant_registry = api_handler.tenant_registry
+  api_handler.enable_jwe_precheck(JWEPreCheck(
+    secret_resolver.list_kids,
+    max_recipients=precheck_config['max_recipients'],
+    max_ciphertext_size=precheck_config['max_ciphertext_size'],
+    kid_refresh_interval=precheck_config['kid_refresh_interval'],
+    # Server DIDs of tenants are accepted as soon as they are created
+    owns_kid=(lambda kid: tenant_registry.lookup_kid(kid) is not None) if tenant_registry is not None else None,
+  ))
+
+
+def configure_outbox(api_handler, did_comm):
+  """
+  Enables sending messages to Peer DIDs on behalf of other services, if configured.
+
+  :return: The OutboxHandler serving the send requests, or None if sending is disabled
+  """
+  outbox_config = utils.load_component_configuration('outbox')
+  if not outbox_config['enabled']:
+    return None
+
+  outbox = Outbox(
+    concurrency=outbox_config['concurrency'],
+    queue_size=outbox_config['queue_size'],
+    connections_per_endpoint=outbox_config['connections_per_endpoint'],
+    max_endpoint_pools=outbox_config['max_endpoint_pools'],
+    max_coalesced=outbox_config['max_coalesced'],
+    max_attempts=outbox_config['max_attempts'],
+    backoff_base=outbox_config['backoff_base'],
+    backoff_max=outbox_config['backoff_max'],
+    connect_timeout=outbox_config['connect_timeout'],
+    read_timeout=outbox_config['read_timeout'],
+  )
+  logging.info('Outbox enabled with {} sender threads per worker process'.format(outbox_config['concurrency']))
+  return OutboxHandler(
+    did_comm, api_handler.did_comm, api_handler.server_did, outbox, wait_timeout=outbox_config['wait_timeout'],
+    max_recipients=outbox_config['max_recipients'])
+
+
+def configure_tenants(api_handler, did_comm):
+  """
+  Enables the server DIDs of tenants, if configured.
+
+  :return: The TenantsHandler serving the tenant management requests, or None if tenants are disabled
+  """
+  tenants_config = utils.load_component_configuration('tenants')
+  if not tenants_config['enabled']:
+    return None
+
+  tenant_registry = TenantRegistry(
+    tenants_config['database_path'], tenants_config['refresh_interval'], tenants_config['miss_refresh_interval'])
+  api_handler.enable_tenants(tenant_registry)
+  logging.info('Tenants enabled. {} server DIDs of tenants loaded from {}'.format(
+    tenant_registry.count_identities(), tenants_config['database_path']))
+  return TenantsHandler(tenant_registry, did_comm, server_service_endpoint())
+
+
+def configure_admission(api_handler):
+  """
+  Enables the admission control of the inbox and the rate limit per sender of the API Handler, if configured.
+
+  :return: The AdmissionController of the inbox, or None if admission control is disabled
+  """
+  admission_config = utils.load_component_configuration('admission')
+  if not admission_config['enabled']:
+    return None
+
+  if admission_config['sender_rate'] is not None:
+    api_handler.enable_sender_rate_limit(SenderRateLimiter(
+      admission_config['sender_rate'], admission_config['sender_burst'], admission_config['max_senders']))
+  logging.info('Admission control enabled. At most {} inbox requests in flight per worker process'.format(
+    admission_config['max_in_flight']))
+  return AdmissionController(
+    admission_config['max_in_flight'],
+    admission_config['max_queued'],
+    admission_config['queue_timeout'],
+    retry_after=admission_config['retry_after'],
+  )
+
+
+def configure_websocket_inbox(api_handler, admission_controller=None):
+  """
+  Creates the WebSocket inbox of the asynchronous serving mode, if enabled.
+
+  :param admission_controller: AdmissionController of the inbox, admitting every message received over WebSocket
+  :return: The WebSocketInbox, or None if the WebSocket inbox is disabled
+  """
+  websocket_config = utils.load_component_configuration('websocket_inbox')
+  if not websocket_config['enabled']:
+    return None
+
+  logging.info('WebSocket inbox enabled on {}'.format(constants.API_EXTERNAL_INBOX_WEBSOCKET))
+  return WebSocketInbox(
+    api_handler,
+    max_in_flight=websocket_config['max_in_flight'],
+    idle_timeout=websocket_config['idle_timeout'],
+    max_connections=websocket_config['max_connections'],
+    max_message_size=utils.load_component_configuration('inbox')['max_body_size'],
+    admission_controller=admission_controller,
+  )
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+"""
+ASGI entry point (asynchronous serving mode).
+
+The DIDComm inbox is served natively on the event loop: unpacking, the webhook call and packing of the response are
+awaited end to end, so a single worker process handles many in-flight requests while the webhook is slow.
+The WebSocket inbox (if enabled) is served on the event loop as well.
+All other endpoints are served by the Flask application of the WSGI entry point.
+
+Run with: gunicorn -c python:did_communication_api.gunicorn_config --preload -k uvicorn.workers.UvicornWorker
+  did_communication_api.asgi:app
+"""
+
+# Imported first, so the startup report includes the imports of the service and its dependencies
+from did_communication_api import startup
+
+import asyncio
+import functools
+import json
+import logging
+
+# Imported lazily by the WSGI entry point, but used by the asynchronous webhook client of every worker process
+import httpx  # noqa: F401
+from asgiref.wsgi import WsgiToAsgi
+
+from did_communication_api import app_configurer, compression, constants, metrics, utils, webhook_client
+from did_communication_api.__main__ import flask_app, api_handler, admission_controller, did_comm, server_did
+from did_communication_api.prewarm import prewarm_worker
+
+INBOX_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+
+class DIDCommASGIApplication:
+
+  def __init__(self, api_handler, wsgi_app, admission_controller=None, websocket_inbox=None):
+    self.api_handler = api_handler
+    self.fallback_app = WsgiToAsgi(wsgi_app)
+    self.admission_controller = admission_controller
+    self.websocket_inbox = websocket_inbox
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] == 'lifespan':
+      await self._lifespan(receive, send)
+    elif (
+      scope['type'] == 'http' and
+      scope['path'] == constants.API_EXTERNAL_INBOX and
+      scope['method'] in INBOX_METHODS
+    ):
+      await self._admission_controlled(self._receive_message, scope, receive, _compressing_send(scope, send))
+    elif (
+      scope['type'] == 'http' and
+      scope['path'] == constants.API_EXTERNAL_INBOX_BATCH and
+      scope['method'] in INBOX_METHODS
+    ):
+      await self._admission_controlled(
+        self._receive_message_batch, scope, receive, _compressing_send(scope, send))
+    elif scope['type'] == 'websocket':
+      if self.websocket_inbox is not None and scope['path'] == constants.API_EXTERNAL_INBOX_WEBSOCKET:
+        await self.websocket_inbox.handle(scope, receive, send)
+      else:
+        # The Flask application serves no WebSocket endpoints; closing before accepting rejects with HTTP 403
+        await receive()
+        await send({'type': 'websocket.close'})
+    else:
+      await self.fallback_app(scope, receive, send)
+
+  async def _admission_controlled(self, handler, scope, receive, send):
+    # Sheds requests with HTTP 503 (Retry-After) while the admission controller of this worker is saturated
+    if self.admission_controller is None:
+      await handler(scope, receive, send)
+      return
+    if not await self.admission_controller.acquire_async():
+      await _send_json(send, *utils.overloaded_resp(self.admission_controller.retry_after))
+      return
+    try:
+      await handler(scope, receive, send)
+    finally:
+      await self.admission_controller.release_async()
+
+  async def _receive_message(self, scope, receive, send):
+    # Used by other systems to send HTTP Requests with encrypted (DIDComm) Payload
+    deadline = _request_deadline(scope)
+    with metrics.stage(metrics.STAGE_FORM_PARSING):
+      packed_msg, error_response = await _get_packed_msg(scope, receive)
+    if error_response:
+      await _send_json(send, *error_response)
+      return
+
+    response_data, http_code = await self.api_handler.handle_message_received_async(
+      packed_msg, scope['method'], deadline)
+    if 'didcomm_msg' in response_data and utils.accepts_raw_didcomm(_get_header(scope, b'accept')):
+      # Clients accepting application/didcomm-encrypted+json get the packed response message as raw body
+      await _send(send, response_data['didcomm_msg'].encode('utf-8'), constants.DIDCOMM_ENCRYPTED_MEDIA_TYPE, http_code)
+    else:
+      await _send_json(send, response_data, http_code)
+
+  async def _receive_message_batch(self, scope, receive, send):
+    # Used by other systems to send several encrypted (DIDComm) messages in a single HTTP Request
+    deadline = _request_deadline(scope)
+    body, error_response = await _read_request_body(scope, receive)
+    if error_response:
+      await _send_json(send, *error_response)
+      return
+    try:
+      request_data = json.loads(body)
+    except ValueError:
+      request_data = None
+    packed_msgs, error_response = utils.get_batch_messages(request_data)
+    if error_response:
+      await _send_json(send, *error_response)
+      return
+    response_data, http_code = await self.api_handler.handle_batch_received_async(
+      packed_msgs, scope['method'], deadline)
+    await _send_json(send, response_data, http_code)
+
+  @staticmethod
+  async def _lifespan(receive, send):
+    while True:
+      message = await receive()
+      if message['type'] == 'lifespan.startup':
+        app_configurer.start_worker_threads(api_handler)
+        if not startup.is_ready():
+          # Not pre-warmed by the gunicorn hook (e.g. when run by uvicorn directly)
+          await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+            prewarm_worker, did_comm, api_handler.did_comm, server_did, asynchronous=True))
+        await send({'type': 'lifespan.startup.complete'})
+      elif message['type'] == 'lifespan.shutdown':
+        await webhook_client.close_async_webhook_client()
+        await send({'type': 'lifespan.shutdown.complete'})
+        return
+
+
+async def _get_packed_msg(scope, receive):
+  """
+  Reads the packed DIDComm message of the request: either the raw body (media type
+  application/didcomm-encrypted+json) or the didcomm_msg field of a form.
+
+  :return: (packed message, None) or (None, error response)
+  """
+  body, error_response = await _read_request_body(scope, receive)
+  if error_response:
+    return None, error_response
+
+  content_type = _get_header(scope, b'content-type')
+  if utils.is_raw_didcomm_body(content_type):
+    packed_msg = body.decode('utf-8', errors='replace')
+  else:
+    packed_msg = utils.get_form_field(content_type, body, 'didcomm_msg')
+  if not packed_msg:
+    logging.warning("Received HTTP Request with invalid body structure. Missing didcomm_msg attribute")
+    return None, utils.generate_err_resp('Missing didcomm_msg', constants.HTTP_BAD_REQUEST)
+  return packed_msg, None
+
+
+async def _read_request_body(scope, receive):
+  """
+  Reads the (decompressed) body of an inbox request, at most inbox.max_body_size bytes.
+
+  :return: (body, None) or (None, error response)
+  """
+  max_body_size = utils.load_component_configuration('inbox')['max_body_size']
+  content_length = _get_header(scope, b'content-length')
+  if content_length and content_length.isdigit() and int(content_length) > max_body_size:
+    return None, utils.payload_too_large_resp()
+  body = await _read_body(receive, max_body_size)
+  if body is None:
+    return None, utils.payload_too_large_resp()
+  return compression.decode_request_body(body, _get_header(scope, b'content-encoding'))
+
+
+async def _read_body(receive, max_body_size):
+  """ :return: The request body, or None as soon as it exceeds max_body_size bytes """
+  chunks = []
+  body_size = 0
+  more_body = True
+  while more_body:
+    message = await receive()
+    if message['type'] == 'http.disconnect':
+      break
+    chunk = message.get('body', b'')
+    body_size += len(chunk)
+    if body_size > max_body_size:
+      return None
+    chunks.append(chunk)
+    more_body = message.get('more_body', False)
+  return b''.join(chunks)
+
+
+def _get_header(scope, name):
+  for header_name, header_value in scope['headers']:
+    if header_name == name:
+      return header_value.decode('latin-1')
+  return None
+
+
+def _request_deadline(scope):
+  return utils.request_deadline(lambda header_name: _get_header(scope, header_name.lower().encode('latin-1')))
+
+
+def _compressing_send(scope, send):
+  """
+  Wraps send to compress the response body if the client accepts a configured encoding (Accept-Encoding).
+  Responses of the inbox are sent by _send, with the whole body in a single message.
+  """
+  accept_encoding = _get_header(scope, b'accept-encoding')
+  response_start = None
+
+  async def compressing_send(message):
+    nonlocal response_start
+    if message['type'] == 'http.response.start':
+      response_start = message
+      return
+    if message['type'] != 'http.response.body' or response_start is None:
+      await send(message)
+      return
+    body, encoding = compression.encode_response_body(message.get('body', b''), accept_encoding)
+    headers = [(name, value) for name, value in response_start['headers'] if name != b'content-length']
+    headers.append((b'content-length', str(len(body)).encode('latin-1')))
+    if encoding is not None:
+      headers += [(b'content-encoding', encoding.encode('latin-1')), (b'vary', b'Accept-Encoding')]
+    await send(dict(response_start, headers=headers))
+    response_start = None
+    await send(dict(message, body=body))
+
+  return compressing_send
+
+
+async def _send_json(send, data, http_code):
+  await _send(send, json.dumps(data).encode('utf-8'), 'application/json', http_code, utils.retry_after_headers(data))
+
+
+async def _send(send, body, content_type, http_code, headers=None):
+  await send({
+    'type': 'http.response.start',
+    'status': int(http_code),
+    'headers': [
+      (b'content-type', content_type.encode('latin-1')),
+      (b'content-length', str(len(body)).encode('latin-1')),
+    ] + [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in (headers or {}).items()],
+  })
+  await send({'type': 'http.response.body', 'body': body})
+
+
+websocket_inbox = app_configurer.configure_websocket_inbox(api_handler, admission_controller)
+app = DIDCommASGIApplication(api_handler, flask_app, admission_controller, websocket_inbox)
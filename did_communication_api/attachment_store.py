@@ -0,0 +1,146 @@
+"""
+Content-addressed store of large attachments of received messages.
+
+Instead of embedding large attachments inline in the notification of the webhook, their data is written once to
+the store and the webhook gets a reference (hash, size, media type and URL) it can fetch the data from.
+"""
+
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+VALID_DIGEST_REGEX = re.compile('^[0-9a-f]{64}$')
+
+
+class AttachmentStore:
+  """
+  Stores attachment data in files named by the SHA-256 of the data, so identical attachments are stored once.
+
+  Files expire ttl_seconds after they were last stored; expired files are deleted by cleanup(), which runs at most
+  once per cleanup_interval when attachments are stored.
+  """
+
+  def __init__(self, directory, ttl_seconds, cleanup_interval=60):
+    self.directory = directory
+    self.ttl_seconds = ttl_seconds
+    self.cleanup_interval = cleanup_interval
+    self._next_cleanup = 0.0
+    self._cleanup_lock = threading.Lock()
+    os.makedirs(directory, exist_ok=True)
+
+  def put(self, data):
+    """
+    :param data: The attachment data (bytes)
+    :return: Hex SHA-256 digest of the data, under which it is stored
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    file_path = self.path(digest)
+    if os.path.exists(file_path):
+      # Stored before: only restart its TTL
+      os.utime(file_path)
+    else:
+      fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.attachment-', suffix='.tmp')
+      try:
+        with os.fdopen(fd, 'wb') as f:
+          f.write(data)
+        os.replace(tmp_path, file_path)
+      except BaseException:
+        if os.path.exists(tmp_path):
+          os.remove(tmp_path)
+        raise
+    self._cleanup_if_due()
+    return digest
+
+  def path(self, digest):
+    return os.path.join(self.directory, digest)
+
+  def get_path(self, digest):
+    """ :return: Path of the stored data, or None if the digest is unknown or the data expired """
+    if not VALID_DIGEST_REGEX.match(digest):
+      return None
+    file_path = self.path(digest)
+    try:
+      if os.stat(file_path).st_mtime + self.ttl_seconds <= time.time():
+        return None
+    except FileNotFoundError:
+      return None
+    return file_path
+
+  def cleanup(self):
+    """ Deletes expired attachments. :return: Number of deleted attachments """
+    expired_before = time.time() - self.ttl_seconds
+    deleted = 0
+    with os.scandir(self.directory) as entries:
+      for entry in entries:
+        try:
+          if entry.is_file() and VALID_DIGEST_REGEX.match(entry.name) and entry.stat().st_mtime <= expired_before:
+            os.remove(entry.path)
+            deleted += 1
+        except FileNotFoundError:
+          # Deleted concurrently by another worker process
+          pass
+    return deleted
+
+  def _cleanup_if_due(self):
+    now = time.monotonic()
+    if now < self._next_cleanup or not self._cleanup_lock.acquire(blocking=False):
+      return
+    try:
+      self._next_cleanup = now + self.cleanup_interval
+      deleted = self.cleanup()
+      if deleted:
+        logging.info('Deleted {} expired attachments'.format(deleted))
+    finally:
+      self._cleanup_lock.release()
+
+
+class AttachmentOffloader:
+  """ Replaces large base64 attachments of unpacked messages by references to the AttachmentStore. """
+
+  def __init__(self, attachment_store, min_size, base_url):
+    """
+    :param attachment_store: AttachmentStore
+    :param min_size: Minimum length of the base64 data of an attachment to be offloaded
+    :param base_url: URL of the attachments retrieval API as reachable by the webhook (ending with /)
+    """
+    self.attachment_store = attachment_store
+    self.min_size = min_size
+    self.base_url = base_url
+
+  def offload(self, message_unpacked_dict):
+    """ :return: The unpacked message (dict as returned by DIDComm.unpack) with offloaded attachments """
+    attachments = message_unpacked_dict['attachments']
+    if not attachments or not any(self._is_large(attachment) for attachment in attachments):
+      return message_unpacked_dict
+    return dict(message_unpacked_dict, attachments=[
+      self._reference(attachment) if self._is_large(attachment) else attachment for attachment in attachments
+    ])
+
+  def _is_large(self, attachment):
+    data = attachment.get('data') or {}
+    return isinstance(data.get('base64'), str) and len(data['base64']) >= self.min_size
+
+  def _reference(self, attachment):
+    encoded_data = attachment['data']['base64']
+    try:
+      # Accepts base64url as well as standard base64, with or without padding
+      data = base64.urlsafe_b64decode(encoded_data + '=' * (-len(encoded_data) % 4))
+    except (binascii.Error, ValueError):
+      logging.warning('Could not decode the base64 data of attachment {}. Keeping it inline'.format(
+        attachment.get('id')))
+      return attachment
+    digest = self.attachment_store.put(data)
+    reference = {
+      'hash': 'sha256:' + digest,
+      'size': len(data),
+      'media_type': attachment.get('media_type'),
+      'url': self.base_url + digest,
+    }
+    other_data = {key: value for key, value in attachment['data'].items() if key != 'base64'}
+    return dict(attachment, data=dict(other_data, reference=reference))
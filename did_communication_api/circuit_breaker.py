@@ -0,0 +1,93 @@
+"""
+Circuit breaker failing webhook calls fast while the webhook is failing or slow, instead of letting every request
+wait for it (and adding to its load).
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from did_communication_api import metrics
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+  """
+  Tracks the outcome of the last window_size calls. Once at least minimum_calls were recorded, the breaker opens if
+  the rate of failed calls reaches failure_rate_threshold or the rate of calls taking at least slow_call_duration
+  seconds reaches slow_call_rate_threshold.
+
+  While open, calls are rejected. After open_seconds, a single trial call is let through (half open): the breaker
+  closes if it succeeds in time, and opens again otherwise.
+  """
+
+  def __init__(self, name, window_size=20, minimum_calls=10, failure_rate_threshold=0.5, slow_call_duration=5.0,
+               slow_call_rate_threshold=0.8, open_seconds=10.0):
+    self.name = name
+    self.window_size = window_size
+    self.minimum_calls = minimum_calls
+    self.failure_rate_threshold = failure_rate_threshold
+    self.slow_call_duration = slow_call_duration
+    self.slow_call_rate_threshold = slow_call_rate_threshold
+    self.open_seconds = open_seconds
+    self.state = STATE_CLOSED
+    # (failed, slow) of the last window_size calls
+    self._calls = collections.deque(maxlen=window_size)
+    self._open_until = 0.0
+    self._trial_in_flight = False
+    self._lock = threading.Lock()
+
+  def allow(self):
+    """ :return: True iff the call may be made; its outcome must then be passed to record() or cancel() """
+    with self._lock:
+      if self.state == STATE_CLOSED:
+        return True
+      if self.state == STATE_OPEN:
+        if time.monotonic() < self._open_until:
+          return False
+        self._transition(STATE_HALF_OPEN)
+      if self._trial_in_flight:
+        return False
+      self._trial_in_flight = True
+      return True
+
+  def record(self, success, duration):
+    """
+    :param success: False iff the call failed
+    :param duration: Duration of the call in seconds
+    """
+    slow = duration >= self.slow_call_duration
+    with self._lock:
+      if self.state == STATE_HALF_OPEN:
+        self._trial_in_flight = False
+        self._transition(STATE_CLOSED if success and not slow else STATE_OPEN)
+        return
+      if self.state == STATE_OPEN:
+        # Call allowed before the breaker opened
+        return
+      self._calls.append((not success, slow))
+      if len(self._calls) < self.minimum_calls:
+        return
+      failure_rate = sum(failed for failed, _ in self._calls) / len(self._calls)
+      slow_call_rate = sum(slow for _, slow in self._calls) / len(self._calls)
+      if failure_rate >= self.failure_rate_threshold or slow_call_rate >= self.slow_call_rate_threshold:
+        self._transition(STATE_OPEN)
+
+  def cancel(self):
+    """ Releases an allowed call which was not made or whose outcome says nothing about the webhook """
+    with self._lock:
+      if self.state == STATE_HALF_OPEN:
+        self._trial_in_flight = False
+
+  def _transition(self, state):
+    logging.warning('Circuit breaker of {} changed from {} to {}'.format(self.name, self.state, state))
+    metrics.observe_breaker_transition(state)
+    self.state = state
+    if state == STATE_OPEN:
+      self._open_until = time.monotonic() + self.open_seconds
+    elif state == STATE_CLOSED:
+      self._calls.clear()
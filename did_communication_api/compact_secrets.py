@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compacts the secrets store: removes the private keys of retired DIDs, i.e. of all DIDs other than the current
+server DID (recorded in the server identity file), the DIDs of tenants (if enabled) and the DIDs given with --keep.
+
+Usage:
+  python -m did_communication_api.compact_secrets [--dry-run] [--keep <DID> ...]
+"""
+
+import argparse
+import logging
+import sys
+
+from did_communication_api import app_configurer, utils
+from did_communication_api.server_identity import ServerIdentity
+from did_communication_api.tenants import TenantRegistry
+
+
+def compact_secrets(secret_resolver, server_identity, keep_dids=(), dry_run=False, tenant_registry=None):
+  """
+  :param tenant_registry: TenantRegistry whose DIDs are kept (None if tenants are disabled)
+  :return: List of the kids of the removed keys
+  :raises ValueError: If there is no live DID, as compacting would remove all keys
+  """
+  # Holding the identity lock prevents a booting service from storing a new server DID meanwhile
+  with server_identity.locked():
+    identity = server_identity.read()
+    live_dids = set(keep_dids)
+    if identity:
+      live_dids.add(identity['did'])
+    if tenant_registry is not None:
+      live_dids.update(tenant_registry.list_dids())
+    if not live_dids:
+      raise ValueError('No server identity recorded in {} and no DIDs to keep given'.format(server_identity.file_path))
+    return secret_resolver.retain_dids(live_dids, dry_run=dry_run)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--identity-file', help='The server identity file (default: from the configuration)')
+  parser.add_argument('--keep', action='append', default=[], help='Further DID whose keys are kept')
+  parser.add_argument('--dry-run', action='store_true', help='Only list the keys which would be removed')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+
+  identity_file = args.identity_file or utils.load_component_configuration('server_identity')['file_path']
+  tenants_config = utils.load_component_configuration('tenants')
+  tenant_registry = TenantRegistry(tenants_config['database_path']) if tenants_config['enabled'] else None
+  try:
+    removed_kids = compact_secrets(
+      app_configurer.secret_resolver_factory()(), ServerIdentity(identity_file), args.keep, args.dry_run,
+      tenant_registry)
+  except ValueError as error:
+    logging.error(str(error))
+    sys.exit(1)
+
+  for kid in removed_kids:
+    print(('Would remove ' if args.dry_run else 'Removed ') + kid)
+  print('{} keys {}'.format(len(removed_kids), 'to remove' if args.dry_run else 'removed'))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,205 @@
+"""
+HTTP compression (Content-Encoding) of inbox requests and responses and of webhook notifications.
+
+Packed DIDComm messages are base64url encoded JSON, and large ones (e.g. presentations with SHACL or presentation
+definition attachments) compress well. Compressed request bodies are decompressed with limits on the decompressed
+size and the compression ratio, so a small request cannot expand into a huge body (decompression bomb).
+"""
+
+import json
+import logging
+import time
+import zlib
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+from did_communication_api import constants, metrics, utils
+from did_communication_api.errors import (
+  DecompressionError, DecompressedBodyTooLargeError, UnsupportedContentEncodingError)
+
+ENCODING_GZIP = 'gzip'
+ENCODING_DEFLATE = 'deflate'
+ENCODING_ZSTD = 'zstd'
+ENCODING_IDENTITY = 'identity'
+
+# zlib window bits of the gzip format and of the zlib format used by the "deflate" Content-Encoding
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+ZLIB_WBITS = zlib.MAX_WBITS
+# Raw deflate streams, sent as "deflate" by some clients
+RAW_DEFLATE_WBITS = -zlib.MAX_WBITS
+
+
+def is_available(encoding):
+  """ True iff the encoding can be used (zstd requires the zstandard package) """
+  return encoding in (ENCODING_GZIP, ENCODING_DEFLATE) or (encoding == ENCODING_ZSTD and zstandard is not None)
+
+
+def is_encoded(content_encoding):
+  """ True iff compression is enabled and the Content-Encoding header of a request names an encoding """
+  if not content_encoding or not utils.load_component_configuration('compression')['enabled']:
+    return False
+  return any(coding.strip().lower() not in ('', ENCODING_IDENTITY) for coding in content_encoding.split(','))
+
+
+def decode_request_body(body, content_encoding):
+  """
+  Decompresses a request body according to its Content-Encoding header.
+
+  :return: (decompressed body, None) or (None, error response)
+  """
+  if not is_encoded(content_encoding):
+    return body, None
+  compression_config = utils.load_component_configuration('compression')
+  max_size = compression_config['max_decompressed_size']
+  if compression_config['max_ratio']:
+    max_size = min(max_size, compression_config['max_ratio'] * max(len(body), 1))
+  started = time.perf_counter()
+  try:
+    decompressed_body = decompress(body, _request_encoding(content_encoding), max_size)
+  except UnsupportedContentEncodingError:
+    logging.warning(constants.INVALID_REQUEST_RECEIVED.format(
+      'Unsupported Content-Encoding: {}'.format(content_encoding)))
+    return None, utils.generate_err_resp('Unsupported Content-Encoding', constants.HTTP_UNSUPPORTED_MEDIA_TYPE)
+  except DecompressedBodyTooLargeError:
+    logging.warning(constants.INVALID_REQUEST_RECEIVED.format(
+      'Body decompresses to more than {} bytes'.format(max_size)))
+    return None, utils.generate_err_resp('Request body too large', constants.HTTP_PAYLOAD_TOO_LARGE)
+  except DecompressionError:
+    logging.warning(constants.INVALID_REQUEST_RECEIVED.format('Body cannot be decompressed'))
+    return None, utils.generate_err_resp('Invalid compressed request body', constants.HTTP_BAD_REQUEST)
+  metrics.observe_compression(
+    metrics.COMPRESSION_REQUEST, len(decompressed_body), len(body), time.perf_counter() - started)
+  return decompressed_body, None
+
+
+def encode_response_body(body, accept_encoding):
+  """
+  Compresses a response body with the preferred encoding accepted by the client, if it has at least min_size bytes.
+
+  :return: (body, Content-Encoding or None if the body is not compressed)
+  """
+  compression_config = utils.load_component_configuration('compression')
+  if not compression_config['enabled'] or len(body) < compression_config['min_size']:
+    return body, None
+  encoding = negotiate(accept_encoding, compression_config['encodings'])
+  if encoding is None:
+    return body, None
+  started = time.perf_counter()
+  compressed_body = compress(body, encoding, compression_config['level'])
+  if len(compressed_body) >= len(body):
+    return body, None
+  metrics.observe_compression(
+    metrics.COMPRESSION_RESPONSE, len(body), len(compressed_body), time.perf_counter() - started)
+  return compressed_body, encoding
+
+
+def encode_webhook_body(json_data):
+  """ :return: (body, headers) of a webhook notification, compressed with the configured webhook_encoding """
+  body = json.dumps(json_data).encode('utf-8')
+  headers = {'Content-Type': 'application/json'}
+  compression_config = utils.load_component_configuration('compression')
+  encoding = compression_config['webhook_encoding']
+  if not compression_config['enabled'] or not encoding or len(body) < compression_config['min_size']:
+    return body, headers
+  started = time.perf_counter()
+  compressed_body = compress(body, encoding, compression_config['level'])
+  metrics.observe_compression(
+    metrics.COMPRESSION_WEBHOOK, len(body), len(compressed_body), time.perf_counter() - started)
+  headers['Content-Encoding'] = encoding
+  return compressed_body, headers
+
+
+def negotiate(accept_encoding, encodings):
+  """
+  :param accept_encoding: Accept-Encoding header of the request
+  :param encodings: Supported encodings in the order of preference
+  :return: The first of the encodings accepted by the client, or None
+  """
+  if not accept_encoding:
+    return None
+  qualities = {}
+  for coding in accept_encoding.split(','):
+    name, _, parameters = coding.partition(';')
+    quality = 1.0
+    parameter_name, _, value = parameters.partition('=')
+    if parameter_name.strip().lower() == 'q':
+      try:
+        quality = float(value)
+      except ValueError:
+        quality = 0.0
+    qualities[name.strip().lower()] = quality
+  for encoding in encodings:
+    if qualities.get(encoding, qualities.get('*', 0.0)) > 0 and is_available(encoding):
+      return encoding
+  return None
+
+
+def compress(data, encoding, level):
+  if encoding == ENCODING_ZSTD:
+    return zstandard.ZstdCompressor(level=level).compress(data)
+  compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS if encoding == ENCODING_GZIP else ZLIB_WBITS)
+  return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, encoding, max_size):
+  """
+  :raises UnsupportedContentEncodingError: If the encoding is not supported
+  :raises DecompressedBodyTooLargeError: If the data decompresses to more than max_size bytes
+  :raises DecompressionError: If the data is not valid for the encoding
+  """
+  if not is_available(encoding):
+    raise UnsupportedContentEncodingError(encoding)
+  if encoding == ENCODING_ZSTD:
+    return _decompress_zstd(data, max_size)
+  if encoding == ENCODING_GZIP:
+    return _decompress_zlib(data, GZIP_WBITS, max_size)
+  try:
+    return _decompress_zlib(data, ZLIB_WBITS, max_size)
+  except DecompressedBodyTooLargeError:
+    raise
+  except DecompressionError:
+    return _decompress_zlib(data, RAW_DEFLATE_WBITS, max_size)
+
+
+def _request_encoding(content_encoding):
+  codings = [coding.strip().lower() for coding in content_encoding.split(',')]
+  codings = [coding for coding in codings if coding not in ('', ENCODING_IDENTITY)]
+  if len(codings) != 1:
+    # Bodies compressed several times are not supported
+    raise UnsupportedContentEncodingError(content_encoding)
+  return codings[0]
+
+
+def _decompress_zlib(data, wbits, max_size):
+  decompressor = zlib.decompressobj(wbits)
+  try:
+    # Decompresses at most one byte more than allowed, instead of the whole (possibly huge) body
+    result = decompressor.decompress(data, max_size + 1)
+  except zlib.error as error:
+    raise DecompressionError(str(error))
+  if len(result) > max_size:
+    raise DecompressedBodyTooLargeError(max_size)
+  if not decompressor.eof:
+    raise DecompressionError('Truncated compressed body')
+  return result
+
+
+def _decompress_zstd(data, max_size):
+  chunks = []
+  size = 0
+  try:
+    with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+      while size <= max_size:
+        chunk = reader.read(max_size + 1 - size)
+        if not chunk:
+          break
+        chunks.append(chunk)
+        size += len(chunk)
+  except zstandard.ZstdError as error:
+    raise DecompressionError(str(error))
+  if size > max_size:
+    raise DecompressedBodyTooLargeError(max_size)
+  return b''.join(chunks)
@@ -0,0 +1,541 @@
+""" Parsed, validated and immutable snapshot of the service configuration with hot reload. """
+
+import importlib.util
+import logging
+import os
+import signal
+import threading
+import time
+
+from types import MappingProxyType
+
+from yaml import safe_load, YAMLError
+
+from did_communication_api import constants
+from did_communication_api.errors import ConfigurationError
+
+# Components (and their keys) that every configuration has to define
+REQUIRED_CONFIGURATION = {
+  'server': ['host', 'port', 'debug'],
+  'webhooks': ['request_received'],
+  'logging': ['level'],
+}
+
+# Defaults of optional components and keys. Values given in the configuration file take precedence.
+DEFAULT_CONFIGURATION = {
+  'webhooks': {
+    'pool_size': 10,
+    'pool_block': False,
+    'connect_timeout': 3.05,
+    'read_timeout': 30,
+    'http2': False,
+    'request_received_batch': None,
+    'request_received_hedge': None,
+    'hedge_delay': 0.5,
+  },
+  'compression': {
+    'enabled': False,
+    'encodings': ['gzip', 'deflate'],
+    'min_size': 1024,
+    'level': 6,
+    'max_decompressed_size': 10485760,
+    'max_ratio': 100,
+    'webhook_encoding': None,
+  },
+  'webhook_circuit_breaker': {
+    'enabled': False,
+    'window_size': 20,
+    'minimum_calls': 10,
+    'failure_rate_threshold': 0.5,
+    'slow_call_duration': 5.0,
+    'slow_call_rate_threshold': 0.8,
+    'open_seconds': 10.0,
+  },
+  'did_resolver': {
+    'cache_size': 1024,
+  },
+  'inbox': {
+    'max_body_size': 10485760,
+    'deadline_header': 'X-Request-Timeout',
+    'deadline_reserve': 0.1,
+  },
+  'websocket_inbox': {
+    'enabled': False,
+    'max_in_flight': 16,
+    'idle_timeout': 60,
+    'max_connections': 1000,
+  },
+  'batch_inbox': {
+    'max_messages': 100,
+  },
+  'async_delivery': {
+    'enabled': False,
+    'queue_path': 'message_queue.db',
+    'poll_interval': 0.5,
+    'batch_size': 10,
+    'max_attempts': 5,
+    'lease_seconds': 60,
+    'response_ttl': 604800,
+    'max_responses_per_recipient': 1000,
+  },
+  'crypto_executor': {
+    'enabled': False,
+    'pool_size': 0,
+    'queue_depth': 64,
+  },
+  'admission': {
+    'enabled': False,
+    'max_in_flight': 64,
+    'max_queued': 128,
+    'queue_timeout': 5.0,
+    'retry_after': 1,
+    'sender_rate': None,
+    'sender_burst': 20,
+    'max_senders': 100000,
+  },
+  'tenants': {
+    'enabled': False,
+    'database_path': 'tenants.db',
+    'refresh_interval': 5.0,
+    'miss_refresh_interval': 1.0,
+  },
+  'outbox': {
+    'enabled': False,
+    'concurrency': 8,
+    'queue_size': 1000,
+    'connections_per_endpoint': 4,
+    'max_endpoint_pools': 100,
+    'max_coalesced': 16,
+    'max_attempts': 5,
+    'backoff_base': 0.5,
+    'backoff_max': 60,
+    'connect_timeout': 3.05,
+    'read_timeout': 30,
+    'wait_timeout': 30,
+    'max_recipients': 16,
+  },
+  'jwe_precheck': {
+    'enabled': True,
+    'max_recipients': 16,
+    'max_ciphertext_size': 10485760,
+    'kid_refresh_interval': 5.0,
+  },
+  'attachment_offload': {
+    'enabled': False,
+    'min_size': 65536,
+    'directory': 'attachments',
+    'ttl_seconds': 3600,
+    'base_url': None,
+  },
+  'replay_cache': {
+    'enabled': False,
+    'ttl_seconds': 300,
+    'max_entries': 10000,
+    'shared_path': None,
+    'wait_timeout': 30,
+  },
+  'decision_cache': {
+    'enabled': False,
+    'max_entries': 10000,
+    'max_ttl': 300,
+    'invalidations_path': None,
+    'invalidation_check_interval': 1.0,
+  },
+  'secrets': {
+    'backend': 'json',
+    'file_path': 'secrets.json',
+    'database_path': 'secrets.db',
+  },
+  'startup': {
+    'prewarm': True,
+  },
+  'server_identity': {
+    'persistent': True,
+    'file_path': 'server_identity.json',
+  },
+}
+
+SECRETS_BACKENDS = ('json', 'sqlite')
+COMPRESSION_ENCODINGS = ('gzip', 'deflate', 'zstd')
+
+# Environment variables overriding the server configuration
+SERVER_ENV_OVERRIDES = {
+  'host': 'API_HOST',
+  'port': 'API_PORT',
+  'debug': 'API_DEBIG',
+}
+
+# Minimum time in seconds between two checks of the configuration file's modification time
+FILE_CHECK_INTERVAL = 1.0
+
+# Configuration read once on boot (by app_configurer and the clients and stores it creates), whose changes only take
+# effect after a restart. Components mapped to None are read once as a whole, others only the listed keys.
+# All other configuration (e.g. inbox, batch_inbox, compression, the webhook URLs, logging.level) is reloaded.
+RESTART_REQUIRED_CONFIGURATION = {
+  'server': None,
+  'secrets': None,
+  'server_identity': None,
+  'did_resolver': None,
+  'crypto_executor': None,
+  'async_delivery': None,
+  'replay_cache': None,
+  'decision_cache': None,
+  'attachment_offload': None,
+  'jwe_precheck': None,
+  'outbox': None,
+  'tenants': None,
+  'admission': None,
+  'websocket_inbox': None,
+  'webhook_circuit_breaker': None,
+  'webhooks': ('pool_size', 'pool_block', 'connect_timeout', 'read_timeout', 'http2'),
+}
+
+
+class ServiceConfiguration:
+  """ Immutable snapshot of the configuration of this service """
+
+  def __init__(self, service_config, file_path, file_mtime):
+    self._config = _freeze(service_config)
+    self.file_path = file_path
+    self.file_mtime = file_mtime
+
+  def __getitem__(self, component_name):
+    return self._config[component_name]
+
+  def __contains__(self, component_name):
+    return component_name in self._config
+
+  def get(self, component_name, default=None):
+    return self._config.get(component_name, default)
+
+
+class ConfigurationStore:
+  """
+  Holds the current configuration snapshot.
+
+  The snapshot is replaced as a whole when the configuration file changes (checked at most once per
+  FILE_CHECK_INTERVAL), when reload() is called or on the first get() after request_reload(), e.g. on SIGHUP.
+  A new configuration is only swapped in after it was parsed and validated successfully; otherwise the previous
+  snapshot stays active.
+  """
+
+  def __init__(self, file_path):
+    self.file_path = file_path
+    self._reload_lock = threading.Lock()
+    self._snapshot = load_configuration(file_path)
+    self._next_check = time.monotonic() + FILE_CHECK_INTERVAL
+    self._reload_requested = False
+
+  def get(self):
+    now = time.monotonic()
+    if now >= self._next_check:
+      self._next_check = now + FILE_CHECK_INTERVAL
+      if self._reload_requested or _file_mtime(self.file_path) != self._snapshot.file_mtime:
+        self._reload_requested = False
+        self.reload()
+    return self._snapshot
+
+  def request_reload(self):
+    """ Lets the next get() reload the configuration. Safe to call from a signal handler (takes no lock). """
+    self._reload_requested = True
+    self._next_check = 0.0
+
+  def reload(self):
+    """
+    Re-loads the configuration file and swaps in the new snapshot if it is valid.
+
+    :return: True iff the new configuration was swapped in
+    """
+    with self._reload_lock:
+      try:
+        snapshot = load_configuration(self.file_path)
+      except ConfigurationError as error:
+        logging.error('Configuration reload failed, keeping the previous configuration: {}'.format(error))
+        return False
+      previous_snapshot, self._snapshot = self._snapshot, snapshot
+    logging.info('Configuration reloaded from {}'.format(self.file_path))
+    if snapshot['logging']['level'] != previous_snapshot['logging']['level']:
+      logging.getLogger().setLevel(snapshot['logging']['level'])
+    changed_settings = _restart_required_changes(previous_snapshot, snapshot)
+    if changed_settings:
+      logging.warning('Changes of {} take effect after a restart of the service'.format(', '.join(changed_settings)))
+    return True
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_configuration():
+  """ Returns the current configuration snapshot. Loads the configuration on first use. """
+  global _store
+  if _store is None:
+    with _store_lock:
+      if _store is None:
+        _store = ConfigurationStore(get_configuration_file_path())
+  return _store.get()
+
+
+def reload_configuration():
+  get_configuration()
+  return _store.reload()
+
+
+def request_configuration_reload():
+  """ Reloads the configuration on its next use (by the next request) """
+  get_configuration()
+  _store.request_reload()
+
+
+def install_reload_signal_handler():
+  """
+  Reloads the configuration on its next use after the process received SIGHUP (if supported by the platform).
+  The handler only requests the reload: it runs on the main thread, which may be reloading the configuration itself.
+
+  gunicorn replaces this handler in its master process (SIGHUP restarts the workers) and in every worker process,
+  where it is installed again by the post_worker_init hook (gunicorn_config).
+  """
+  if not hasattr(signal, 'SIGHUP'):
+    return
+
+  def handle_sighup(signum, frame):
+    request_configuration_reload()
+
+  signal.signal(signal.SIGHUP, handle_sighup)
+
+
+def get_configuration_file_path():
+  return os.getenv(constants.CONFIG_FILE_PATH_ENV_VARIABLE,
+                   os.path.join(constants.PROJECT_DIRECTORY, 'config/config.yml'))
+
+
+def load_configuration(file_path):
+  """
+  Parses and validates the configuration file.
+
+  :param file_path: Path to the config.yml
+  :return: ServiceConfiguration snapshot
+  :raises ConfigurationError: if the file cannot be read or parsed or the configuration is invalid
+  """
+  file_mtime = _file_mtime(file_path)
+  try:
+    with open(file_path, 'r') as file:
+      project_config = safe_load(file)
+  except (OSError, YAMLError) as error:
+    raise ConfigurationError(constants.LOG_YAML_PARSE_FAIL.format(file_path, error))
+
+  if not isinstance(project_config, dict) or not project_config.get(constants.CONF_SERVICES_NAME):
+    raise ConfigurationError(constants.LOG_CNF_NO_SERVICES)
+  services_config = project_config[constants.CONF_SERVICES_NAME]
+  if not isinstance(services_config.get(constants.SERVICE_NAME), dict):
+    raise ConfigurationError(constants.LOG_CNF_UNAVAIL_SERVICE)
+
+  try:
+    service_config = _with_defaults(services_config[constants.SERVICE_NAME])
+    _apply_server_env_overrides(service_config)
+    validate_configuration(service_config)
+  except (TypeError, ValueError, KeyError, AttributeError) as error:
+    # E.g. a value of the wrong type, which cannot be converted by the validation
+    raise ConfigurationError('Invalid configuration - {}: {}'.format(type(error).__name__, error))
+  return ServiceConfiguration(service_config, file_path, file_mtime)
+
+
+def validate_configuration(service_config):
+  for component_name, required_keys in REQUIRED_CONFIGURATION.items():
+    component_config = service_config.get(component_name)
+    if not isinstance(component_config, dict):
+      raise ConfigurationError(constants.LOG_CNF_COMPONENT_MISSING % component_name)
+    for key in required_keys:
+      if component_config.get(key) is None:
+        raise ConfigurationError('Invalid configuration - Missing {}.{}'.format(component_name, key))
+
+  for component_name, validate_component in COMPONENT_VALIDATORS.items():
+    validate_component(service_config[component_name])
+
+
+def _validate_server(server_config):
+  try:
+    int(server_config['port'])
+  except (TypeError, ValueError):
+    raise ConfigurationError('Invalid configuration - server.port must be a number')
+
+
+def _validate_webhooks(webhooks_config):
+  if int(webhooks_config['pool_size']) < 1:
+    raise ConfigurationError('Invalid configuration - webhooks.pool_size must be at least 1')
+  if float(webhooks_config['hedge_delay']) < 0:
+    raise ConfigurationError('Invalid configuration - webhooks.hedge_delay must not be negative')
+
+
+def _validate_webhook_circuit_breaker(breaker_config):
+  if int(breaker_config['window_size']) < 1 or not 1 <= int(breaker_config['minimum_calls']) <= \
+     int(breaker_config['window_size']):
+    raise ConfigurationError('Invalid configuration - webhook_circuit_breaker.minimum_calls must be between 1 and '
+                             'window_size')
+  if not 0 < float(breaker_config['failure_rate_threshold']) <= 1 or \
+     not 0 < float(breaker_config['slow_call_rate_threshold']) <= 1:
+    raise ConfigurationError('Invalid configuration - webhook_circuit_breaker rate thresholds must be in (0, 1]')
+
+
+def _validate_compression(compression_config):
+  encodings = list(compression_config['encodings'] or [])
+  if compression_config['webhook_encoding'] is not None:
+    encodings.append(compression_config['webhook_encoding'])
+  if any(encoding not in COMPRESSION_ENCODINGS for encoding in encodings):
+    raise ConfigurationError('Invalid configuration - compression encodings must be any of {}'.format(
+      COMPRESSION_ENCODINGS))
+  if compression_config['enabled'] and 'zstd' in encodings and importlib.util.find_spec('zstandard') is None:
+    raise ConfigurationError('Invalid configuration - the zstd compression requires the zstandard package')
+  if not 1 <= int(compression_config['level']) <= 9:
+    raise ConfigurationError('Invalid configuration - compression.level must be between 1 and 9')
+  if int(compression_config['min_size']) < 0 or int(compression_config['max_decompressed_size']) < 1 or \
+     float(compression_config['max_ratio'] or 0) < 0:
+    raise ConfigurationError('Invalid configuration - compression sizes and max_ratio must not be negative')
+
+
+def _validate_did_resolver(did_resolver_config):
+  if int(did_resolver_config['cache_size']) < 0:
+    raise ConfigurationError('Invalid configuration - did_resolver.cache_size must not be negative')
+
+
+def _validate_inbox(inbox_config):
+  if int(inbox_config['max_body_size']) < 1:
+    raise ConfigurationError('Invalid configuration - inbox.max_body_size must be at least 1')
+  if float(inbox_config['deadline_reserve']) < 0:
+    raise ConfigurationError('Invalid configuration - inbox.deadline_reserve must not be negative')
+
+
+def _validate_websocket_inbox(websocket_config):
+  if any(int(websocket_config[key]) < 1 for key in ('max_in_flight', 'max_connections')) or \
+     float(websocket_config['idle_timeout']) <= 0:
+    raise ConfigurationError('Invalid configuration - websocket_inbox limits and idle_timeout must be positive')
+
+
+def _validate_batch_inbox(batch_config):
+  if int(batch_config['max_messages']) < 1:
+    raise ConfigurationError('Invalid configuration - batch_inbox.max_messages must be at least 1')
+
+
+def _validate_async_delivery(delivery_config):
+  if int(delivery_config['batch_size']) < 1 or int(delivery_config['max_attempts']) < 1:
+    raise ConfigurationError('Invalid configuration - async_delivery.batch_size and max_attempts must be at least 1')
+  if float(delivery_config['response_ttl']) <= 0 or int(delivery_config['max_responses_per_recipient']) < 1:
+    raise ConfigurationError('Invalid configuration - async_delivery.response_ttl and max_responses_per_recipient '
+                             'must be positive')
+
+
+def _validate_crypto_executor(executor_config):
+  if int(executor_config['pool_size']) < 0 or int(executor_config['queue_depth']) < 0:
+    raise ConfigurationError('Invalid configuration - crypto_executor sizes must not be negative')
+
+
+def _validate_admission(admission_config):
+  if int(admission_config['max_in_flight']) < 1 or int(admission_config['max_queued']) < 0:
+    raise ConfigurationError('Invalid configuration - admission.max_in_flight must be at least 1')
+  if admission_config['sender_rate'] is not None and (
+     float(admission_config['sender_rate']) <= 0 or int(admission_config['sender_burst']) < 1):
+    raise ConfigurationError('Invalid configuration - admission.sender_rate and sender_burst must be positive')
+
+
+def _validate_outbox(outbox_config):
+  if any(int(outbox_config[key]) < 1 for key in (
+     'concurrency', 'queue_size', 'connections_per_endpoint', 'max_endpoint_pools', 'max_coalesced', 'max_attempts',
+     'max_recipients')):
+    raise ConfigurationError('Invalid configuration - outbox sizes, max_attempts and max_recipients must be at least 1')
+
+
+def _validate_jwe_precheck(precheck_config):
+  if int(precheck_config['max_recipients']) < 1 or int(precheck_config['max_ciphertext_size']) < 1:
+    raise ConfigurationError('Invalid configuration - jwe_precheck limits must be at least 1')
+
+
+def _validate_attachment_offload(offload_config):
+  if int(offload_config['min_size']) < 0 or float(offload_config['ttl_seconds']) <= 0:
+    raise ConfigurationError('Invalid configuration - attachment_offload.min_size and ttl_seconds must be positive')
+
+
+def _validate_replay_cache(replay_config):
+  if int(replay_config['max_entries']) < 1 or float(replay_config['ttl_seconds']) <= 0:
+    raise ConfigurationError('Invalid configuration - replay_cache.max_entries and ttl_seconds must be positive')
+
+
+def _validate_decision_cache(cache_config):
+  if int(cache_config['max_entries']) < 1 or float(cache_config['max_ttl']) <= 0:
+    raise ConfigurationError('Invalid configuration - decision_cache.max_entries and max_ttl must be positive')
+  if float(cache_config['invalidation_check_interval']) < 0:
+    raise ConfigurationError('Invalid configuration - decision_cache.invalidation_check_interval must not be negative')
+
+
+def _validate_secrets(secrets_config):
+  if secrets_config['backend'] not in SECRETS_BACKENDS:
+    raise ConfigurationError('Invalid configuration - secrets.backend must be one of {}'.format(SECRETS_BACKENDS))
+
+
+# Validation of every component, called with the component's configuration (defaults applied)
+COMPONENT_VALIDATORS = {
+  'server': _validate_server,
+  'webhooks': _validate_webhooks,
+  'webhook_circuit_breaker': _validate_webhook_circuit_breaker,
+  'compression': _validate_compression,
+  'did_resolver': _validate_did_resolver,
+  'inbox': _validate_inbox,
+  'websocket_inbox': _validate_websocket_inbox,
+  'batch_inbox': _validate_batch_inbox,
+  'async_delivery': _validate_async_delivery,
+  'crypto_executor': _validate_crypto_executor,
+  'admission': _validate_admission,
+  'outbox': _validate_outbox,
+  'jwe_precheck': _validate_jwe_precheck,
+  'attachment_offload': _validate_attachment_offload,
+  'replay_cache': _validate_replay_cache,
+  'decision_cache': _validate_decision_cache,
+  'secrets': _validate_secrets,
+}
+
+
+def _restart_required_changes(previous_snapshot, snapshot):
+  """ :return: The names of the changed settings which are only read on boot (see RESTART_REQUIRED_CONFIGURATION) """
+  changed_settings = []
+  for component_name, keys in RESTART_REQUIRED_CONFIGURATION.items():
+    previous_config, config = previous_snapshot.get(component_name), snapshot.get(component_name)
+    if keys is None:
+      if previous_config != config:
+        changed_settings.append(component_name)
+      continue
+    changed_settings.extend('{}.{}'.format(component_name, key) for key in keys
+                            if (previous_config or {}).get(key) != (config or {}).get(key))
+  return changed_settings
+
+
+def _with_defaults(service_config):
+  result = dict(service_config)
+  for component_name, defaults in DEFAULT_CONFIGURATION.items():
+    component_config = dict(defaults)
+    component_config.update(result.get(component_name) or {})
+    result[component_name] = component_config
+  return result
+
+
+def _apply_server_env_overrides(service_config):
+  server_config = service_config.get('server')
+  if not isinstance(server_config, dict):
+    return
+  server_config = dict(server_config)
+  for key, env_variable in SERVER_ENV_OVERRIDES.items():
+    server_config[key] = os.getenv(env_variable, server_config.get(key))
+  service_config['server'] = server_config
+
+
+def _freeze(value):
+  if isinstance(value, dict):
+    return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+  if isinstance(value, list):
+    return tuple(_freeze(item) for item in value)
+  return value
+
+
+def _file_mtime(file_path):
+  try:
+    return os.stat(file_path).st_mtime_ns
+  except OSError:
+    return None
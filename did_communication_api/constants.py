@@ -12,6 +12,13 @@ CONF_SERVICES_NAME = "services"
 
 # API Endpoints
 API_EXTERNAL_INBOX = '/did_comm/inbox/'
+API_EXTERNAL_INBOX_BATCH = '/did_comm/inbox/batch/'
+API_EXTERNAL_INBOX_WEBSOCKET = '/did_comm/inbox/ws/'
+API_EXTERNAL_PICKUP = '/did_comm/pickup/'
+API_INTERNAL_ATTACHMENTS = '/-system/attachments/'
+API_INTERNAL_DECISION_CACHE = '/-system/decision_cache/'
+API_INTERNAL_OUTBOX = '/-system/outbox/'
+API_INTERNAL_TENANTS = '/-system/tenants/'
 
 # Regexes
 VALID_COMPONENT_NAME_REGEX = re.compile('[a-z_]+')
@@ -35,9 +42,20 @@ LOG_CON_EST_TO_SERVICE_FAILED = 'Connection establishment to service {} failed d
 
 # HTTP STATUS CODES
 HTTP_SUCCESS_STATUS = 200
+HTTP_CREATED = 201
+HTTP_ACCEPTED = 202
 HTTP_BAD_REQUEST = 400
 HTTP_NOT_FOUND = 404
+HTTP_PAYLOAD_TOO_LARGE = 413
+HTTP_UNSUPPORTED_MEDIA_TYPE = 415
+HTTP_TOO_MANY_REQUESTS = 429
 HTTP_INTERNAL_ERROR = 500
+HTTP_BAD_GATEWAY = 502
+HTTP_SERVICE_UNAVAILABLE = 503
+
+# Webhooks
+# Seconds; read timeout of a webhook call whose deadline was reached right after the call was allowed
+MIN_WEBHOOK_READ_TIMEOUT = 0.001
 
 # HTTP Error Messages:
 HTTP_MSG_INVALID_CON_REQ = "Invalid Connection Request: {}"
@@ -51,6 +69,19 @@ DIDCOMM_REQUEST_PRESENTATION_MSG_TYPE = "https://didcomm.org/present-proof/2.0/r
 DIDCOMM_PRESENTATION_MSG_TYPE = "https://didcomm.org/present-proof/2.0/presentation"
 DIDCOMM_ERROR_MSG_TYPE = "https://uwmbv.solid.aifb.kit.edu/ssi-acs/didcomm/messages/error-message"
 DIDCOMM_AUTHORIZATION_DECISION_MSG_TYPE = "http://example.aifb.org/autorization-decision/"
+# Message packed and unpacked by a worker process for itself when it is pre-warmed
+PREWARM_MSG_TYPE = "https://uwmbv.solid.aifb.kit.edu/ssi-acs/didcomm/messages/prewarm"
+
+# DIDComm Message Pickup Protocol 3.0 Message Types
+MESSAGE_PICKUP_STATUS_REQUEST_MSG_TYPE = "https://didcomm.org/messagepickup/3.0/status-request"
+MESSAGE_PICKUP_STATUS_MSG_TYPE = "https://didcomm.org/messagepickup/3.0/status"
+MESSAGE_PICKUP_DELIVERY_REQUEST_MSG_TYPE = "https://didcomm.org/messagepickup/3.0/delivery-request"
+MESSAGE_PICKUP_DELIVERY_MSG_TYPE = "https://didcomm.org/messagepickup/3.0/delivery"
+MESSAGE_PICKUP_MESSAGES_RECEIVED_MSG_TYPE = "https://didcomm.org/messagepickup/3.0/messages-received"
+
+# Media Types
+DIDCOMM_ENCRYPTED_MEDIA_TYPE = "application/didcomm-encrypted+json"
+FORM_MEDIA_TYPE = "application/x-www-form-urlencoded"
 
 # Attachment formats:
 PRESENTATION_REQUEST_ATTACHMENT_FORMAT_PE_DEFINITION = "dif/presentation-exchange/definitions@v1.0"
@@ -60,6 +91,7 @@ PRESENTATION_ATTACHMENT_FORMAT_SHACL = "https://uwmbv.solid.aifb.kit.edu/ssi-acs
                                        "required-credentials/SHACL/presentation"
 
 # Logging
+INVALID_BATCH_REQUEST_RECEIVED = "Received Invalid Batch Request: {}"
 INVALID_REQUEST_RECEIVED = "Received Invalid Request: {}"
 DIDCOMM_MESSAGE_RECEIVED = "Received DIDComm Request: Message_ID: {msg_id} Message Type: {msg_type}. " \
                            "Notifying Webhook.."
@@ -0,0 +1,145 @@
+"""
+Cache of the webhook's decisions on repeatable requests, e.g. a client asking for the same resource again and again.
+
+The webhook decides what is cacheable: a response with "cache_ttl": <seconds> is stored for that time (at most
+max_ttl seconds), keyed by (recipient DID, sender DID, HTTP method, message type, hash of the message body and
+attachments). An equal request is then answered with the stored response, packed for the sender as a new message,
+without notifying the webhook.
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+from did_communication_api.lru_cache import LRUCache
+from did_communication_api.sqlite_connections import SQLiteConnections
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS decision_cache_invalidations (
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  sender TEXT,
+  msg_type TEXT
+);
+"""
+
+# Positions of the sender DID and the message type in the keys of the cache
+KEY_SENDER = 1
+KEY_MSG_TYPE = 3
+
+
+def decision_key(message_unpacked_dict, http_method, recipient_did):
+  """ :return: The key of the message in the DecisionCache, or None if the message cannot be cached """
+  try:
+    content = json.dumps(
+      [message_unpacked_dict['msg_body'], message_unpacked_dict['attachments']],
+      sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+  except (TypeError, ValueError):
+    return None
+  return (recipient_did, message_unpacked_dict['frm'], http_method, message_unpacked_dict['msg_type'],
+          hashlib.sha256(content.encode('utf-8')).hexdigest())
+
+
+def ttl_of(webhook_response):
+  """ :return: The seconds the webhook allows its response to be cached (None if it must not be cached) """
+  ttl = webhook_response.get('cache_ttl') if isinstance(webhook_response, dict) else None
+  if isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or ttl <= 0:
+    return None
+  return ttl
+
+
+class DecisionCache:
+  """
+  Decisions stored in the memory of this process (LRU, size-bounded).
+
+  Invalidations remove the stored decisions of a sender and/or a message type. If invalidations_path is set, they
+  are recorded in an SQLite database shared by all worker processes, which check for new invalidations at most every
+  invalidation_check_interval seconds.
+
+  A decision is only stored if the cache was not invalidated since the request was looked up (see generation()), so
+  a webhook call in flight during an invalidation does not store a decision made before it.
+  """
+
+  def __init__(self, max_entries, max_ttl, invalidations_path=None, invalidation_check_interval=1.0):
+    self.cache = LRUCache(max_entries)
+    self.max_ttl = max_ttl
+    self.invalidation_check_interval = invalidation_check_interval
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+    self._connections = None
+    self._invalidations_seq = 0
+    self._next_invalidations_check = 0.0
+    self._invalidations_lock = threading.Lock()
+    if invalidations_path:
+      self._connections = SQLiteConnections(invalidations_path)
+      connection, lock = self._connections.get()
+      with lock:
+        connection.executescript(SCHEMA)
+        # Invalidations of earlier runs do not concern the (empty) cache
+        self._invalidations_seq = connection.execute(
+          'SELECT COALESCE(MAX(seq), 0) FROM decision_cache_invalidations').fetchone()[0]
+
+  def generation(self):
+    """ :return: The number of invalidations applied so far, to be passed to put() after the webhook call """
+    self._apply_invalidations()
+    return self.invalidations
+
+  def get(self, key):
+    """ :return: The stored response to the request, or None """
+    self._apply_invalidations()
+    entry = self.cache.get(key)
+    if entry is not None and entry[0] <= time.monotonic():
+      self.cache.pop(key)
+      entry = None
+    if entry is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return entry[1]
+
+  def put(self, key, response, ttl_seconds, generation):
+    """ :param generation: generation() when the request was looked up """
+    if ttl_seconds is None:
+      return
+    self._apply_invalidations()
+    with self._invalidations_lock:
+      if self.invalidations != generation:
+        # Invalidated while the webhook decided: the decision may be outdated
+        return
+      self.cache.put(key, (time.monotonic() + min(ttl_seconds, self.max_ttl), response))
+
+  def invalidate(self, sender=None, msg_type=None):
+    """
+    Removes the stored decisions on the requests of the sender and/or of the message type (all decisions if both
+    are None), in all worker processes if the invalidations are shared.
+    """
+    if self._connections is not None:
+      with self._connections.transaction() as connection:
+        connection.execute(
+          'INSERT INTO decision_cache_invalidations (sender, msg_type) VALUES (?, ?)', (sender, msg_type))
+      self._apply_invalidations(force=True)
+    else:
+      with self._invalidations_lock:
+        self._invalidate(sender, msg_type)
+
+  def stats(self):
+    return dict(self.cache.stats(), hits=self.hits, misses=self.misses, invalidations=self.invalidations)
+
+  def _apply_invalidations(self, force=False):
+    if self._connections is None or (not force and time.monotonic() < self._next_invalidations_check):
+      return
+    with self._invalidations_lock:
+      self._next_invalidations_check = time.monotonic() + self.invalidation_check_interval
+      with self._connections.transaction() as connection:
+        invalidations = connection.execute(
+          'SELECT seq, sender, msg_type FROM decision_cache_invalidations WHERE seq > ? ORDER BY seq',
+          (self._invalidations_seq,)).fetchall()
+      for seq, sender, msg_type in invalidations:
+        self._invalidate(sender, msg_type)
+        self._invalidations_seq = seq
+
+  def _invalidate(self, sender, msg_type):
+    self.invalidations += 1
+    self.cache.remove_if(lambda key: (sender is None or key[KEY_SENDER] == sender) and
+                                     (msg_type is None or key[KEY_MSG_TYPE] == msg_type))
@@ -0,0 +1,151 @@
+""" Pool of worker processes performing the CPU-bound DIDComm pack and unpack operations. """
+
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from did_communication_api.did_comm.did_comm import DIDComm
+from did_communication_api.errors import CryptoExecutorBusyError, CryptoExecutorBrokenError
+
+# DIDComm instance of a crypto worker process, created by _init_worker
+_worker_did_comm = None
+
+
+class CryptoExecutor:
+  """
+  Offloads DIDComm pack/unpack jobs to a pool of worker processes.
+
+  Offers the pack/unpack interface of DIDComm, so it can be used in its place by the ApiHandler. Every worker
+  process holds its own DIDComm instance reading the server's secrets store and a DID resolver cache warmed with
+  the given DIDs. At most pool_size + queue_depth jobs are outstanding at any time; further jobs are rejected
+  with CryptoExecutorBusyError.
+
+  The process pool is started lazily in the process using it, so it is never inherited by forked web workers.
+  If a worker process dies (e.g. killed when out of memory), its jobs fail with CryptoExecutorBrokenError and the
+  pool is started again for the next jobs.
+  """
+
+  def __init__(self, secret_resolver_factory, did_cache_size, pool_size=None, queue_depth=64, warm_dids=()):
+    """
+    :param secret_resolver_factory: Function creating a secrets resolver on the server's secrets store
+    :param did_cache_size: Capacity of the DID resolver cache of each worker process
+    :param pool_size: Number of worker processes (default: number of CPUs)
+    :param queue_depth: Number of jobs that may wait for a free worker process
+    :param warm_dids: DIDs resolved by each worker process on start, e.g. the server's DID
+    """
+    self.secret_resolver_factory = secret_resolver_factory
+    self.did_cache_size = did_cache_size
+    self.pool_size = pool_size or os.cpu_count() or 1
+    self.max_outstanding_jobs = self.pool_size + queue_depth
+    self.warm_dids = tuple(warm_dids)
+    self.outstanding_jobs = 0
+    self._lock = threading.Lock()
+    self._executor = None
+    self._executor_pid = None
+
+  def pack(self, msg_body, to, frm, msg_type, msg_id=None, thid=None, attachments=None):
+    return _result(self._submit(_pack_job, msg_body, to, frm, msg_type, msg_id, thid, attachments))
+
+  async def pack_async(self, msg_body, to, frm, msg_type, msg_id=None, thid=None, attachments=None):
+    return await _result_async(self._submit(_pack_job, msg_body, to, frm, msg_type, msg_id, thid, attachments))
+
+  def unpack(self, packed_msg):
+    return _result(self._submit(_unpack_job, packed_msg))
+
+  async def unpack_async(self, packed_msg):
+    return await _result_async(self._submit(_unpack_job, packed_msg))
+
+  def shutdown(self):
+    with self._lock:
+      if self._executor is not None and self._executor_pid == os.getpid():
+        self._executor.shutdown(wait=True)
+      self._executor = None
+
+  def _submit(self, job, *args):
+    with self._lock:
+      if self.outstanding_jobs >= self.max_outstanding_jobs:
+        raise CryptoExecutorBusyError('Crypto executor queue is full')
+      self.outstanding_jobs += 1
+    executor = None
+    try:
+      executor = self._get_executor()
+      future = executor.submit(job, *args)
+    except BrokenProcessPool as error:
+      self._job_done(executor, broken=True)
+      raise CryptoExecutorBrokenError(str(error))
+    except BaseException:
+      self._job_done(executor)
+      raise
+    future.add_done_callback(functools.partial(self._on_job_done, executor))
+    return future
+
+  def _on_job_done(self, executor, future):
+    self._job_done(executor, broken=not future.cancelled() and isinstance(future.exception(), BrokenProcessPool))
+
+  def _job_done(self, executor, broken=False):
+    with self._lock:
+      self.outstanding_jobs -= 1
+      # Discards a broken pool (once), so the next job starts a new one
+      if not broken or executor is None or self._executor is not executor:
+        return
+      self._executor = None
+    logging.error('A crypto executor worker process died. Restarting the process pool')
+    executor.shutdown(wait=False)
+
+  def _get_executor(self):
+    pid = os.getpid()
+    if self._executor is None or self._executor_pid != pid:
+      with self._lock:
+        if self._executor is None or self._executor_pid != pid:
+          self._executor = ProcessPoolExecutor(
+            max_workers=self.pool_size,
+            mp_context=_get_mp_context(),
+            initializer=_init_worker,
+            initargs=(self.secret_resolver_factory, self.did_cache_size, self.warm_dids),
+          )
+          self._executor_pid = pid
+    return self._executor
+
+
+def _result(future):
+  try:
+    return future.result()
+  except BrokenProcessPool as error:
+    raise CryptoExecutorBrokenError(str(error))
+
+
+async def _result_async(future):
+  try:
+    return await asyncio.wrap_future(future)
+  except BrokenProcessPool as error:
+    raise CryptoExecutorBrokenError(str(error))
+
+
+def _get_mp_context():
+  # fork: the workers must not re-import (and thereby re-run) the __main__ module of the service
+  if 'fork' in multiprocessing.get_all_start_methods():
+    return multiprocessing.get_context('fork')
+  return multiprocessing.get_context()
+
+
+def _init_worker(secret_resolver_factory, did_cache_size, warm_dids):
+  global _worker_did_comm
+  # Never use an event loop inherited from the parent process
+  asyncio.set_event_loop(asyncio.new_event_loop())
+  _worker_did_comm = DIDComm(secret_resolver_factory(), did_cache_size=did_cache_size)
+  for did in warm_dids:
+    _worker_did_comm.resolve_peer_did(did)
+
+
+def _pack_job(msg_body, to, frm, msg_type, msg_id, thid, attachments):
+  return _worker_did_comm.pack(msg_body, to, frm, msg_type, msg_id, thid, attachments)
+
+
+def _unpack_job(packed_msg):
+  return _worker_did_comm.unpack(packed_msg)
@@ -2,8 +2,12 @@ import json
 import logging
 
 from didcomm.common.resolvers import ResolversConfig
-from didcomm.core.utils import id_generator_default, get_did
-from didcomm.message import Message
+from didcomm.core.authcrypt import authcrypt
+from didcomm.core.keys.authcrypt_keys_selector import find_authcrypt_pack_sender_and_recipient_keys
+from didcomm.core.serialization import dict_to_json
+from didcomm.core.types import Key
+from didcomm.core.utils import id_generator_default, get_did, extract_key
+from didcomm.message import Message, Attachment
 from didcomm.pack_encrypted import pack_encrypted, PackEncryptedConfig
 from didcomm.secrets.secrets_util import generate_x25519_keys_as_jwk_dict, generate_ed25519_keys_as_jwk_dict, \
   jwk_to_secret
@@ -18,16 +22,17 @@ from peerdid.errors import PeerDIDError
 
 from did_communication_api import utils
 from did_communication_api.errors import MyDIDCommError
-from did_communication_api.did_comm.did_resolver_peer_dids import DIDResolverPeerDID
+from did_communication_api.did_comm.did_resolver_peer_dids import DIDResolverPeerDID, DEFAULT_CACHE_SIZE
 
 
 class DIDComm:
 
-  def __init__(self, secret_resolver):
+  def __init__(self, secret_resolver, did_cache_size=DEFAULT_CACHE_SIZE):
     self.secrets_resolver = secret_resolver
+    self.did_resolver = DIDResolverPeerDID(did_cache_size)
     self.resolvers_config = ResolversConfig(
       secrets_resolver=self.secrets_resolver,
-      did_resolver=DIDResolverPeerDID()
+      did_resolver=self.did_resolver
     )
 
   def create_peer_did(self, service_endpoint):
@@ -68,7 +73,7 @@ class DIDComm:
     )
 
     # 5. Store private keys in the Secret Resolver using the KIDs from the DID DOC
-    did_doc = DIDDocPeerDID.from_json(peer_did.resolve_peer_did(did))
+    did_doc = DIDDocPeerDID.from_json(self.did_resolver.resolve_json(did))
 
     auth_private_key = auth_key[0]
     auth_private_key["kid"] = did_doc.auth_kids[0]
@@ -84,41 +89,55 @@ class DIDComm:
 
     return did
 
-  @staticmethod
-  def resolve_peer_did(did):
+  def resolve_peer_did(self, did):
     try:
-      did_doc_json_string = peer_did.resolve_peer_did(did, format=VerificationMaterialFormatPeerDID.JWK)
+      did_doc_json_string = self.did_resolver.resolve_json(did)
     except PeerDIDError as error:
       logging.warning("Encountered PeerDIDError while resolving peer did: {}".format(str(error)))
       raise MyDIDCommError("Got PeerDID Error when resolving peer did")
     return json.loads(did_doc_json_string)
-    # return peer_did.resolve_peer_did(did, format=VerificationMaterialFormatPeerDID.JWK)
 
-  def pack(self, msg_body, to, frm, msg_type, msg_id=None):
+  def pack(self, msg_body, to, frm, msg_type, msg_id=None, thid=None, attachments=None):
+    return utils.get_or_create_eventloop().run_until_complete(
+      self.pack_async(msg_body, to, frm, msg_type, msg_id, thid, attachments))
+
+  async def pack_async(self, msg_body, to, frm, msg_type, msg_id=None, thid=None, attachments=None):
+    """
+    Packs an authenticated and encrypted DIDComm message.
+
+    :param to: The recipient's DID, or a list of recipient DIDs. A message to several recipients is a single JWE:
+      its content is encrypted once and only the content encryption key is wrapped for every recipient key.
+    :param thid: Optional thread id, e.g. the id of the message this message responds to
+    :param attachments: Optional list of attachments as dicts (the format of the DIDComm spec)
+    :return: The packed message
+    """
     # TODO: Update to configure type, id and body
     if not msg_id:
       msg_id = id_generator_default()
+    recipients = list(dict.fromkeys(to)) if isinstance(to, (list, tuple)) else [to]
     message = Message(
       body=msg_body,
       id=msg_id,
       type=msg_type,
       frm=frm,
-      to=[to],
+      to=recipients,
+      thid=thid,
+      attachments=[Attachment.from_dict(attachment) for attachment in attachments] if attachments else None,
     )
     pack_config = PackEncryptedConfig()
     pack_config.forward = False
+    if len(recipients) > 1:
+      return await self._pack_for_recipients(message, recipients, frm, pack_config)
 
     # Authenticated Encryption without the unnecessary additional signatures:
     try:
-      message_pack_encrypted = utils.get_or_create_eventloop().run_until_complete(
-        pack_encrypted(
-          resolvers_config=self.resolvers_config,
-          message=message,
-          frm=frm,
-          to=to,
-          sign_frm=None,
-          pack_config=pack_config
-        )
+      message_pack_encrypted = await pack_encrypted(
+        resolvers_config=self.resolvers_config,
+        message=message,
+        frm=frm,
+        to=recipients[0],
+        sign_frm=None,
+        pack_config=pack_config
       )
     except DIDCommError as error:
       logging.error("Encountered DIDCommError: {}".format(str(error)))
@@ -126,13 +145,37 @@ class DIDComm:
 
     return message_pack_encrypted.packed_msg
 
+  async def _pack_for_recipients(self, message, recipients, frm, pack_config):
+    """
+    Authcrypts the message for the keys of all recipients at once. pack_encrypted only supports a single recipient
+    DID, so the recipient keys are selected per DID as pack_encrypted does and then encrypted to in one JWE.
+    """
+    try:
+      sender_key = None
+      recipient_keys = []
+      for recipient in recipients:
+        pack_keys = await find_authcrypt_pack_sender_and_recipient_keys(frm, recipient, self.resolvers_config)
+        if sender_key is not None and sender_key.kid != pack_keys.sender_private_key.kid:
+          raise MyDIDCommError('Recipients require different sender keys: {}'.format(recipients))
+        sender_key = pack_keys.sender_private_key
+        recipient_keys.extend(Key(kid=recipient_key.id, key=extract_key(recipient_key))
+                              for recipient_key in pack_keys.recipient_public_keys)
+      encrypt_result = authcrypt(
+        message.as_dict(), recipient_keys, Key(kid=sender_key.kid, key=extract_key(sender_key)),
+        pack_config.enc_alg_auth)
+    except DIDCommError as error:
+      logging.error("Encountered DIDCommError: {}".format(str(error)))
+      raise MyDIDCommError("Unsuccessful packing of message")
+    return dict_to_json(encrypt_result.msg)
+
   def unpack(self, packed_msg):
+    return utils.get_or_create_eventloop().run_until_complete(self.unpack_async(packed_msg))
+
+  async def unpack_async(self, packed_msg):
     try:
-      res = utils.get_or_create_eventloop().run_until_complete(
-        unpack_didcomm(
-          resolvers_config=self.resolvers_config,
-          packed_msg=packed_msg
-        )
+      res = await unpack_didcomm(
+        resolvers_config=self.resolvers_config,
+        packed_msg=packed_msg
       )
     except DIDCommError as error:
       logging.warning("Encountered DIDComm Error when unpacking message: {}".format(str(error)))
@@ -142,7 +185,11 @@ class DIDComm:
       MyDIDCommError("Unsuccessful unpacking of message")
 
     frm = get_did(res.metadata.encrypted_from) if res.metadata.encrypted_from else None
-    to = get_did(res.metadata.encrypted_to[0])
+    to_kids = res.metadata.encrypted_to
+    if len(to_kids) > 1:
+      # Message to several recipients: the recipient is the one whose key is in the secrets store
+      to_kids = await self.secrets_resolver.get_keys(to_kids) or to_kids
+    to = get_did(to_kids[0])
     attachments = []
     if res.message.attachments:
       for attachment in res.message.attachments:
@@ -152,6 +199,7 @@ class DIDComm:
       'frm': frm,
       'to': to,
       'msg_id': res.message.id,
+      'thid': res.message.thid,
       'msg_type': res.message.type,
       'msg_body': res.message.body,
       'attachments': attachments
@@ -1,5 +1,6 @@
 """ Resolver of Peer DIDs. Required for the usage of DIDComm """
 
+import copy
 import json
 from typing import Optional
 
@@ -11,38 +12,70 @@ from peerdid.core.did_doc_types import DIDCommServicePeerDID
 from peerdid.did_doc import DIDDocPeerDID
 from peerdid.types import VerificationMaterialFormatPeerDID
 
+from did_communication_api.lru_cache import LRUCache
+
+DEFAULT_CACHE_SIZE = 1024
+
 
 class DIDResolverPeerDID(DIDResolver):
+  """
+  Resolves Peer DIDs and caches the resolved DID Documents.
+
+  Static Peer DIDs (numalgo 0 and 2) are self-certifying - the DID Document is derived from the DID itself and
+  never changes - so resolved documents are kept in a size-bounded LRU cache without expiry.
+  """
+
+  def __init__(self, cache_size=DEFAULT_CACHE_SIZE):
+    # DID -> (DID Doc JSON string in JWK format, DIDDoc)
+    self.cache = LRUCache(cache_size)
 
   async def resolve(self, did: DID) -> Optional[DIDDoc]:
+    _, did_doc = self._resolve_cached(did)
+    # DIDDoc objects are mutable - never hand out the cached instance
+    return copy.deepcopy(did_doc)
+
+  def resolve_json(self, did: DID) -> str:
+    """ Resolves the DID Document of the given Peer DID as JSON string with keys in JWK format. """
+    did_doc_json, _ = self._resolve_cached(did)
+    return did_doc_json
+
+  def _resolve_cached(self, did):
+    cached = self.cache.get(did)
+    if cached is not None:
+      return cached
+
     # request DID Doc in JWK format
     did_doc_json = peer_did.resolve_peer_did(did, format=VerificationMaterialFormatPeerDID.JWK)
-    did_doc = DIDDocPeerDID.from_json(did_doc_json)
-
-    return DIDDoc(
-      did=did_doc.did,
-      key_agreement_kids=did_doc.agreement_kids,
-      authentication_kids=did_doc.auth_kids,
-      verification_methods=[
-        VerificationMethod(
-          id=m.id,
-          type=VerificationMethodType.JSON_WEB_KEY_2020,
-          controller=m.controller,
-          verification_material=VerificationMaterial(
-            format=VerificationMaterialFormat.JWK,
-            value=json.dumps(m.ver_material.value)
-          )
-        )
-        for m in did_doc.authentication + did_doc.key_agreement
-      ],
-      didcomm_services=[
-        DIDCommService(
-          id=s.id,
-          service_endpoint=s.service_endpoint,
-          routing_keys=s.routing_keys,
-          accept=s.accept
+    resolved = (did_doc_json, _to_didcomm_did_doc(DIDDocPeerDID.from_json(did_doc_json)))
+    self.cache.put(did, resolved)
+    return resolved
+
+
+def _to_didcomm_did_doc(did_doc):
+  return DIDDoc(
+    did=did_doc.did,
+    key_agreement_kids=did_doc.agreement_kids,
+    authentication_kids=did_doc.auth_kids,
+    verification_methods=[
+      VerificationMethod(
+        id=m.id,
+        type=VerificationMethodType.JSON_WEB_KEY_2020,
+        controller=m.controller,
+        verification_material=VerificationMaterial(
+          format=VerificationMaterialFormat.JWK,
+          value=json.dumps(m.ver_material.value)
         )
-        for s in did_doc.service
-        if isinstance(s, DIDCommServicePeerDID)
-      ] if did_doc.service else []
-    )
+      )
+      for m in did_doc.authentication + did_doc.key_agreement
+    ],
+    didcomm_services=[
+      DIDCommService(
+        id=s.id,
+        service_endpoint=s.service_endpoint,
+        routing_keys=s.routing_keys,
+        accept=s.accept
+      )
+      for s in did_doc.service
+      if isinstance(s, DIDCommServicePeerDID)
+    ] if did_doc.service else []
+  )
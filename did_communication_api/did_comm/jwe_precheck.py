@@ -0,0 +1,119 @@
+"""
+Cheap structural validation of packed (JWE) DIDComm messages before they are unpacked.
+
+Messages that cannot be decrypted by this server anyway - no JWE, unsupported algorithms, no recipient key of this
+server, malformed sender key id, too many recipients or too large ciphertext - are rejected without DID resolution,
+secrets lookups or cryptographic operations.
+"""
+
+import base64
+import binascii
+import json
+import threading
+import time
+
+from peerdid.peer_did import is_peer_did
+
+# Reject reasons
+REJECT_MALFORMED = 'malformed'
+REJECT_UNSUPPORTED_ALGORITHM = 'unsupported_algorithm'
+REJECT_TOO_MANY_RECIPIENTS = 'too_many_recipients'
+REJECT_CIPHERTEXT_TOO_LARGE = 'ciphertext_too_large'
+REJECT_UNKNOWN_RECIPIENT = 'unknown_recipient'
+REJECT_INVALID_SENDER = 'invalid_sender'
+
+# (alg, enc) of the DIDComm authcrypt and anoncrypt algorithms
+AUTHCRYPT_ALGORITHMS = {('ECDH-1PU+A256KW', 'A256CBC-HS512')}
+ANONCRYPT_ALGORITHMS = {
+  ('ECDH-ES+A256KW', 'A256CBC-HS512'),
+  ('ECDH-ES+A256KW', 'XC20P'),
+  ('ECDH-ES+A256KW', 'A256GCM'),
+}
+
+JWE_MEMBERS = ('protected', 'recipients', 'iv', 'ciphertext', 'tag')
+
+
+class JWEPreCheck:
+
+  def __init__(self, list_kids, max_recipients=16, max_ciphertext_size=10485760, kid_refresh_interval=5.0,
+               owns_kid=None):
+    """
+    :param list_kids: Function returning the kids of all keys of the secrets store
+    :param max_recipients: Maximum number of recipients of a message
+    :param max_ciphertext_size: Maximum length of the (base64url) ciphertext of a message
+    :param kid_refresh_interval: Minimum time in seconds between two reloads of the kids after an unknown kid
+    :param owns_kid: Function returning True iff a kid not (yet) reloaded from the secrets store belongs to this
+      server, e.g. to a server DID of a tenant created since the last reload
+    """
+    self.list_kids = list_kids
+    self.max_recipients = max_recipients
+    self.max_ciphertext_size = max_ciphertext_size
+    self.kid_refresh_interval = kid_refresh_interval
+    self.owns_kid = owns_kid
+    self._kids = frozenset()
+    self._next_kid_refresh = 0.0
+    self._kids_lock = threading.Lock()
+
+  def check(self, packed_msg):
+    """
+    :param packed_msg: The packed DIDComm message (JSON string)
+    :return: None if the message may be unpacked, otherwise the reason to reject it
+    """
+    if not isinstance(packed_msg, str) or not packed_msg.lstrip().startswith('{'):
+      return REJECT_MALFORMED
+    try:
+      jwe = json.loads(packed_msg)
+    except ValueError:
+      return REJECT_MALFORMED
+    if not isinstance(jwe, dict) or not all(isinstance(jwe.get(member), (str, list)) for member in JWE_MEMBERS):
+      return REJECT_MALFORMED
+
+    recipients = jwe['recipients']
+    if not isinstance(recipients, list) or not recipients:
+      return REJECT_MALFORMED
+    if len(recipients) > self.max_recipients:
+      return REJECT_TOO_MANY_RECIPIENTS
+    if not isinstance(jwe['ciphertext'], str) or len(jwe['ciphertext']) > self.max_ciphertext_size:
+      return REJECT_CIPHERTEXT_TOO_LARGE
+
+    protected_header = _decode_protected_header(jwe['protected'])
+    if protected_header is None:
+      return REJECT_MALFORMED
+    algorithm = (protected_header.get('alg'), protected_header.get('enc'))
+    if algorithm not in AUTHCRYPT_ALGORITHMS and algorithm not in ANONCRYPT_ALGORITHMS:
+      return REJECT_UNSUPPORTED_ALGORITHM
+
+    if algorithm in AUTHCRYPT_ALGORITHMS:
+      skid = protected_header.get('skid')
+      if not isinstance(skid, str) or not is_peer_did(skid.split('#')[0]):
+        return REJECT_INVALID_SENDER
+
+    headers = [recipient.get('header') for recipient in recipients if isinstance(recipient, dict)]
+    kids = [header.get('kid') for header in headers if isinstance(header, dict)]
+    if not any(isinstance(kid, str) and self._is_known_kid(kid) for kid in kids):
+      return REJECT_UNKNOWN_RECIPIENT
+    return None
+
+  def _is_known_kid(self, kid):
+    if kid in self._kids:
+      return True
+    # Keys may have been added since the last reload (e.g. by another worker process).
+    # Checked under the lock, so a request does not miss a reload in progress.
+    with self._kids_lock:
+      now = time.monotonic()
+      if kid not in self._kids and now >= self._next_kid_refresh:
+        self._next_kid_refresh = now + self.kid_refresh_interval
+        self._kids = frozenset(self.list_kids())
+      if kid in self._kids:
+        return True
+    return self.owns_kid is not None and self.owns_kid(kid)
+
+
+def _decode_protected_header(protected):
+  if not isinstance(protected, str):
+    return None
+  try:
+    protected_header = json.loads(base64.urlsafe_b64decode(protected + '=' * (-len(protected) % 4)))
+  except (binascii.Error, ValueError):
+    return None
+  return protected_header if isinstance(protected_header, dict) else None
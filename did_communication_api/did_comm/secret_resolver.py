@@ -2,6 +2,8 @@
 
 import json
 import logging
+import os
+import tempfile
 
 from multiprocessing import Lock
 from pathlib import Path
@@ -16,9 +18,21 @@ lock = Lock()
 
 
 class SecretsResolverLocal(SecretsResolverEditable):
+  """
+  Keeps an in-memory kid -> Secret index of the secrets file.
+
+  The index is loaded once and re-loaded only when the file's version changes. The version of the file is
+  its (inode, mtime, size) signature: every write replaces the file atomically with a new one, so a change
+  made by another worker process is noticed with a single stat() call.
+  """
 
   def __init__(self, file_path="secrets.json"):
     self.file_path = file_path
+    # Tuple of (file version, kid -> Secret dict). Always replaced as a whole so readers never see a mix.
+    self._index = (None, {})
+    # Lookups answered from the in-memory index (hits) and lookups which had to re-load the file (misses)
+    self.hits = 0
+    self.misses = 0
     self._init_secrets_file()
 
   def _init_secrets_file(self):
@@ -34,23 +48,60 @@ class SecretsResolverLocal(SecretsResolverEditable):
       logging.info('Releasing lock')
       lock.release()
 
+  def _file_version(self):
+    try:
+      file_stat = os.stat(self.file_path)
+    except FileNotFoundError:
+      return None
+    return _stat_version(file_stat)
+
   def _read_secrets(self):
     with open(self.file_path) as f:
+      version = _stat_version(os.fstat(f.fileno()))
       try:
         jwk_keys = json.load(f)
       except json.decoder.JSONDecodeError:
         jwk_keys = []
-      return {jwk_key["kid"]: jwk_to_secret(jwk_key) for jwk_key in jwk_keys}
+      return version, {jwk_key["kid"]: jwk_to_secret(jwk_key) for jwk_key in jwk_keys}
 
   def _write_secrets(self, secrets_dict):
-    with open(self.file_path, 'w') as f:
-      secrets_as_jwk = [secret_to_jwk_dict(s) for s in secrets_dict.values()]
-      json.dump(secrets_as_jwk, f)
+    """ Writes the secrets to a temporary file and atomically renames it over the secrets file. """
+    directory = os.path.dirname(os.path.abspath(self.file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.secrets-', suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'w') as f:
+        secrets_as_jwk = [secret_to_jwk_dict(s) for s in secrets_dict.values()]
+        json.dump(secrets_as_jwk, f)
+        f.flush()
+        os.fsync(f.fileno())
+        # The rename keeps inode, mtime and size, so this is the version of the new secrets file
+        version = _stat_version(os.fstat(f.fileno()))
+      os.replace(tmp_path, self.file_path)
+    except BaseException:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      raise
+    return version
+
+  def _secrets(self):
+    """ Returns the kid -> Secret index, re-loading it only if the secrets file has changed. """
+    version, secrets_dict = self._index
+    if version is None or version != self._file_version():
+      self.misses += 1
+      self._index = self._read_secrets()
+      version, secrets_dict = self._index
+    else:
+      self.hits += 1
+    return secrets_dict
+
+  def stats(self):
+    return {'size': len(self._index[1]), 'hits': self.hits, 'misses': self.misses}
 
   def _save_new_secret(self, secret):
-    secrets_dict = self._read_secrets()
+    secrets_dict = dict(self._secrets())
     secrets_dict[secret.kid] = secret
-    self._write_secrets(secrets_dict)
+    version = self._write_secrets(secrets_dict)
+    self._index = (version, secrets_dict)
 
   async def add_key(self, secret: Secret):
     lock.acquire()
@@ -59,29 +110,39 @@ class SecretsResolverLocal(SecretsResolverEditable):
     finally:
       lock.release()
 
-  async def get_kids(self) -> List[str]:
+  def retain_dids(self, live_dids, dry_run=False):
+    """
+    Compacts the secrets store: removes all keys that do not belong to one of the live DIDs.
+
+    :param live_dids: DIDs whose keys are kept
+    :param dry_run: If True, only determine the keys that would be removed
+    :return: List of the kids of the removed keys
+    """
     lock.acquire()
     try:
-      secrets_dict = self._read_secrets()
-      res = list(secrets_dict.keys())
+      secrets_dict = self._secrets()
+      retained = {kid: secret for kid, secret in secrets_dict.items() if kid.split('#')[0] in live_dids}
+      removed_kids = [kid for kid in secrets_dict if kid not in retained]
+      if removed_kids and not dry_run:
+        version = self._write_secrets(retained)
+        self._index = (version, retained)
+      return removed_kids
     finally:
       lock.release()
-    return res
+
+  def list_kids(self) -> List[str]:
+    return list(self._secrets().keys())
+
+  async def get_kids(self) -> List[str]:
+    return self.list_kids()
 
   async def get_key(self, kid: DID_URL) -> Optional[Secret]:
-    lock.acquire()
-    try:
-      secrets_dict = self._read_secrets()
-      res = secrets_dict.get(kid)
-    finally:
-      lock.release()
-    return res
+    return self._secrets().get(kid)
 
   async def get_keys(self, kids: List[DID_URL]) -> List[DID_URL]:
-    lock.acquire()
-    try:
-      secrets_dict = self._read_secrets()
-      res = [s.kid for s in secrets_dict.values() if s.kid in kids]
-    finally:
-      lock.release()
-    return res
+    secrets_dict = self._secrets()
+    return [kid for kid in kids if kid in secrets_dict]
+
+
+def _stat_version(file_stat):
+  return file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size
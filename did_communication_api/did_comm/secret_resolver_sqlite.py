@@ -0,0 +1,134 @@
+""" Secret (Private Key) Resolver storing private keys in an indexed SQLite database. """
+
+import json
+import logging
+import os
+import threading
+
+from typing import List, Optional
+
+from didcomm.common.types import DID_URL
+from didcomm.secrets.secrets_resolver import Secret
+from didcomm.secrets.secrets_resolver_editable import SecretsResolverEditable
+from didcomm.secrets.secrets_util import jwk_to_secret, secret_to_jwk_dict
+from peewee import Model, SqliteDatabase, TextField, chunked
+
+# Rows per statement when inserting or deleting many keys (below SQLite's limit of host parameters)
+BATCH_SIZE = 400
+
+
+def _secret_model(db):
+  class StoredSecret(Model):
+    kid = TextField(primary_key=True)
+    jwk = TextField()
+
+    class Meta:
+      database = db
+      table_name = 'secrets'
+
+  return StoredSecret
+
+
+class SecretsResolverSQLite(SecretsResolverEditable):
+  """
+  Stores every private key as one row (JWK) keyed by its kid.
+
+  Lookups are primary key queries, so their cost does not grow with the number of stored keys, and adding a key
+  writes a single row. The database runs in WAL mode, so readers in other processes are not blocked by writers.
+  Every process uses its own connection; connections are never shared with forked child processes.
+  """
+
+  def __init__(self, file_path="secrets.db"):
+    self.file_path = file_path
+    self._databases = {}
+    self._databases_lock = threading.Lock()
+    database, model, lock = self._get_database()
+    with lock:
+      database.create_tables([model], safe=True)
+
+  def count_keys(self):
+    database, model, lock = self._get_database()
+    with lock:
+      return model.select().count()
+
+  def import_json(self, json_file_path):
+    """
+    Migrates the keys of a secrets file of SecretsResolverLocal. Keys whose kid is already stored are skipped.
+
+    :param json_file_path: The secrets file (JSON array of JWKs)
+    :return: Number of keys in the secrets file
+    """
+    with open(json_file_path) as f:
+      try:
+        jwk_keys = json.load(f)
+      except json.decoder.JSONDecodeError:
+        jwk_keys = []
+    rows = [{'kid': jwk_key['kid'], 'jwk': json.dumps(jwk_key)} for jwk_key in jwk_keys]
+    database, model, lock = self._get_database()
+    with lock, database.atomic():
+      for batch in chunked(rows, BATCH_SIZE):
+        model.insert_many(batch).on_conflict_ignore().execute()
+    return len(rows)
+
+  def retain_dids(self, live_dids, dry_run=False):
+    """
+    Compacts the secrets store: removes all keys that do not belong to one of the live DIDs.
+
+    :param live_dids: DIDs whose keys are kept
+    :param dry_run: If True, only determine the keys that would be removed
+    :return: List of the kids of the removed keys
+    """
+    database, model, lock = self._get_database()
+    with lock, database.atomic():
+      removed_kids = [kid for (kid,) in model.select(model.kid).tuples() if kid.split('#')[0] not in live_dids]
+      if not dry_run:
+        for batch in chunked(removed_kids, BATCH_SIZE):
+          model.delete().where(model.kid.in_(batch)).execute()
+    return removed_kids
+
+  async def add_key(self, secret: Secret):
+    database, model, lock = self._get_database()
+    with lock:
+      model.replace(kid=secret.kid, jwk=json.dumps(secret_to_jwk_dict(secret))).execute()
+
+  def list_kids(self) -> List[str]:
+    database, model, lock = self._get_database()
+    with lock:
+      return [row[0] for row in database.execute_sql('SELECT kid FROM secrets').fetchall()]
+
+  async def get_kids(self) -> List[str]:
+    return self.list_kids()
+
+  # The lookups of the unpack/pack hot path use plain SQL: building the peewee query costs more than running it
+
+  async def get_key(self, kid: DID_URL) -> Optional[Secret]:
+    database, model, lock = self._get_database()
+    with lock:
+      row = database.execute_sql('SELECT jwk FROM secrets WHERE kid = ?', (kid,)).fetchone()
+    return jwk_to_secret(json.loads(row[0])) if row else None
+
+  async def get_keys(self, kids: List[DID_URL]) -> List[DID_URL]:
+    if not kids:
+      return []
+    database, model, lock = self._get_database()
+    with lock:
+      rows = database.execute_sql(
+        'SELECT kid FROM secrets WHERE kid IN ({})'.format(', '.join('?' * len(kids))), kids).fetchall()
+    stored_kids = {row[0] for row in rows}
+    return [kid for kid in kids if kid in stored_kids]
+
+  def _get_database(self):
+    # One connection (and lock) per process, shared by the threads of the process
+    pid = os.getpid()
+    database = self._databases.get(pid)
+    if database is None:
+      with self._databases_lock:
+        database = self._databases.get(pid)
+        if database is None:
+          sqlite_database = SqliteDatabase(
+            self.file_path, thread_safe=False, check_same_thread=False, timeout=30,
+            pragmas={'journal_mode': 'wal', 'synchronous': 'normal'})
+          database = (sqlite_database, _secret_model(sqlite_database), threading.Lock())
+          self._databases[pid] = database
+          logging.info('Opened secrets database: {}'.format(self.file_path))
+    return database
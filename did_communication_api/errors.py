@@ -9,3 +9,38 @@ class DIDCommAPIError(Exception):
 class MyDIDCommError(DIDCommAPIError):
   """ Base exception class for errors when using the DID Comm Implementation """
   pass
+
+
+class ConfigurationError(DIDCommAPIError):
+  """ Raised when the service configuration is missing, cannot be parsed or is invalid """
+  pass
+
+
+class OutboxFullError(DIDCommAPIError):
+  """ Raised when the outbound send queue is full and no further messages are accepted """
+  pass
+
+
+class CryptoExecutorBusyError(DIDCommAPIError):
+  """ Raised when the queue of the crypto executor is full and no further pack/unpack jobs are accepted """
+  pass
+
+
+class CryptoExecutorBrokenError(CryptoExecutorBusyError):
+  """ Raised when a worker process of the crypto executor died; the pool is restarted for further jobs """
+  pass
+
+
+class UnsupportedContentEncodingError(DIDCommAPIError):
+  """ Raised when a request body is compressed with a Content-Encoding this service does not support """
+  pass
+
+
+class DecompressionError(DIDCommAPIError):
+  """ Raised when a compressed request body cannot be decompressed """
+  pass
+
+
+class DecompressedBodyTooLargeError(DecompressionError):
+  """ Raised when a compressed request body decompresses to more than the allowed size (decompression bomb) """
+  pass
@@ -0,0 +1,26 @@
+"""
+gunicorn server hooks, used with: gunicorn -c python:did_communication_api.gunicorn_config ...
+"""
+
+import sys
+
+
+def post_worker_init(worker):
+  from did_communication_api import app_configurer, configuration
+  from did_communication_api.__main__ import api_handler, did_comm, server_did
+  from did_communication_api.prewarm import prewarm_worker
+
+  # gunicorn has reset the signal handlers of the worker process: SIGHUP to a worker reloads its configuration
+  configuration.install_reload_signal_handler()
+  # Background threads run in the worker processes only, the master process forks them
+  app_configurer.start_worker_threads(api_handler)
+  # Pre-warms every worker process after fork, before it accepts requests
+  prewarm_worker(did_comm, api_handler.did_comm, server_did,
+                 asynchronous='did_communication_api.asgi' in sys.modules)
+
+
+def child_exit(server, worker):
+  from did_communication_api import metrics
+
+  # Called in the master process for every exited worker, also for workers killed on timeout
+  metrics.mark_process_dead(worker.pid)
@@ -0,0 +1,71 @@
+""" Thread-safe, size-bounded LRU cache with hit/miss/eviction counters. """
+
+import threading
+
+from collections import OrderedDict
+
+
+class LRUCache:
+
+  def __init__(self, capacity):
+    """
+    :param capacity: Maximum number of entries. A capacity of 0 disables the cache.
+    """
+    self.capacity = max(0, int(capacity))
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        value = self._entries[key]
+      except KeyError:
+        self.misses += 1
+        return default
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    if not self.capacity:
+      return
+    with self._lock:
+      self._entries[key] = value
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.capacity:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+
+  def pop(self, key, default=None):
+    with self._lock:
+      return self._entries.pop(key, default)
+
+  def remove_if(self, predicate):
+    """ Removes the entries whose key satisfies predicate(key). :return: The number of removed entries """
+    with self._lock:
+      keys = [key for key in self._entries if predicate(key)]
+      for key in keys:
+        del self._entries[key]
+    return len(keys)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def stats(self):
+    return {
+      'size': len(self._entries),
+      'capacity': self.capacity,
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions
+    }
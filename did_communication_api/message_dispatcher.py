@@ -0,0 +1,115 @@
+""" Background dispatcher delivering queued requests to the webhook (asynchronous delivery mode). """
+
+import logging
+import os
+import threading
+import time
+
+from did_communication_api.errors import MyDIDCommError
+
+# Seconds between two deletions of expired responses by the dispatcher of a worker process
+PRUNE_INTERVAL = 60
+
+
+class MessageDispatcher:
+  """
+  Drains the MessageQueue in a background thread of the current process: notifies the webhook of every queued
+  request and stores the packed response for pickup by the sender. Requests whose webhook notification failed are
+  retried with exponential backoff; after max_attempts the sender gets an Internal Server Error response.
+  Requests failing otherwise (unexpected errors) are retried as well and discarded after max_attempts.
+  Responses not picked up within the response TTL of the queue are deleted every PRUNE_INTERVAL seconds.
+
+  The thread is started in the worker processes (see app_configurer.start_worker_threads) or on the first enqueued
+  request, never in the gunicorn master process, which would fork with it running.
+  """
+
+  def __init__(self, api_handler, message_queue, poll_interval=0.5, batch_size=10, max_attempts=5):
+    self.api_handler = api_handler
+    self.message_queue = message_queue
+    self.poll_interval = poll_interval
+    self.batch_size = batch_size
+    self.max_attempts = max_attempts
+    self._thread_pid = None
+    self._next_prune = 0.0
+    self._wakeup = threading.Event()
+    self._lock = threading.Lock()
+
+  def ensure_started(self):
+    """ Starts the dispatcher thread of the current process, unless it is already running. """
+    if self._thread_pid == os.getpid():
+      return
+    with self._lock:
+      if self._thread_pid != os.getpid():
+        self._wakeup = threading.Event()
+        threading.Thread(target=self._run, name='message-dispatcher', daemon=True).start()
+        self._thread_pid = os.getpid()
+        logging.info('Message dispatcher started')
+
+  def notify(self):
+    """ Wakes up the dispatcher of the current process, e.g. after a request was enqueued. """
+    self.ensure_started()
+    self._wakeup.set()
+
+  def _run(self):
+    while True:
+      try:
+        dispatched = self.dispatch_queued_requests()
+        self._prune_responses()
+      except Exception:
+        logging.exception('Unexpected error in message dispatcher')
+        dispatched = 0
+      if not dispatched:
+        self._wakeup.wait(self.poll_interval)
+        self._wakeup.clear()
+
+  def dispatch_queued_requests(self):
+    """ :return: Number of claimed requests """
+    queued_requests = self.message_queue.claim_requests(self.batch_size)
+    for queued_request in queued_requests:
+      try:
+        self._dispatch(queued_request)
+      except Exception:
+        self._dispatch_failed(queued_request)
+    return len(queued_requests)
+
+  def _prune_responses(self):
+    if time.monotonic() < self._next_prune:
+      return
+    self._next_prune = time.monotonic() + PRUNE_INTERVAL
+    pruned = self.message_queue.prune_responses()
+    if pruned:
+      logging.info('Deleted {} responses which were not picked up in time'.format(pruned))
+
+  def _dispatch(self, queued_request):
+    give_up = queued_request.attempts >= self.max_attempts
+    try:
+      packed_response = self.api_handler.dispatch_queued_request(queued_request, give_up=give_up)
+    except MyDIDCommError:
+      logging.error('Could not pack the response to queued request {}. Discarding request'.format(queued_request.id))
+      self.message_queue.discard_request(queued_request.id)
+      return
+    if packed_response is None:
+      delay = _retry_delay(queued_request.attempts)
+      logging.warning('Webhook notification of queued request {} failed (attempt {}). Retrying in {}s'.format(
+        queued_request.id, queued_request.attempts, delay))
+      self.message_queue.retry_request(queued_request.id, delay)
+      return
+    dropped = self.message_queue.complete_request(queued_request.id, queued_request.sender, packed_response)
+    if dropped:
+      logging.warning('Too many responses waiting for pickup by {}. Deleted the {} oldest'.format(
+        queued_request.sender, dropped))
+
+  def _dispatch_failed(self, queued_request):
+    if queued_request.attempts >= self.max_attempts:
+      logging.exception('Could not dispatch queued request {} (attempt {}). Discarding request'.format(
+        queued_request.id, queued_request.attempts))
+      self.message_queue.discard_request(queued_request.id)
+      return
+    delay = _retry_delay(queued_request.attempts)
+    logging.exception('Could not dispatch queued request {} (attempt {}). Retrying in {}s'.format(
+      queued_request.id, queued_request.attempts, delay))
+    self.message_queue.retry_request(queued_request.id, delay)
+
+
+def _retry_delay(attempts):
+  return min(2 ** attempts, 300)
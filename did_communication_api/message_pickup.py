@@ -0,0 +1,94 @@
+""" DIDComm Message Pickup protocol (3.0) for responses stored in the asynchronous delivery mode. """
+
+import base64
+import logging
+
+from did_communication_api import constants, utils
+from did_communication_api.errors import MyDIDCommError, CryptoExecutorBusyError
+
+DEFAULT_DELIVERY_LIMIT = 10
+
+
+class MessagePickupHandler:
+  """
+  Lets clients collect the packed responses to their queued requests.
+
+  Supported messages (sent as authenticated and encrypted DIDComm messages):
+  - status-request: answered with a status message containing the number of waiting responses
+  - delivery-request (body: {'limit': <n>}): answered with a delivery message with up to limit responses as
+    attachments (attachment id: id of the stored response), or with a status message if there are none
+  - messages-received (body: {'message_id_list': [<attachment id>, ...]}): deletes the received responses and is
+    answered with a status message
+  Only the authenticated sender of a pickup message can collect the responses addressed to it.
+  """
+
+  def __init__(self, did_comm, server_did, message_queue, max_delivery_limit=100):
+    self.did_comm = did_comm
+    self.server_did = server_did
+    self.message_queue = message_queue
+    self.max_delivery_limit = max_delivery_limit
+
+  def handle_pickup_message(self, didcomm_packed_msg):
+    try:
+      message_unpacked_dict = self.did_comm.unpack(didcomm_packed_msg)
+    except MyDIDCommError:
+      logging.warning(constants.INVALID_REQUEST_RECEIVED.format("Could not decrypt/authenticate Pickup Message"))
+      return utils.generate_err_resp('Invalid DIDComm Message', constants.HTTP_BAD_REQUEST)
+    except CryptoExecutorBusyError:
+      return utils.generate_err_resp('Service Unavailable', constants.HTTP_SERVICE_UNAVAILABLE)
+
+    recipient = message_unpacked_dict['frm']
+    if not recipient:
+      return utils.generate_err_resp('Pickup Messages must be authenticated', constants.HTTP_BAD_REQUEST)
+
+    msg_type = message_unpacked_dict['msg_type']
+    msg_body = message_unpacked_dict['msg_body'] or {}
+    if msg_type == constants.MESSAGE_PICKUP_STATUS_REQUEST_MSG_TYPE:
+      response = self._status(recipient)
+    elif msg_type == constants.MESSAGE_PICKUP_DELIVERY_REQUEST_MSG_TYPE:
+      response = self._delivery(recipient, msg_body.get('limit'))
+    elif msg_type == constants.MESSAGE_PICKUP_MESSAGES_RECEIVED_MSG_TYPE:
+      message_ids = msg_body.get('message_id_list')
+      if isinstance(message_ids, list):
+        self.message_queue.delete_responses(recipient, [str(message_id) for message_id in message_ids])
+      response = self._status(recipient)
+    else:
+      logging.warning(constants.INVALID_REQUEST_RECEIVED.format(f'Unsupported Pickup Message type: {msg_type}'))
+      return utils.generate_err_resp('Unsupported Message Type', constants.HTTP_BAD_REQUEST)
+
+    try:
+      response_message_encrypted = self.did_comm.pack(
+        to=recipient, frm=self.server_did, thid=utils.reply_thread_id(message_unpacked_dict), **response)
+    except CryptoExecutorBusyError:
+      return utils.generate_err_resp('Service Unavailable', constants.HTTP_SERVICE_UNAVAILABLE)
+    return {'didcomm_msg': response_message_encrypted}, constants.HTTP_SUCCESS_STATUS
+
+  def _status(self, recipient):
+    return {
+      'msg_type': constants.MESSAGE_PICKUP_STATUS_MSG_TYPE,
+      'msg_body': {
+        'message_count': self.message_queue.count_responses(recipient),
+        'live_delivery': False
+      }
+    }
+
+  def _delivery(self, recipient, limit):
+    try:
+      limit = max(1, min(int(limit), self.max_delivery_limit))
+    except (TypeError, ValueError):
+      limit = DEFAULT_DELIVERY_LIMIT
+    responses = self.message_queue.fetch_responses(recipient, limit)
+    if not responses:
+      return self._status(recipient)
+    return {
+      'msg_type': constants.MESSAGE_PICKUP_DELIVERY_MSG_TYPE,
+      'msg_body': {},
+      'attachments': [
+        {
+          'id': response_id,
+          'media_type': constants.DIDCOMM_ENCRYPTED_MEDIA_TYPE,
+          'data': {'base64': base64.urlsafe_b64encode(packed_msg.encode('utf-8')).decode('ascii')}
+        }
+        for response_id, packed_msg in responses
+      ]
+    }
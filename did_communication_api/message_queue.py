@@ -0,0 +1,145 @@
+""" Durable local queue (SQLite in WAL mode) of received requests and of packed responses awaiting pickup. """
+
+import json
+import time
+import uuid
+
+from did_communication_api.sqlite_connections import SQLiteConnections
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS received_requests (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  sender TEXT NOT NULL,
+  http_method TEXT NOT NULL,
+  message TEXT NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  available_at REAL NOT NULL,
+  created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS received_requests_available_at ON received_requests (available_at);
+CREATE TABLE IF NOT EXISTS pending_responses (
+  id TEXT PRIMARY KEY,
+  recipient TEXT NOT NULL,
+  packed_msg TEXT NOT NULL,
+  created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pending_responses_recipient ON pending_responses (recipient, created_at);
+CREATE INDEX IF NOT EXISTS pending_responses_created_at ON pending_responses (created_at);
+"""
+
+
+class QueuedRequest:
+
+  def __init__(self, request_id, sender, http_method, message, attempts):
+    self.id = request_id
+    self.sender = sender
+    self.http_method = http_method
+    self.message = message
+    self.attempts = attempts
+
+
+class MessageQueue:
+  """
+  Persists received (unpacked) requests until the dispatcher delivered them to the webhook, and the packed
+  responses until their recipients picked them up.
+
+  Requests are claimed with a lease, so several dispatchers (e.g. one per worker process) can drain the queue
+  concurrently and a request claimed by a crashed dispatcher becomes available again after the lease expired.
+
+  Responses which are never picked up are bounded: every recipient keeps its max_responses_per_recipient newest
+  responses, and prune_responses() deletes the responses older than response_ttl seconds.
+  """
+
+  def __init__(self, file_path, lease_seconds=60, response_ttl=604800, max_responses_per_recipient=1000):
+    self.file_path = file_path
+    self.lease_seconds = lease_seconds
+    self.response_ttl = response_ttl
+    self.max_responses_per_recipient = max_responses_per_recipient
+    self._connections = SQLiteConnections(file_path)
+    connection, lock = self._connections.get()
+    with lock:
+      connection.executescript(SCHEMA)
+
+  def enqueue_request(self, sender, http_method, message):
+    """
+    :param message: The unpacked message (dict as returned by DIDComm.unpack)
+    :return: The id of the queued request
+    """
+    now = time.time()
+    with self._transaction() as connection:
+      cursor = connection.execute(
+        'INSERT INTO received_requests (sender, http_method, message, available_at, created_at) '
+        'VALUES (?, ?, ?, ?, ?)',
+        (sender, http_method, json.dumps(message), now, now))
+      return cursor.lastrowid
+
+  def claim_requests(self, limit):
+    """ Claims up to limit available requests for the duration of the lease. """
+    now = time.time()
+    with self._transaction(immediate=True) as connection:
+      rows = connection.execute(
+        'SELECT id, sender, http_method, message, attempts FROM received_requests '
+        'WHERE available_at <= ? ORDER BY id LIMIT ?', (now, limit)).fetchall()
+      connection.executemany(
+        'UPDATE received_requests SET available_at = ?, attempts = attempts + 1 WHERE id = ?',
+        [(now + self.lease_seconds, row[0]) for row in rows])
+    return [QueuedRequest(row[0], row[1], row[2], json.loads(row[3]), row[4] + 1) for row in rows]
+
+  def retry_request(self, request_id, delay):
+    with self._transaction() as connection:
+      connection.execute(
+        'UPDATE received_requests SET available_at = ? WHERE id = ?', (time.time() + delay, request_id))
+
+  def discard_request(self, request_id):
+    with self._transaction() as connection:
+      connection.execute('DELETE FROM received_requests WHERE id = ?', (request_id,))
+
+  def complete_request(self, request_id, recipient, packed_response):
+    """
+    Removes the request from the queue and stores the packed response for pickup by the recipient.
+
+    :return: Number of older responses of the recipient deleted to stay within max_responses_per_recipient
+    """
+    with self._transaction() as connection:
+      connection.execute('DELETE FROM received_requests WHERE id = ?', (request_id,))
+      connection.execute(
+        'INSERT INTO pending_responses (id, recipient, packed_msg, created_at) VALUES (?, ?, ?, ?)',
+        (uuid.uuid4().hex, recipient, packed_response, time.time()))
+      return connection.execute(
+        'DELETE FROM pending_responses WHERE id IN (SELECT id FROM pending_responses WHERE recipient = ? '
+        'ORDER BY created_at DESC LIMIT -1 OFFSET ?)', (recipient, self.max_responses_per_recipient)).rowcount
+
+  def prune_responses(self):
+    """
+    Deletes the responses older than response_ttl seconds, e.g. of senders who never pick up their responses.
+
+    :return: Number of deleted responses
+    """
+    with self._transaction() as connection:
+      return connection.execute(
+        'DELETE FROM pending_responses WHERE created_at < ?', (time.time() - self.response_ttl,)).rowcount
+
+  def count_requests(self):
+    with self._transaction() as connection:
+      return connection.execute('SELECT COUNT(*) FROM received_requests').fetchone()[0]
+
+  def count_responses(self, recipient):
+    with self._transaction() as connection:
+      return connection.execute(
+        'SELECT COUNT(*) FROM pending_responses WHERE recipient = ?', (recipient,)).fetchone()[0]
+
+  def fetch_responses(self, recipient, limit):
+    """ :return: List of (response id, packed response) of the recipient, oldest first """
+    with self._transaction() as connection:
+      return connection.execute(
+        'SELECT id, packed_msg FROM pending_responses WHERE recipient = ? ORDER BY created_at LIMIT ?',
+        (recipient, limit)).fetchall()
+
+  def delete_responses(self, recipient, response_ids):
+    with self._transaction() as connection:
+      connection.executemany(
+        'DELETE FROM pending_responses WHERE recipient = ? AND id = ?',
+        [(recipient, response_id) for response_id in response_ids])
+
+  def _transaction(self, immediate=False):
+    return self._connections.transaction(immediate=immediate)
@@ -0,0 +1,217 @@
+"""
+Prometheus metrics of the inbox hot path.
+
+If the environment variable PROMETHEUS_MULTIPROC_DIR is set (it must point to an empty directory when the service
+starts), the metrics of all gunicorn worker processes are written to that directory and aggregated on every scrape of
+/-system/metrics. Otherwise, the endpoint only reports the metrics of the process serving the scrape.
+"""
+
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+MULTIPROCESS_DIR_ENV_VAR = 'PROMETHEUS_MULTIPROC_DIR'
+
+# Stages of handling an inbox request
+STAGE_FORM_PARSING = 'form_parsing'
+STAGE_PRECHECK = 'precheck'
+STAGE_UNPACK = 'unpack'
+STAGE_WEBHOOK = 'webhook'
+STAGE_PARSE_WEBHOOK_RESPONSE = 'parse_webhook_response'
+STAGE_PACK = 'pack'
+STAGES = (STAGE_FORM_PARSING, STAGE_PRECHECK, STAGE_UNPACK, STAGE_WEBHOOK, STAGE_PARSE_WEBHOOK_RESPONSE, STAGE_PACK)
+
+# Outcomes of inbox requests
+OUTCOME_INVALID_MESSAGE = 'invalid_message'
+OUTCOME_REJECTED = 'rejected'
+OUTCOME_WEBHOOK_INVALID = 'webhook_invalid'
+OUTCOME_WEBHOOK_ERROR = 'webhook_error'
+OUTCOME_SUCCESS = 'success'
+OUTCOME_QUEUED = 'queued'
+OUTCOME_BUSY = 'busy'
+OUTCOME_REPLAYED = 'replayed'
+OUTCOME_RATE_LIMITED = 'rate_limited'
+OUTCOME_DECISION_CACHED = 'decision_cached'
+
+# Reasons of shedding inbox requests
+SHED_QUEUE_FULL = 'queue_full'
+SHED_QUEUE_TIMEOUT = 'queue_timeout'
+SHED_RATE_LIMITED = 'rate_limited'
+
+# Outcomes of delivery attempts of outbound messages
+OUTBOUND_SENT = 'sent'
+OUTBOUND_FAILED = 'failed'
+OUTBOUND_RETRIED = 'retried'
+
+# Reasons of failing webhook calls without calling the webhook
+WEBHOOK_BREAKER_OPEN = 'breaker_open'
+WEBHOOK_DEADLINE_EXCEEDED = 'deadline_exceeded'
+
+# Directions of compressed HTTP bodies
+COMPRESSION_REQUEST = 'request'
+COMPRESSION_RESPONSE = 'response'
+COMPRESSION_WEBHOOK = 'webhook'
+
+# Reasons of closing WebSocket connections
+WEBSOCKET_CLOSE_CLIENT = 'client'
+WEBSOCKET_CLOSE_IDLE = 'idle'
+WEBSOCKET_CLOSE_TOO_BIG = 'too_big'
+WEBSOCKET_CLOSE_REJECTED = 'rejected'
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+STAGE_DURATION = Histogram(
+  'didcomm_inbox_stage_duration_seconds', 'Duration of the stages of handling an inbox request',
+  ['stage'], buckets=LATENCY_BUCKETS)
+REQUEST_DURATION = Histogram(
+  'didcomm_inbox_request_duration_seconds', 'Duration of handling an inbox request', buckets=LATENCY_BUCKETS)
+REQUESTS = Counter('didcomm_inbox_requests_total', 'Handled inbox requests by outcome', ['outcome'])
+PAYLOAD_SIZE = Histogram(
+  'didcomm_inbox_payload_bytes', 'Size of the packed DIDComm messages of inbox requests and responses',
+  ['direction'], buckets=SIZE_BUCKETS)
+PRECHECK_REJECTS = Counter(
+  'didcomm_inbox_precheck_rejects_total', 'Messages rejected before unpacking by reason', ['reason'])
+INBOX_IN_FLIGHT = Gauge(
+  'didcomm_inbox_in_flight', 'Inbox requests admitted and being handled', multiprocess_mode='livesum')
+INBOX_QUEUED = Gauge('didcomm_inbox_queued', 'Inbox requests waiting for admission', multiprocess_mode='livesum')
+SHED = Counter('didcomm_inbox_shed_total', 'Inbox requests shed by admission control by reason', ['reason'])
+TENANT_REQUESTS = Counter('didcomm_tenant_requests_total', 'Received messages by tenant', ['tenant'])
+OUTBOUND_DELIVERIES = Counter(
+  'didcomm_outbox_deliveries_total', 'Delivery attempts of outbound messages by outcome', ['outcome'])
+WEBHOOK_BREAKER_TRANSITIONS = Counter(
+  'didcomm_webhook_breaker_transitions_total', 'State changes of webhook circuit breakers by new state', ['state'])
+WEBHOOK_FAST_FAILURES = Counter(
+  'didcomm_webhook_fast_failures_total', 'Webhook calls failed without calling the webhook by reason', ['reason'])
+WEBHOOK_HEDGES = Counter('didcomm_webhook_hedged_requests_total', 'Notifications sent to the secondary webhook')
+WEBSOCKET_CONNECTIONS = Gauge(
+  'didcomm_websocket_connections', 'Open WebSocket inbox connections', multiprocess_mode='livesum')
+WEBSOCKET_CLOSES = Counter('didcomm_websocket_closes_total', 'Closed WebSocket inbox connections by reason', ['reason'])
+COMPRESSION_SAVED_BYTES = Counter(
+  'didcomm_compression_saved_bytes_total', 'Bytes saved by compressing HTTP bodies by direction', ['direction'])
+COMPRESSION_DURATION = Histogram(
+  'didcomm_compression_duration_seconds', 'Duration of compressing or decompressing an HTTP body by direction',
+  ['direction'], buckets=LATENCY_BUCKETS)
+STARTUP_PHASE_DURATION = Gauge(
+  'didcomm_startup_phase_seconds', 'Duration of the phases of booting the service and pre-warming a worker process',
+  ['phase'], multiprocess_mode='max')
+CACHE_HITS = Counter('didcomm_cache_hits_total', 'Cache hits', ['cache'])
+CACHE_MISSES = Counter('didcomm_cache_misses_total', 'Cache misses', ['cache'])
+
+_stage_durations = {stage: STAGE_DURATION.labels(stage) for stage in STAGES}
+_request_sizes = PAYLOAD_SIZE.labels('request')
+_response_sizes = PAYLOAD_SIZE.labels('response')
+
+# Cache name -> function returning the cache's stats dict (with 'hits' and 'misses')
+_caches = {}
+# Cache name -> (hits, misses) when last recorded
+_recorded_cache_stats = {}
+_cache_stats_lock = threading.Lock()
+
+
+@contextmanager
+def stage(stage_name):
+  """ Records the duration of the with-block as duration of the given stage. """
+  started = time.perf_counter()
+  try:
+    yield
+  finally:
+    _stage_durations[stage_name].observe(time.perf_counter() - started)
+
+
+def observe_request(outcome, duration, request_size=None, response_size=None):
+  REQUESTS.labels(outcome).inc()
+  REQUEST_DURATION.observe(duration)
+  if request_size is not None:
+    _request_sizes.observe(request_size)
+  if response_size is not None:
+    _response_sizes.observe(response_size)
+  _record_cache_stats()
+
+
+def observe_precheck_reject(reason):
+  PRECHECK_REJECTS.labels(reason).inc()
+
+
+def observe_shed(reason):
+  SHED.labels(reason).inc()
+
+
+def observe_tenant_request(tenant):
+  TENANT_REQUESTS.labels(tenant).inc()
+
+
+def observe_outbound_delivery(outcome):
+  OUTBOUND_DELIVERIES.labels(outcome).inc()
+
+
+def observe_breaker_transition(state):
+  WEBHOOK_BREAKER_TRANSITIONS.labels(state).inc()
+
+
+def observe_webhook_fast_failure(reason):
+  WEBHOOK_FAST_FAILURES.labels(reason).inc()
+
+
+def observe_webhook_hedge():
+  WEBHOOK_HEDGES.inc()
+
+
+def observe_compression(direction, original_size, compressed_size, duration):
+  COMPRESSION_SAVED_BYTES.labels(direction).inc(max(0, original_size - compressed_size))
+  COMPRESSION_DURATION.labels(direction).observe(duration)
+
+
+def observe_startup_phases(phase_durations):
+  for phase_name, seconds in phase_durations.items():
+    STARTUP_PHASE_DURATION.labels(phase_name).set(seconds)
+
+
+def observe_websocket_close(reason):
+  WEBSOCKET_CLOSES.labels(reason).inc()
+
+
+def register_cache(cache_name, get_stats):
+  """
+  Reports the hits and misses of a cache of this process.
+
+  :param cache_name: Value of the cache label
+  :param get_stats: Function returning a dict with the cache's (monotonic) 'hits' and 'misses' counts
+  """
+  _caches[cache_name] = get_stats
+
+
+def _record_cache_stats():
+  # Cache counters are only increased by the difference since the last recording, once per handled request
+  with _cache_stats_lock:
+    for cache_name, get_stats in _caches.items():
+      stats = get_stats()
+      recorded_hits, recorded_misses = _recorded_cache_stats.get(cache_name, (0, 0))
+      if stats['hits'] > recorded_hits:
+        CACHE_HITS.labels(cache_name).inc(stats['hits'] - recorded_hits)
+      if stats['misses'] > recorded_misses:
+        CACHE_MISSES.labels(cache_name).inc(stats['misses'] - recorded_misses)
+      _recorded_cache_stats[cache_name] = (stats['hits'], stats['misses'])
+
+
+def generate_metrics():
+  """ :return: (metrics in the Prometheus text format, content type) """
+  if os.getenv(MULTIPROCESS_DIR_ENV_VAR):
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+  return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+  """
+  Removes the live gauges (e.g. in-flight requests) of an exited worker process from the aggregated metrics, which
+  would otherwise keep its last values - e.g. of a worker killed in the middle of requests.
+  """
+  if os.getenv(MULTIPROCESS_DIR_ENV_VAR):
+    multiprocess.mark_process_dead(pid)
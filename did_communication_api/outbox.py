@@ -0,0 +1,363 @@
+"""
+Outbound DIDComm messages: other services let DID-Comm-API pack messages for Peer DIDs and deliver them to the
+service endpoints of the DID Documents of their recipients.
+"""
+
+import collections
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from did_communication_api import constants, metrics, utils
+from did_communication_api.did_comm.utils import get_service_endpoint_of_did_document
+from did_communication_api.errors import MyDIDCommError, CryptoExecutorBusyError, OutboxFullError
+
+# Status of outbound messages
+STATUS_QUEUED = 'queued'
+STATUS_SENT = 'sent'
+STATUS_FAILED = 'failed'
+
+# HTTP status codes of the recipient's endpoint after which the delivery is retried
+RETRYABLE_HTTP_CODES = (429, 500, 502, 503, 504)
+
+
+class OutboundMessage:
+
+  def __init__(self, message_id, recipient, endpoint, packed_msg):
+    """
+    :param recipient: The recipient's DID, or the list of DIDs of the recipients sharing the endpoint
+    """
+    self.id = message_id
+    self.recipient = recipient
+    self.endpoint = endpoint
+    self.packed_msg = packed_msg
+    self.attempts = 0
+    self.status = STATUS_QUEUED
+    self.http_code = None
+    self.error = None
+    self.done = threading.Event()
+
+  def as_dict(self):
+    return {
+      'id': self.id,
+      'to': self.recipient,
+      'status': self.status,
+      'attempts': self.attempts,
+      'http_code': self.http_code,
+      'error': self.error,
+    }
+
+
+class Outbox:
+  """
+  Bounded send queue of packed messages, drained by sender threads of the current process.
+
+  Messages are queued per service endpoint. A sender thread takes up to max_coalesced queued messages of one
+  endpoint and posts them back to back over a pooled keep-alive connection to that endpoint; at most
+  connections_per_endpoint sender threads serve an endpoint at a time. Deliveries failing with a connection error,
+  HTTP 429 or 5xx are retried with exponential backoff (and jitter) until max_attempts.
+  """
+
+  def __init__(self, concurrency=8, queue_size=1000, connections_per_endpoint=4, max_endpoint_pools=100,
+               max_coalesced=16, max_attempts=5, backoff_base=0.5, backoff_max=60,
+               connect_timeout=3.05, read_timeout=30):
+    """
+    :param concurrency: Number of sender threads
+    :param queue_size: Maximum number of messages queued or being delivered
+    :param connections_per_endpoint: Maximum number of connections (and sender threads) per endpoint
+    :param max_endpoint_pools: Maximum number of endpoints whose keep-alive connections are kept
+    :param max_coalesced: Maximum number of messages a sender thread posts to an endpoint in a row
+    :param max_attempts: Maximum number of delivery attempts of a message
+    :param backoff_base: Delay in seconds before the first retry, doubled on every further retry
+    :param backoff_max: Maximum delay in seconds between two attempts
+    """
+    self.concurrency = concurrency
+    self.queue_size = queue_size
+    self.connections_per_endpoint = connections_per_endpoint
+    self.max_endpoint_pools = max_endpoint_pools
+    self.max_coalesced = max_coalesced
+    self.max_attempts = max_attempts
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
+    self.timeout = (connect_timeout, read_timeout)
+    self._condition = threading.Condition()
+    # endpoint -> deque of messages ready to be sent (in the order endpoints are served)
+    self._pending = collections.OrderedDict()
+    # endpoint -> number of sender threads posting to it
+    self._active = collections.Counter()
+    # Heap of (time of the next attempt, sequence number, message) of messages awaiting a retry
+    self._retries = []
+    self._retry_sequence = 0
+    self._size = 0
+    self._threads_pid = None
+    self._sessions = {}
+
+  def submit(self, outbound_messages):
+    """
+    Queues the messages, all or none of them.
+
+    :raises OutboxFullError: If the queue has no room for all messages
+    """
+    with self._condition:
+      if self._size + len(outbound_messages) > self.queue_size:
+        raise OutboxFullError('The outbound queue is full')
+      self._size += len(outbound_messages)
+      for outbound_message in outbound_messages:
+        self._pending.setdefault(outbound_message.endpoint, collections.deque()).append(outbound_message)
+      self._condition.notify_all()
+    self.ensure_started()
+
+  def has_room(self, count):
+    """ :return: True iff count further messages fit into the queue at the moment """
+    return self._size + count <= self.queue_size
+
+  def ensure_started(self):
+    """ Starts the sender threads of the current process, unless they are already running. """
+    if self._threads_pid == os.getpid():
+      return
+    with self._condition:
+      if self._threads_pid != os.getpid():
+        for index in range(self.concurrency):
+          threading.Thread(target=self._run, name='outbox-sender-{}'.format(index), daemon=True).start()
+        self._threads_pid = os.getpid()
+        logging.info('Outbox started with {} sender threads'.format(self.concurrency))
+
+  def _run(self):
+    while True:
+      endpoint, outbound_messages = self._take()
+      try:
+        for outbound_message in outbound_messages:
+          self._deliver_safely(outbound_message)
+      finally:
+        with self._condition:
+          self._active[endpoint] -= 1
+          if not self._active[endpoint]:
+            del self._active[endpoint]
+          self._condition.notify_all()
+
+  def _take(self):
+    """ Waits for messages to send. :return: (endpoint, messages to post to it) """
+    with self._condition:
+      while True:
+        self._schedule_due_retries()
+        for endpoint in self._pending:
+          if self._active[endpoint] < self.connections_per_endpoint:
+            break
+        else:
+          endpoint = None
+        if endpoint is not None:
+          break
+        self._condition.wait(self._retries[0][0] - time.monotonic() if self._retries else None)
+
+      queued_messages = self._pending.pop(endpoint)
+      outbound_messages = [queued_messages.popleft() for _ in range(min(self.max_coalesced, len(queued_messages)))]
+      if queued_messages:
+        # Served again after the other endpoints
+        self._pending[endpoint] = queued_messages
+      self._active[endpoint] += 1
+      return endpoint, outbound_messages
+
+  def _schedule_due_retries(self):
+    now = time.monotonic()
+    while self._retries and self._retries[0][0] <= now:
+      outbound_message = heapq.heappop(self._retries)[2]
+      self._pending.setdefault(outbound_message.endpoint, collections.deque()).append(outbound_message)
+
+  def _deliver_safely(self, outbound_message):
+    try:
+      self._deliver(outbound_message)
+    except Exception:
+      # Raised before the message was finished or scheduled for a retry (both are the last steps of _deliver)
+      logging.exception('Unexpected error when delivering message {} to {}'.format(
+        outbound_message.id, outbound_message.endpoint))
+      if not outbound_message.done.is_set():
+        self._finish(outbound_message, STATUS_FAILED)
+
+  def _deliver(self, outbound_message):
+    outbound_message.attempts += 1
+    retry_after = None
+    try:
+      response = self._get_session().post(
+        outbound_message.endpoint, data=outbound_message.packed_msg.encode('utf-8'),
+        headers={'Content-Type': constants.DIDCOMM_ENCRYPTED_MEDIA_TYPE}, timeout=self.timeout)
+    except requests.exceptions.RequestException as error:
+      outbound_message.error = str(error)
+      retryable = True
+    else:
+      outbound_message.http_code = response.status_code
+      response.close()
+      if response.ok:
+        outbound_message.error = None
+        self._finish(outbound_message, STATUS_SENT)
+        return
+      outbound_message.error = 'The endpoint responded with HTTP {}'.format(response.status_code)
+      retryable = response.status_code in RETRYABLE_HTTP_CODES
+      retry_after = _retry_after_seconds(response.headers.get('Retry-After'))
+
+    if not retryable or outbound_message.attempts >= self.max_attempts:
+      logging.error('Delivery of message {} to {} failed after {} attempts: {}'.format(
+        outbound_message.id, outbound_message.endpoint, outbound_message.attempts, outbound_message.error))
+      self._finish(outbound_message, STATUS_FAILED)
+      return
+
+    delay = min(self.backoff_max, self.backoff_base * 2 ** (outbound_message.attempts - 1)) * random.uniform(0.5, 1)
+    if retry_after is not None:
+      delay = max(delay, min(retry_after, self.backoff_max))
+    logging.warning('Delivery of message {} to {} failed (attempt {}): {}. Retrying in {:.1f}s'.format(
+      outbound_message.id, outbound_message.endpoint, outbound_message.attempts, outbound_message.error, delay))
+    metrics.observe_outbound_delivery(metrics.OUTBOUND_RETRIED)
+    with self._condition:
+      self._retry_sequence += 1
+      heapq.heappush(self._retries, (time.monotonic() + delay, self._retry_sequence, outbound_message))
+
+  def _finish(self, outbound_message, status):
+    outbound_message.status = status
+    metrics.observe_outbound_delivery(status)
+    with self._condition:
+      self._size -= 1
+    outbound_message.done.set()
+
+  def _get_session(self):
+    # Never reuse sockets inherited from the parent process (gunicorn --preload)
+    pid = os.getpid()
+    session = self._sessions.get(pid)
+    if session is None:
+      with self._condition:
+        session = self._sessions.get(pid)
+        if session is None:
+          self._sessions.clear()
+          session = requests.Session()
+          adapter = HTTPAdapter(
+            pool_connections=self.max_endpoint_pools, pool_maxsize=self.connections_per_endpoint, pool_block=True)
+          session.mount('http://', adapter)
+          session.mount('https://', adapter)
+          self._sessions[pid] = session
+    return session
+
+
+class OutboxHandler:
+  """
+  Handles the requests of other services to send messages.
+
+  Request body: a message {'to': <Peer DID or list of Peer DIDs>, 'type': <message type>, 'body': <message body>,
+  'id', 'thid', 'attachments'} (id, thid and attachments are optional) or {'messages': [<message>, ...]}; with
+  'wait': true, the response is sent once all messages were delivered (or failed), at most after wait_timeout seconds.
+
+  A message to several recipients is packed once per max_recipients recipients (one JWE for all of them) and
+  delivered once per service endpoint.
+  """
+
+  def __init__(self, did_comm, crypto_backend, server_did, outbox, wait_timeout=30, max_recipients=16):
+    """
+    :param did_comm: DIDComm used to resolve the DID Documents of the recipients
+    :param crypto_backend: DIDComm or CryptoExecutor packing the messages
+    :param max_recipients: Maximum number of recipients of a packed message
+    """
+    self.did_comm = did_comm
+    self.crypto_backend = crypto_backend
+    self.server_did = server_did
+    self.outbox = outbox
+    self.wait_timeout = wait_timeout
+    self.max_recipients = max_recipients
+
+  def handle_send_request(self, request_data):
+    if not isinstance(request_data, dict):
+      return utils.generate_err_resp('Expected a JSON object', constants.HTTP_BAD_REQUEST)
+    messages = request_data['messages'] if 'messages' in request_data else [request_data]
+    if not isinstance(messages, list) or not messages:
+      return utils.generate_err_resp('Expected a non-empty list of messages', constants.HTTP_BAD_REQUEST)
+    if not self.outbox.has_room(sum(_recipient_count(message) for message in messages)):
+      # Do not pack messages which cannot be queued anyway
+      return utils.generate_err_resp('Service Unavailable', constants.HTTP_SERVICE_UNAVAILABLE)
+
+    outbound_messages = []
+    for index, message in enumerate(messages):
+      try:
+        outbound_messages.extend(self._pack(message))
+      except ValueError as error:
+        logging.warning(constants.INVALID_REQUEST_RECEIVED.format('Invalid outbound message: {}'.format(error)))
+        return utils.generate_err_resp('Invalid message {}: {}'.format(index, error), constants.HTTP_BAD_REQUEST)
+      except CryptoExecutorBusyError:
+        return utils.generate_err_resp('Service Unavailable', constants.HTTP_SERVICE_UNAVAILABLE)
+    try:
+      self.outbox.submit(outbound_messages)
+    except OutboxFullError:
+      return utils.generate_err_resp('Service Unavailable', constants.HTTP_SERVICE_UNAVAILABLE)
+
+    http_code = constants.HTTP_ACCEPTED
+    if request_data.get('wait') is True:
+      deadline = time.monotonic() + self.wait_timeout
+      if all(outbound_message.done.wait(max(0.0, deadline - time.monotonic()))
+             for outbound_message in outbound_messages):
+        all_sent = all(outbound_message.status == STATUS_SENT for outbound_message in outbound_messages)
+        http_code = constants.HTTP_SUCCESS_STATUS if all_sent else constants.HTTP_BAD_GATEWAY
+    return {'messages': [outbound_message.as_dict() for outbound_message in outbound_messages]}, http_code
+
+  def _pack(self, message):
+    """
+    :return: The OutboundMessages delivering the message to all its recipients
+    :raises ValueError: If the message is invalid or a recipient has no (http) service endpoint
+    """
+    if not isinstance(message, dict):
+      raise ValueError('Expected a JSON object')
+    recipients, msg_type = message.get('to'), message.get('type')
+    if isinstance(recipients, str):
+      recipients = [recipients]
+    if not isinstance(recipients, list) or not recipients or \
+       not all(isinstance(recipient, str) for recipient in recipients):
+      raise ValueError("'to' must be a DID or a non-empty list of DIDs")
+    if not isinstance(msg_type, str):
+      raise ValueError("'type' is required")
+    attachments = message.get('attachments')
+    if attachments is not None and not isinstance(attachments, list):
+      raise ValueError("'attachments' must be a list")
+
+    recipients = list(dict.fromkeys(recipients))
+    endpoints = {recipient: self._endpoint_of(recipient) for recipient in recipients}
+    message_id = str(message.get('id') or uuid.uuid4())
+    outbound_messages = []
+    for start in range(0, len(recipients), self.max_recipients):
+      chunk = recipients[start:start + self.max_recipients]
+      try:
+        packed_msg = self.crypto_backend.pack(
+          msg_body=message.get('body') or {}, to=chunk, frm=self.server_did, msg_type=msg_type,
+          msg_id=message_id, thid=message.get('thid'), attachments=attachments)
+      except (MyDIDCommError, KeyError, TypeError):
+        raise ValueError('Could not pack the message')
+      # Recipients sharing an endpoint (e.g. hosted by the same agent) get the message once
+      recipients_by_endpoint = {}
+      for recipient in chunk:
+        recipients_by_endpoint.setdefault(endpoints[recipient], []).append(recipient)
+      outbound_messages.extend(
+        OutboundMessage(message_id, endpoint_recipients[0] if len(endpoint_recipients) == 1 else endpoint_recipients,
+                        endpoint, packed_msg)
+        for endpoint, endpoint_recipients in recipients_by_endpoint.items())
+    return outbound_messages
+
+  def _endpoint_of(self, recipient):
+    try:
+      endpoint = get_service_endpoint_of_did_document(self.did_comm.resolve_peer_did(recipient))
+    except MyDIDCommError:
+      raise ValueError('Could not resolve the DID of the recipient {}'.format(recipient))
+    if not isinstance(endpoint, str) or not endpoint.startswith(('http://', 'https://')):
+      raise ValueError('The DID Document of the recipient {} has no HTTP service endpoint'.format(recipient))
+    return endpoint
+
+
+def _recipient_count(message):
+  recipients = message.get('to') if isinstance(message, dict) else None
+  return len(recipients) if isinstance(recipients, list) else 1
+
+
+def _retry_after_seconds(retry_after):
+  try:
+    return max(0.0, float(retry_after))
+  except (TypeError, ValueError):
+    return None
@@ -0,0 +1,43 @@
+"""
+Pre-warm step of worker processes: runs after fork, before a worker process serves requests, so the first requests
+do not pay for opening the secrets store, cold DID resolver and crypto code paths or creating the webhook client.
+"""
+
+import logging
+
+from peerdid.did_doc import DIDDocPeerDID
+
+from did_communication_api import constants, metrics, startup, utils, webhook_client
+
+
+def prewarm_worker(did_comm, crypto_backend, server_did, asynchronous=False):
+  """
+  Loads the keys of the server DID, resolves it and packs and unpacks a message to itself, then marks this process
+  ready (see GET /-system/readiness). A failed pre-warm step is logged and leaves the process not ready.
+
+  :param did_comm: DIDComm of the service (secrets store and DID resolver)
+  :param crypto_backend: DIDComm or CryptoExecutor packing and unpacking the messages of the inbox
+  :param asynchronous: True in the asynchronous serving mode (ASGI), which uses the asynchronous webhook client
+  """
+  if utils.load_component_configuration('startup')['prewarm']:
+    try:
+      with startup.phase(startup.PHASE_PREWARM_DID):
+        did_doc = DIDDocPeerDID.from_json(did_comm.did_resolver.resolve_json(server_did))
+      with startup.phase(startup.PHASE_PREWARM_KEYS):
+        utils.get_or_create_eventloop().run_until_complete(
+          did_comm.secrets_resolver.get_keys(did_doc.auth_kids + did_doc.agreement_kids))
+      with startup.phase(startup.PHASE_PREWARM_PACK_UNPACK):
+        # Also starts the processes of the crypto executor, if enabled
+        crypto_backend.unpack(crypto_backend.pack(
+          msg_body={}, to=server_did, frm=server_did, msg_type=constants.PREWARM_MSG_TYPE))
+      with startup.phase(startup.PHASE_PREWARM_WEBHOOK_CLIENT):
+        if asynchronous:
+          webhook_client.get_async_webhook_client()
+        else:
+          webhook_client.get_webhook_client()
+    except Exception:
+      logging.exception('Pre-warming the worker process failed')
+      return
+  startup.mark_ready()
+  metrics.observe_startup_phases(startup.phases())
+  startup.log_report('Worker process ready')
@@ -0,0 +1,234 @@
+"""
+Cache of the responses to completed inbox requests, keyed by (sender DID, message id).
+
+A client retrying a request (e.g. after a timeout) gets the stored response instead of a second webhook call.
+Duplicates arriving while the original request is still handled wait for its response instead of being handled
+concurrently.
+"""
+
+import asyncio
+import json
+import threading
+import time
+
+from did_communication_api.lru_cache import LRUCache
+from did_communication_api.sqlite_connections import SQLiteConnections
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS replay_cache (
+  sender TEXT NOT NULL,
+  msg_id TEXT NOT NULL,
+  response TEXT,
+  expires_at REAL NOT NULL,
+  PRIMARY KEY (sender, msg_id)
+);
+CREATE INDEX IF NOT EXISTS replay_cache_expires_at ON replay_cache (expires_at);
+"""
+
+# Stored responses between two prunings of the expired and surplus entries of the shared store
+PRUNE_INTERVAL = 100
+
+
+class MemoryReplayStore:
+  """ Responses stored in the memory of this process (LRU, size-bounded). """
+
+  def __init__(self, max_entries):
+    self.cache = LRUCache(max_entries)
+
+  def get(self, key):
+    entry = self.cache.get(key)
+    if entry is None or entry[0] <= time.time():
+      return None
+    return entry[1]
+
+  def put(self, key, response, ttl_seconds):
+    self.cache.put(key, (time.time() + ttl_seconds, response))
+
+  def try_claim(self, key, lease_seconds):
+    # Duplicates within this process are coalesced by the ReplayCache itself
+    return True
+
+  def release(self, key):
+    pass
+
+  def stats(self):
+    return self.cache.stats()
+
+
+class SQLiteReplayStore:
+  """
+  Responses stored in an SQLite database shared by all worker processes.
+
+  A process handling a request claims its key with a pending entry (without response) for the duration of a lease,
+  so duplicates received by other worker processes wait for the response as well.
+  """
+
+  def __init__(self, file_path, max_entries):
+    self.file_path = file_path
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self._puts = 0
+    self._connections = SQLiteConnections(file_path)
+    connection, lock = self._connections.get()
+    with lock:
+      connection.executescript(SCHEMA)
+
+  def get(self, key):
+    with self._connections.transaction() as connection:
+      row = connection.execute(
+        'SELECT response FROM replay_cache WHERE sender = ? AND msg_id = ? AND expires_at > ?',
+        (*key, time.time())).fetchone()
+    if row is None or row[0] is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return json.loads(row[0])
+
+  def put(self, key, response, ttl_seconds):
+    now = time.time()
+    with self._connections.transaction() as connection:
+      connection.execute(
+        'INSERT OR REPLACE INTO replay_cache (sender, msg_id, response, expires_at) VALUES (?, ?, ?, ?)',
+        (*key, json.dumps(response), now + ttl_seconds))
+    self._puts += 1
+    if self._puts % PRUNE_INTERVAL == 0:
+      self._prune(now)
+
+  def try_claim(self, key, lease_seconds):
+    """ :return: True iff the key was claimed, False if another process holds it or its response is stored """
+    now = time.time()
+    with self._connections.transaction(immediate=True) as connection:
+      row = connection.execute(
+        'SELECT 1 FROM replay_cache WHERE sender = ? AND msg_id = ? AND expires_at > ?', (*key, now)).fetchone()
+      if row is not None:
+        return False
+      connection.execute(
+        'INSERT OR REPLACE INTO replay_cache (sender, msg_id, response, expires_at) VALUES (?, ?, NULL, ?)',
+        (*key, now + lease_seconds))
+      return True
+
+  def release(self, key):
+    with self._connections.transaction() as connection:
+      connection.execute(
+        'DELETE FROM replay_cache WHERE sender = ? AND msg_id = ? AND response IS NULL', key)
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses}
+
+  def _prune(self, now):
+    with self._connections.transaction(immediate=True) as connection:
+      connection.execute('DELETE FROM replay_cache WHERE expires_at <= ?', (now,))
+      connection.execute(
+        'DELETE FROM replay_cache WHERE rowid IN '
+        '(SELECT rowid FROM replay_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+
+class ReplayCache:
+  """
+  Coalesces duplicate requests and stores the responses of completed requests for ttl_seconds.
+
+  Only one request per key is handled at a time: duplicates wait (at most wait_timeout seconds) for its response.
+  If the request ends with a response which must not be cached (e.g. the webhook was unreachable), the next
+  waiting duplicate handles the request itself.
+  """
+
+  def __init__(self, store, ttl_seconds, wait_timeout=30, poll_interval=0.05):
+    """
+    :param store: MemoryReplayStore or SQLiteReplayStore
+    :param ttl_seconds: Time responses are stored
+    :param wait_timeout: Maximum time a duplicate waits for the response; also the lease of a claimed key
+    :param poll_interval: Seconds between checks of the shared store while another process handles the request
+    """
+    self.store = store
+    self.ttl_seconds = ttl_seconds
+    self.wait_timeout = wait_timeout
+    self.poll_interval = poll_interval
+    self._lock = threading.Lock()
+    # key -> threading.Event (sync handlers) / asyncio.Future (async handlers) of the request being handled
+    self._in_flight = {}
+    self._in_flight_async = {}
+
+  def get_or_compute(self, key, compute, is_cacheable):
+    """
+    :param key: (sender DID, message id)
+    :param compute: Function handling the request, returning the response
+    :param is_cacheable: Function deciding whether a response is stored
+    :return: (response, True iff it is the stored response of an earlier request)
+    """
+    deadline = time.monotonic() + self.wait_timeout
+    while time.monotonic() < deadline:
+      with self._lock:
+        response = self.store.get(key)
+        if response is not None:
+          return response, True
+        in_flight = self._in_flight.get(key)
+        if in_flight is None:
+          in_flight = self._in_flight[key] = threading.Event()
+          break
+      in_flight.wait(max(0.0, deadline - time.monotonic()))
+    else:
+      # Waited too long: handle the request without coalescing
+      return compute(), False
+
+    try:
+      while not self.store.try_claim(key, self.wait_timeout):
+        response = self.store.get(key)
+        if response is not None:
+          return response, True
+        if time.monotonic() >= deadline:
+          return compute(), False
+        time.sleep(self.poll_interval)
+      try:
+        response = compute()
+      except BaseException:
+        self.store.release(key)
+        raise
+      return self._store(key, response, is_cacheable), False
+    finally:
+      with self._lock:
+        self._in_flight.pop(key, None)
+      in_flight.set()
+
+  async def get_or_compute_async(self, key, compute, is_cacheable):
+    """ Same as get_or_compute, but compute returns an awaitable and waiting does not block the event loop. """
+    deadline = time.monotonic() + self.wait_timeout
+    while time.monotonic() < deadline:
+      response = self.store.get(key)
+      if response is not None:
+        return response, True
+      in_flight = self._in_flight_async.get(key)
+      if in_flight is None:
+        in_flight = self._in_flight_async[key] = asyncio.get_running_loop().create_future()
+        break
+      try:
+        await asyncio.wait_for(asyncio.shield(in_flight), max(0.0, deadline - time.monotonic()))
+      except asyncio.TimeoutError:
+        pass
+    else:
+      return await compute(), False
+
+    try:
+      while not self.store.try_claim(key, self.wait_timeout):
+        response = self.store.get(key)
+        if response is not None:
+          return response, True
+        if time.monotonic() >= deadline:
+          return await compute(), False
+        await asyncio.sleep(self.poll_interval)
+      try:
+        response = await compute()
+      except BaseException:
+        self.store.release(key)
+        raise
+      return self._store(key, response, is_cacheable), False
+    finally:
+      self._in_flight_async.pop(key, None)
+      in_flight.set_result(None)
+
+  def _store(self, key, response, is_cacheable):
+    if is_cacheable(response):
+      self.store.put(key, response, self.ttl_seconds)
+    else:
+      self.store.release(key)
+    return response
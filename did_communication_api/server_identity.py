@@ -0,0 +1,93 @@
+"""
+Persistent identity (Peer DID) of the server.
+
+The server DID is created once and recorded in the identity file together with the service endpoint it was created
+for. Later boots, and all worker processes, reuse the recorded DID as long as its private keys are still in the
+secrets store and the service endpoint did not change.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import tempfile
+
+from contextlib import contextmanager
+
+from peerdid.did_doc import DIDDocPeerDID
+from peerdid.errors import PeerDIDError
+
+from did_communication_api import utils
+
+
+class ServerIdentity:
+
+  def __init__(self, file_path):
+    self.file_path = file_path
+
+  def load_or_create(self, did_comm, service_endpoint):
+    """
+    :param did_comm: DIDComm used to create the Peer DID and whose secrets store holds its keys
+    :param service_endpoint: The service endpoint of the server DID
+    :return: The server DID
+    """
+    with self.locked():
+      identity = self.read()
+      if identity and identity.get('service_endpoint') == service_endpoint:
+        if _has_private_keys(did_comm, identity['did']):
+          logging.info('Reusing the server DID of {}'.format(self.file_path))
+          return identity['did']
+        logging.warning('Private keys of the server DID are missing in the secrets store. Creating a new server DID')
+      elif identity:
+        logging.warning('Service endpoint changed to {}. Creating a new server DID'.format(service_endpoint))
+
+      did = did_comm.create_peer_did(service_endpoint)
+      self._write({'did': did, 'service_endpoint': service_endpoint})
+      logging.info('Created the server DID and stored it in {}'.format(self.file_path))
+      return did
+
+  def read(self):
+    """ :return: The recorded identity {'did': <DID>, 'service_endpoint': <endpoint>} or None """
+    try:
+      with open(self.file_path) as f:
+        return json.load(f)
+    except FileNotFoundError:
+      return None
+    except json.decoder.JSONDecodeError:
+      logging.error('Could not parse the server identity file {}'.format(self.file_path))
+      return None
+
+  @contextmanager
+  def locked(self):
+    """ Exclusive lock (across processes) on the server identity and the secrets store changes it makes. """
+    with open(self.file_path + '.lock', 'a') as lock_file:
+      fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+  def _write(self, identity):
+    directory = os.path.dirname(os.path.abspath(self.file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.server_identity-', suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'w') as f:
+        json.dump(identity, f)
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(tmp_path, self.file_path)
+    except BaseException:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      raise
+
+
+def _has_private_keys(did_comm, did):
+  try:
+    did_doc = DIDDocPeerDID.from_json(did_comm.did_resolver.resolve_json(did))
+  except PeerDIDError as error:
+    logging.error('Could not resolve the recorded server DID: {}'.format(str(error)))
+    return False
+  kids = did_doc.auth_kids + did_doc.agreement_kids
+  stored_kids = utils.get_or_create_eventloop().run_until_complete(did_comm.secrets_resolver.get_keys(kids))
+  return len(stored_kids) == len(kids)
@@ -0,0 +1,59 @@
+""" Per-process SQLite connections (WAL mode) with serialized transactions. """
+
+import os
+import sqlite3
+import threading
+
+
+class SQLiteConnections:
+  """
+  Hands out one connection (and lock) per process: neither must be used by forked worker processes.
+  Connections of the parent process are deliberately never closed in a child process.
+  """
+
+  def __init__(self, file_path):
+    self.file_path = file_path
+    self._connections = {}
+    self._connections_lock = threading.Lock()
+
+  def transaction(self, immediate=False):
+    return _Transaction(*self.get(), immediate=immediate)
+
+  def get(self):
+    """ :return: (connection, lock) of this process """
+    pid = os.getpid()
+    connection = self._connections.get(pid)
+    if connection is None:
+      with self._connections_lock:
+        connection = self._connections.get(pid)
+        if connection is None:
+          sqlite_connection = sqlite3.connect(
+            self.file_path, timeout=30, isolation_level=None, check_same_thread=False)
+          sqlite_connection.execute('PRAGMA journal_mode=WAL')
+          sqlite_connection.execute('PRAGMA synchronous=NORMAL')
+          connection = (sqlite_connection, threading.Lock())
+          self._connections[pid] = connection
+    return connection
+
+
+class _Transaction:
+
+  def __init__(self, connection, lock, immediate=False):
+    self.connection = connection
+    self.lock = lock
+    self.immediate = immediate
+
+  def __enter__(self):
+    self.lock.acquire()
+    try:
+      self.connection.execute('BEGIN IMMEDIATE' if self.immediate else 'BEGIN')
+    except BaseException:
+      self.lock.release()
+      raise
+    return self.connection
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    try:
+      self.connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+    finally:
+      self.lock.release()
@@ -0,0 +1,76 @@
+"""
+Startup report: durations of the phases of booting the service and of pre-warming its worker processes.
+
+Imported first by the entry point, so the imports phase covers the imports of the service and its dependencies.
+Only standard library modules are imported here.
+"""
+
+import logging
+import os
+import time
+
+from contextlib import contextmanager
+
+# Phases of the boot (in the gunicorn master process with --preload, inherited by the forked worker processes)
+PHASE_IMPORTS = 'imports'
+PHASE_CONFIGURATION = 'configuration'
+PHASE_SECRETS = 'secrets'
+PHASE_SERVER_IDENTITY = 'server_identity'
+PHASE_COMPONENTS = 'components'
+# Phases of pre-warming a worker process
+PHASE_PREWARM_DID = 'prewarm_did'
+PHASE_PREWARM_KEYS = 'prewarm_keys'
+PHASE_PREWARM_PACK_UNPACK = 'prewarm_pack_unpack'
+PHASE_PREWARM_WEBHOOK_CLIENT = 'prewarm_webhook_client'
+
+# Phase -> seconds
+_phases = {}
+_last_mark = time.perf_counter()
+# Process which completed its pre-warm step
+_ready_pid = None
+
+
+def mark(phase_name):
+  """ Records the time since the previous mark (or the import of this module) as the duration of the phase. """
+  global _last_mark
+  now = time.perf_counter()
+  _phases[phase_name] = now - _last_mark
+  _last_mark = now
+
+
+@contextmanager
+def phase(phase_name):
+  """ Records the duration of the with-block as the duration of the phase. """
+  started = time.perf_counter()
+  try:
+    yield
+  finally:
+    _phases[phase_name] = time.perf_counter() - started
+
+
+def mark_ready():
+  global _ready_pid
+  _ready_pid = os.getpid()
+
+
+def is_ready():
+  """ True iff this process completed its pre-warm step (a forked worker process has to complete its own) """
+  return _ready_pid == os.getpid()
+
+
+def phases():
+  return dict(_phases)
+
+
+def report():
+  return {
+    'pid': os.getpid(),
+    'ready': is_ready(),
+    'phases': phases(),
+    'total_seconds': sum(_phases.values()),
+  }
+
+
+def log_report(title):
+  logging.info('{} in {:.3f}s: {}'.format(title, sum(_phases.values()), ', '.join(
+    '{} {:.3f}s'.format(phase_name, seconds) for phase_name, seconds in _phases.items())))
@@ -0,0 +1,198 @@
+"""
+Tenants of a multi-tenant deployment: every tenant owns any number of server DIDs (e.g. one per tenant or pairwise
+per connection) and may have its own webhook. Received messages are answered from the DID they were sent to.
+"""
+
+import logging
+import re
+import threading
+import time
+
+from did_communication_api import constants, utils
+from did_communication_api.sqlite_connections import SQLiteConnections
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tenants (
+  tenant TEXT PRIMARY KEY,
+  webhook_url TEXT,
+  version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tenants_version ON tenants (version);
+CREATE TABLE IF NOT EXISTS identities (
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  did TEXT NOT NULL UNIQUE,
+  tenant TEXT NOT NULL,
+  created_at REAL NOT NULL
+);
+"""
+
+VALID_TENANT_NAME_REGEX = re.compile('^[A-Za-z0-9_.-]{1,64}$')
+
+
+class Identity:
+  """ A server DID, the tenant owning it and the webhook notified of the messages sent to it """
+
+  def __init__(self, did, tenant, webhook_url=None):
+    self.did = did
+    self.tenant = tenant
+    self.webhook_url = webhook_url
+
+
+class TenantRegistry:
+  """
+  Tenants and their server DIDs, stored in an SQLite database shared by all worker processes.
+
+  Every process holds an in-memory index DID -> tenant, so looking up the recipient of a message is a dict access
+  regardless of the number of identities. Identities and tenants added by other processes are loaded incrementally:
+  when a DID is not in the index (at most every miss_refresh_interval seconds), and at most every refresh_interval
+  seconds for changed webhooks.
+  """
+
+  def __init__(self, file_path, refresh_interval=5.0, miss_refresh_interval=1.0):
+    self.file_path = file_path
+    self.refresh_interval = refresh_interval
+    self.miss_refresh_interval = miss_refresh_interval
+    self._connections = SQLiteConnections(file_path)
+    connection, lock = self._connections.get()
+    with lock:
+      connection.executescript(SCHEMA)
+    # DID -> tenant and tenant -> webhook URL (None: the configured webhook)
+    self._tenants_by_did = {}
+    self._webhook_urls = {}
+    self._identities_seq = 0
+    self._tenants_version = 0
+    self._next_refresh = 0.0
+    self._next_miss_refresh = 0.0
+    self._refresh_lock = threading.Lock()
+    self.refresh()
+
+  def lookup(self, did):
+    """ :return: The Identity of the server DID, or None if the DID belongs to no tenant """
+    if time.monotonic() >= self._next_refresh:
+      self.refresh()
+    tenant = self._tenants_by_did.get(did)
+    if tenant is None:
+      # Possibly created by another worker process since the last refresh.
+      # Throttled, so messages to unknown DIDs (e.g. retired server DIDs) do not query the database every time.
+      now = time.monotonic()
+      if now < self._next_miss_refresh:
+        return None
+      self._next_miss_refresh = now + self.miss_refresh_interval
+      self.refresh()
+      tenant = self._tenants_by_did.get(did)
+      if tenant is None:
+        return None
+    return Identity(did, tenant, self._webhook_urls.get(tenant))
+
+  def lookup_kid(self, kid):
+    """ :return: The Identity owning the key (kids of Peer DIDs are DID URLs: <DID>#<key id>), or None """
+    return self.lookup(kid.split('#')[0])
+
+  def get_tenant(self, tenant):
+    """ :return: {'tenant', 'webhook_url', 'identities'} or None if the tenant is unknown """
+    with self._connections.transaction() as connection:
+      row = connection.execute('SELECT webhook_url FROM tenants WHERE tenant = ?', (tenant,)).fetchone()
+      if row is None:
+        return None
+      identities = connection.execute('SELECT COUNT(*) FROM identities WHERE tenant = ?', (tenant,)).fetchone()[0]
+    return {'tenant': tenant, 'webhook_url': row[0], 'identities': identities}
+
+  def put_tenant(self, tenant, webhook_url=None):
+    """
+    Creates or updates the tenant.
+
+    :param webhook_url: The webhook notified of the messages to the tenant's DIDs (None: the configured webhook)
+    :raises ValueError: If the tenant name is invalid
+    """
+    _validate_tenant_name(tenant)
+    with self._connections.transaction(immediate=True) as connection:
+      connection.execute(
+        'INSERT OR REPLACE INTO tenants (tenant, webhook_url, version) '
+        'VALUES (?, ?, (SELECT COALESCE(MAX(version), 0) + 1 FROM tenants))', (tenant, webhook_url))
+    self.refresh()
+
+  def add_identity(self, did, tenant):
+    """
+    Records the server DID as owned by the tenant.
+
+    :raises ValueError: If the tenant is unknown
+    """
+    with self._connections.transaction(immediate=True) as connection:
+      if connection.execute('SELECT 1 FROM tenants WHERE tenant = ?', (tenant,)).fetchone() is None:
+        raise ValueError('Unknown tenant: {}'.format(tenant))
+      connection.execute(
+        'INSERT INTO identities (did, tenant, created_at) VALUES (?, ?, ?)', (did, tenant, time.time()))
+    self.refresh()
+
+  def count_identities(self):
+    return len(self._tenants_by_did)
+
+  def list_dids(self):
+    """ :return: The server DIDs of all tenants, as stored in the database """
+    with self._connections.transaction() as connection:
+      return [row[0] for row in connection.execute('SELECT did FROM identities')]
+
+  def refresh(self):
+    """ Loads the identities and tenant changes stored since the last refresh. """
+    with self._refresh_lock:
+      self._next_refresh = time.monotonic() + self.refresh_interval
+      with self._connections.transaction() as connection:
+        identities = connection.execute(
+          'SELECT seq, did, tenant FROM identities WHERE seq > ? ORDER BY seq', (self._identities_seq,)).fetchall()
+        tenants = connection.execute(
+          'SELECT version, tenant, webhook_url FROM tenants WHERE version > ? ORDER BY version',
+          (self._tenants_version,)).fetchall()
+      for seq, did, tenant in identities:
+        self._tenants_by_did[did] = tenant
+        self._identities_seq = seq
+      for version, tenant, webhook_url in tenants:
+        self._webhook_urls[tenant] = webhook_url
+        self._tenants_version = version
+
+
+def _validate_tenant_name(tenant):
+  if not isinstance(tenant, str) or not VALID_TENANT_NAME_REGEX.match(tenant):
+    raise ValueError('Invalid tenant name: {}. Tenant names match {}'.format(
+      tenant, VALID_TENANT_NAME_REGEX.pattern))
+
+
+class TenantsHandler:
+  """ Handles the requests of other services to manage tenants and create server DIDs for them. """
+
+  def __init__(self, tenant_registry, did_comm, service_endpoint):
+    """
+    :param did_comm: DIDComm creating the server DIDs (and storing their keys)
+    :param service_endpoint: Service endpoint of the created DIDs (the inbox of this service)
+    """
+    self.tenant_registry = tenant_registry
+    self.did_comm = did_comm
+    self.service_endpoint = service_endpoint
+
+  def handle_get_tenant(self, tenant):
+    tenant_data = self.tenant_registry.get_tenant(tenant)
+    if tenant_data is None:
+      return utils.generate_err_resp('Unknown tenant', constants.HTTP_NOT_FOUND)
+    return tenant_data, constants.HTTP_SUCCESS_STATUS
+
+  def handle_put_tenant(self, tenant, request_data):
+    """ Request body: {'webhook_url': <URL of the tenant's webhook, or null for the configured webhook>} """
+    if request_data is not None and not isinstance(request_data, dict):
+      return utils.generate_err_resp('Expected a JSON object', constants.HTTP_BAD_REQUEST)
+    webhook_url = (request_data or {}).get('webhook_url')
+    if webhook_url is not None and (not isinstance(webhook_url, str) or
+                                    not webhook_url.startswith(('http://', 'https://'))):
+      return utils.generate_err_resp('Invalid webhook_url', constants.HTTP_BAD_REQUEST)
+    try:
+      self.tenant_registry.put_tenant(tenant, webhook_url)
+    except ValueError as error:
+      return utils.generate_err_resp(str(error), constants.HTTP_BAD_REQUEST)
+    return self.handle_get_tenant(tenant)
+
+  def handle_create_identity(self, tenant):
+    """ Creates a new server DID owned by the tenant. """
+    if self.tenant_registry.get_tenant(tenant) is None:
+      return utils.generate_err_resp('Unknown tenant', constants.HTTP_NOT_FOUND)
+    did = self.did_comm.create_peer_did(self.service_endpoint)
+    self.tenant_registry.add_identity(did, tenant)
+    logging.info('Created server DID {} of tenant {}'.format(did, tenant))
+    return {'did': did, 'tenant': tenant}, constants.HTTP_CREATED
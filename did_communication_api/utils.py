@@ -1,11 +1,15 @@
-import sys
 import os
 import re
+import sys
 import logging
+import math
 import asyncio
+import importlib.util
+import time
+from urllib.parse import parse_qs
 from yaml import safe_load, YAMLError
 
-from did_communication_api import constants
+from did_communication_api import configuration, constants
 
 
 def load_component_configuration(component_name):
@@ -14,10 +18,6 @@ def load_component_configuration(component_name):
                   component_name, constants.VALID_COMPONENT_NAME_REGEX)
     return
 
-  if component_name == 'server':
-    # Exception for server config due to env variables (dirty fix)
-    return get_server_configuration()
-
   service_config = load_service_config()
   if component_name not in service_config:
     logging.error(constants.LOG_CNF_COMPONENT_MISSING, component_name)
@@ -26,21 +26,8 @@ def load_component_configuration(component_name):
 
 
 def load_service_config():
-  def terminate_program_with_message(message):
-    print(message)
-    sys.exit(1)
-
-  config_file_path = os.getenv(constants.CONFIG_FILE_PATH_ENV_VARIABLE,
-                               os.path.join(constants.PROJECT_DIRECTORY, 'config/config.yml'))
-  project_config = get_yaml_content(config_file_path, terminate_program_with_message)
-  if constants.CONF_SERVICES_NAME not in project_config:
-    logging.error(constants.LOG_CNF_NO_SERVICES)
-    terminate_program_with_message(constants.LOG_CNF_NO_SERVICES)
-  services_config = project_config[constants.CONF_SERVICES_NAME]
-  if constants.SERVICE_NAME not in services_config:
-    logging.error(constants.LOG_CNF_UNAVAIL_SERVICE)
-    terminate_program_with_message(constants.LOG_CNF_UNAVAIL_SERVICE)
-  return services_config[constants.SERVICE_NAME]
+  """ Returns the current (already parsed and validated) configuration snapshot of this service """
+  return configuration.get_configuration()
 
 
 def get_yaml_content(file_path, callback_on_error=None):
@@ -55,16 +42,27 @@ def get_yaml_content(file_path, callback_on_error=None):
 
 
 def get_server_configuration():
-  server_local_config = load_service_config()['server']
-  host = os.getenv('API_HOST', server_local_config['host'])
-  port = os.getenv('API_PORT', server_local_config['port'])
-  debug = os.getenv('API_DEBIG', server_local_config['debug'])
-
-  return {
-    'host': host,
-    'port': port,
-    'debug': debug
-  }
+  # Environment variable overrides are applied when the configuration snapshot is loaded
+  return load_service_config()['server']
+
+
+def lazy_import(module_name):
+  """
+  Returns the module without executing it: it is imported on first attribute access. Used for dependencies that
+  are only needed in some serving modes, so the others do not pay for importing them at startup.
+  """
+  module = sys.modules.get(module_name)
+  if module is not None:
+    return module
+  spec = importlib.util.find_spec(module_name)
+  if spec is None:
+    raise ModuleNotFoundError('No module named {!r}'.format(module_name), name=module_name)
+  loader = importlib.util.LazyLoader(spec.loader)
+  spec.loader = loader
+  module = importlib.util.module_from_spec(spec)
+  sys.modules[module_name] = module
+  loader.exec_module(module)
+  return module
 
 
 def get_or_create_eventloop():
@@ -77,6 +75,98 @@ def get_or_create_eventloop():
       return asyncio.get_event_loop()
 
 
+def get_batch_messages(request_data):
+  """
+  Returns the packed DIDComm messages of a batch request with the body {'didcomm_msgs': [<packed message>, ...]}
+
+  :param request_data: The parsed JSON body of the request
+  :return: (list of packed messages, None) or (None, error response) if the batch is invalid
+  """
+  max_messages = load_component_configuration('batch_inbox')['max_messages']
+  packed_msgs = request_data.get('didcomm_msgs') if isinstance(request_data, dict) else None
+  if not isinstance(packed_msgs, list) or not packed_msgs:
+    error_msg = 'Missing didcomm_msgs'
+  elif len(packed_msgs) > max_messages:
+    error_msg = 'Too many messages in batch (maximum: {})'.format(max_messages)
+  elif not all(isinstance(packed_msg, str) for packed_msg in packed_msgs):
+    error_msg = 'Invalid didcomm_msgs'
+  else:
+    return packed_msgs, None
+  logging.warning(constants.INVALID_BATCH_REQUEST_RECEIVED.format(error_msg))
+  return None, generate_err_resp(error_msg, constants.HTTP_BAD_REQUEST)
+
+
+def reply_thread_id(message_unpacked_dict):
+  """ :return: The thread id of a reply to the message: the thread of the message, or the message itself starts one """
+  return message_unpacked_dict.get('thid') or message_unpacked_dict['msg_id']
+
+
+def is_raw_didcomm_body(content_type):
+  """ True iff the request body is a packed DIDComm message (media type application/didcomm-encrypted+json) """
+  return bool(content_type) and content_type.split(';')[0].strip().lower() == constants.DIDCOMM_ENCRYPTED_MEDIA_TYPE
+
+
+def accepts_raw_didcomm(accept_header):
+  """ True iff the Accept header of the request lists the media type application/didcomm-encrypted+json """
+  if not accept_header:
+    return False
+  return any(is_raw_didcomm_body(media_range) for media_range in accept_header.split(','))
+
+
+def get_form_field(content_type, body, field_name):
+  """ :return: The value of the field of a form body (media type application/x-www-form-urlencoded), or None """
+  if not content_type or content_type.split(';')[0].strip().lower() != constants.FORM_MEDIA_TYPE:
+    return None
+  values = parse_qs(body.decode('utf-8', errors='replace')).get(field_name)
+  return values[0] if values else None
+
+
+def payload_too_large_resp():
+  max_body_size = load_component_configuration('inbox')['max_body_size']
+  logging.warning(constants.INVALID_REQUEST_RECEIVED.format('Body larger than {} bytes'.format(max_body_size)))
+  return generate_err_resp('Request body too large', constants.HTTP_PAYLOAD_TOO_LARGE)
+
+
+def retry_later_resp(error_msg, http_code, retry_after):
+  """ Error response asking the client to retry after retry_after seconds (also sent as Retry-After header) """
+  return {
+    'error': error_msg,
+    'retry_after': retry_after
+  }, http_code
+
+
+def overloaded_resp(retry_after):
+  logging.warning('Inbox saturated. Shedding request with HTTP 503')
+  return retry_later_resp('Service Unavailable', constants.HTTP_SERVICE_UNAVAILABLE, retry_after)
+
+
+def retry_after_headers(response_data):
+  """ :return: The Retry-After header of a retry_later_resp response, otherwise no headers """
+  if 'error' not in response_data or response_data.get('retry_after') is None:
+    return {}
+  return {'Retry-After': str(response_data['retry_after'])}
+
+
+def request_deadline(get_header):
+  """
+  :param get_header: Function returning the value of a header of the client's request (or None)
+  :return: The time (time.monotonic()) by which the response must be ready, derived from the time budget the client
+    sent in the configured deadline header; None if the client sent none
+  """
+  inbox_config = load_component_configuration('inbox')
+  budget = get_header(inbox_config['deadline_header'])
+  if budget is None:
+    return None
+  try:
+    budget = float(budget)
+    if not math.isfinite(budget):
+      raise ValueError(budget)
+  except ValueError:
+    logging.warning('Ignoring invalid {} header: {}'.format(inbox_config['deadline_header'], budget))
+    return None
+  return time.monotonic() + budget - inbox_config['deadline_reserve']
+
+
 def generate_err_resp(error_msg, http_code):
 
   return {
@@ -0,0 +1,263 @@
+""" Pooled keep-alive HTTP client used to notify the configured webhooks. """
+
+import concurrent.futures
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from did_communication_api import compression, utils
+from did_communication_api.circuit_breaker import CircuitBreaker
+
+# Only used in the asynchronous serving mode (ASGI)
+httpx = utils.lazy_import('httpx')
+
+
+class WebhookPoolStats:
+  """ Counters of the connection pool of a WebhookClient """
+
+  def __init__(self):
+    self.requests = 0
+    self.connections_created = 0
+    self.wait_time_total = 0.0
+    self.wait_time_max = 0.0
+    self._lock = threading.Lock()
+
+  def connection_created(self):
+    with self._lock:
+      self.connections_created += 1
+
+  def connection_checked_out(self, wait_time):
+    with self._lock:
+      self.requests += 1
+      self.wait_time_total += wait_time
+      self.wait_time_max = max(self.wait_time_max, wait_time)
+
+  def as_dict(self):
+    with self._lock:
+      return {
+        'requests': self.requests,
+        'connections_created': self.connections_created,
+        'connections_reused': max(0, self.requests - self.connections_created),
+        'wait_time_total_seconds': self.wait_time_total,
+        'wait_time_max_seconds': self.wait_time_max,
+      }
+
+
+class WebhookClient:
+  """
+  Sends webhook notifications over a requests Session with a bounded pool of keep-alive connections.
+
+  A client must not be shared between processes, use get_webhook_client() to get the one of the current process.
+  """
+
+  def __init__(self, pool_size=10, pool_block=False, connect_timeout=3.05, read_timeout=30):
+    """
+    :param pool_size: Maximum number of keep-alive connections kept per webhook host
+    :param pool_block: If True, wait for a free connection when all pooled connections are in use instead of
+      opening an additional (not pooled) connection
+    :param connect_timeout: Seconds to wait for the TCP connection to the webhook
+    :param read_timeout: Seconds to wait for the webhook's response
+    """
+    self.stats = WebhookPoolStats()
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.session = requests.Session()
+    adapter = _InstrumentedHTTPAdapter(
+      self.stats, pool_connections=pool_size, pool_maxsize=pool_size, pool_block=pool_block)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
+  def post(self, url, json_data, read_timeout=None):
+    """
+    POSTs the JSON data (compressed if configured, see compression.encode_webhook_body) to the url.
+    Raises requests.exceptions.RequestException on failure.
+
+    :param read_timeout: Seconds to wait for the webhook's response, if shorter than the configured read timeout
+    """
+    body, headers = compression.encode_webhook_body(json_data)
+    return self.session.post(
+      url, data=body, headers=headers, timeout=(self.connect_timeout, read_timeout or self.read_timeout))
+
+  def close(self):
+    self.session.close()
+
+
+class AsyncWebhookClient:
+  """
+  Sends webhook notifications from the event loop of the ASGI application using an httpx connection pool.
+
+  A client is bound to the event loop it is used on, use get_async_webhook_client() to get the one of the
+  current process.
+  """
+
+  def __init__(self, pool_size=10, connect_timeout=3.05, read_timeout=30, http2=False):
+    """
+    :param pool_size: Maximum number of (keep-alive) connections
+    :param connect_timeout: Seconds to wait for the TCP connection to the webhook
+    :param read_timeout: Seconds to wait for the webhook's response
+    :param http2: Negotiate HTTP/2 with the webhook (requires the h2 package)
+    """
+    self.read_timeout = read_timeout
+    self.client = httpx.AsyncClient(
+      limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+      timeout=httpx.Timeout(read_timeout, connect=connect_timeout, pool=None),
+      http2=http2,
+    )
+
+  async def post(self, url, json_data, read_timeout=None):
+    """
+    POSTs the JSON data (compressed if configured, see compression.encode_webhook_body) to the url.
+    Raises httpx.HTTPError on failure.
+
+    :param read_timeout: Seconds to wait for the webhook's response, if shorter than the configured read timeout
+    """
+    body, headers = compression.encode_webhook_body(json_data)
+    if read_timeout is None:
+      return await self.client.post(url, content=body, headers=headers)
+    return await self.client.post(
+      url, content=body, headers=headers,
+      timeout=httpx.Timeout(read_timeout, connect=self.client.timeout.connect, pool=None))
+
+  async def close(self):
+    await self.client.aclose()
+
+
+class _InstrumentedHTTPAdapter(HTTPAdapter):
+  """ HTTPAdapter whose connection pools report to WebhookPoolStats """
+
+  def __init__(self, stats, **kwargs):
+    # Must be set before HTTPAdapter.__init__ which initializes the pool manager
+    self.stats = stats
+    super().__init__(**kwargs)
+
+  def init_poolmanager(self, *args, **kwargs):
+    super().init_poolmanager(*args, **kwargs)
+    self.poolmanager.pool_classes_by_scheme = {
+      'http': _instrumented_pool_class(HTTPConnectionPool, self.stats),
+      'https': _instrumented_pool_class(HTTPSConnectionPool, self.stats),
+    }
+
+
+def _instrumented_pool_class(pool_class, stats):
+
+  class InstrumentedConnection(pool_class.ConnectionCls):
+
+    def connect(self):
+      stats.connection_created()
+      super().connect()
+
+  class InstrumentedConnectionPool(pool_class):
+    ConnectionCls = InstrumentedConnection
+
+    def _get_conn(self, timeout=None):
+      started = time.perf_counter()
+      conn = super()._get_conn(timeout)
+      stats.connection_checked_out(time.perf_counter() - started)
+      return conn
+
+  return InstrumentedConnectionPool
+
+
+_clients = {}
+_async_clients = {}
+_clients_lock = threading.Lock()
+# pid -> {webhook URL -> CircuitBreaker}
+_breakers = {}
+_hedge_executors = {}
+
+
+def get_webhook_client():
+  """ Returns the WebhookClient of the current worker process, creating it on first use. """
+  pid = os.getpid()
+  client = _clients.get(pid)
+  if client is None:
+    with _clients_lock:
+      client = _clients.get(pid)
+      if client is None:
+        # Never reuse sockets inherited from the parent process (gunicorn --preload)
+        _clients.clear()
+        webhooks_config = utils.load_component_configuration('webhooks')
+        client = WebhookClient(
+          pool_size=webhooks_config['pool_size'],
+          pool_block=webhooks_config['pool_block'],
+          connect_timeout=webhooks_config['connect_timeout'],
+          read_timeout=webhooks_config['read_timeout'],
+        )
+        _clients[pid] = client
+  return client
+
+
+def get_async_webhook_client():
+  """ Returns the AsyncWebhookClient of the current worker process, creating it on first use. """
+  pid = os.getpid()
+  client = _async_clients.get(pid)
+  if client is None:
+    _async_clients.clear()
+    webhooks_config = utils.load_component_configuration('webhooks')
+    client = AsyncWebhookClient(
+      pool_size=webhooks_config['pool_size'],
+      connect_timeout=webhooks_config['connect_timeout'],
+      read_timeout=webhooks_config['read_timeout'],
+      http2=webhooks_config['http2'],
+    )
+    _async_clients[pid] = client
+  return client
+
+
+async def close_async_webhook_client():
+  client = _async_clients.pop(os.getpid(), None)
+  if client is not None:
+    await client.close()
+
+
+def get_circuit_breaker(url):
+  """
+  Returns the CircuitBreaker of the webhook in the current worker process, creating it on first use.
+  Returns None if the circuit breaker is disabled.
+  """
+  pid = os.getpid()
+  breakers = _breakers.get(pid)
+  breaker = breakers.get(url) if breakers is not None else None
+  if breaker is None:
+    breaker_config = utils.load_component_configuration('webhook_circuit_breaker')
+    if not breaker_config['enabled']:
+      return None
+    with _clients_lock:
+      if pid not in _breakers:
+        # The state of the parent process (gunicorn --preload) is not the one of this process
+        _breakers.clear()
+        _breakers[pid] = {}
+      breaker = _breakers[pid].get(url)
+      if breaker is None:
+        breaker = CircuitBreaker(
+          url,
+          window_size=breaker_config['window_size'],
+          minimum_calls=breaker_config['minimum_calls'],
+          failure_rate_threshold=breaker_config['failure_rate_threshold'],
+          slow_call_duration=breaker_config['slow_call_duration'],
+          slow_call_rate_threshold=breaker_config['slow_call_rate_threshold'],
+          open_seconds=breaker_config['open_seconds'],
+        )
+        _breakers[pid][url] = breaker
+  return breaker
+
+
+def get_hedge_executor():
+  """ Returns the executor sending the hedged webhook requests of the current worker process. """
+  pid = os.getpid()
+  executor = _hedge_executors.get(pid)
+  if executor is None:
+    with _clients_lock:
+      executor = _hedge_executors.get(pid)
+      if executor is None:
+        _hedge_executors.clear()
+        # Each hedged notification occupies up to two workers: one per webhook
+        executor = concurrent.futures.ThreadPoolExecutor(
+          max_workers=2 * utils.load_component_configuration('webhooks')['pool_size'],
+          thread_name_prefix='webhook-hedge')
+        _hedge_executors[pid] = executor
+  return executor
@@ -0,0 +1,168 @@
+"""
+WebSocket transport of the DIDComm inbox (asynchronous serving mode only).
+
+A client keeps one connection open and sends packed DIDComm messages as frames. Every message is handled like a
+message to the inbox, concurrently with the other messages of the connection, and answered with a frame as soon as
+its response is ready - so responses may arrive in a different order than the messages were sent.
+"""
+
+import asyncio
+import json
+import logging
+
+from did_communication_api import constants, metrics, utils
+
+# WebSocket close codes
+CLOSE_NORMAL = 1000
+CLOSE_MESSAGE_TOO_BIG = 1009
+CLOSE_TRY_AGAIN_LATER = 1013
+
+# The webhook is notified of messages received on WebSocket connections as of messages POSTed to the inbox
+WEBSOCKET_HTTP_METHOD = 'POST'
+
+
+class WebSocketInbox:
+  """
+  Serves the WebSocket connections of a worker process.
+
+  Every connection handles at most max_in_flight messages at a time; further frames are not read until a response
+  was sent, so a fast client is slowed down by TCP flow control instead of queueing messages in memory. Connections
+  without messages in flight for idle_timeout seconds are closed.
+  """
+
+  def __init__(self, api_handler, max_in_flight=16, idle_timeout=60, max_connections=1000,
+               max_message_size=10485760, admission_controller=None):
+    """
+    :param max_in_flight: Maximum number of messages handled concurrently per connection
+    :param idle_timeout: Seconds after which a connection without messages in flight is closed
+    :param max_connections: Maximum number of open connections of this worker process
+    :param max_message_size: Maximum size of a frame in bytes (larger frames close the connection)
+    :param admission_controller: AdmissionController of the inbox; every message is admitted like an inbox request
+    """
+    self.api_handler = api_handler
+    self.max_in_flight = max_in_flight
+    self.idle_timeout = idle_timeout
+    self.max_connections = max_connections
+    self.max_message_size = max_message_size
+    self.admission_controller = admission_controller
+    self.connections = 0
+
+  async def handle(self, scope, receive, send):
+    """ Serves a WebSocket connection (ASGI websocket scope) until it is closed. """
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+      return
+    if self.connections >= self.max_connections:
+      logging.warning('Too many WebSocket connections. Rejecting connection')
+      await send({'type': 'websocket.close', 'code': CLOSE_TRY_AGAIN_LATER})
+      metrics.observe_websocket_close(metrics.WEBSOCKET_CLOSE_REJECTED)
+      return
+
+    self.connections += 1
+    metrics.WEBSOCKET_CONNECTIONS.inc()
+    try:
+      await send({'type': 'websocket.accept'})
+      close_reason = await _WebSocketConnection(self, receive, send).serve()
+      metrics.observe_websocket_close(close_reason)
+    finally:
+      self.connections -= 1
+      metrics.WEBSOCKET_CONNECTIONS.dec()
+
+  async def respond(self, packed_msg):
+    """ :return: The response to a message received on a connection as (response data, http code) """
+    if self.admission_controller is None:
+      return await self.api_handler.handle_message_received_async(packed_msg, WEBSOCKET_HTTP_METHOD)
+    if not await self.admission_controller.acquire_async():
+      return utils.overloaded_resp(self.admission_controller.retry_after)
+    try:
+      return await self.api_handler.handle_message_received_async(packed_msg, WEBSOCKET_HTTP_METHOD)
+    finally:
+      await self.admission_controller.release_async()
+
+
+class _WebSocketConnection:
+
+  def __init__(self, inbox, receive, send):
+    self.inbox = inbox
+    self.receive = receive
+    self.send = send
+    self.in_flight = asyncio.Semaphore(inbox.max_in_flight)
+    self.tasks = set()
+    self.closed = False
+    # Number of frames received, sent back with every response so clients can match error responses too
+    self.seq = 0
+
+  async def serve(self):
+    """ :return: The reason the connection was closed (metrics.WEBSOCKET_CLOSE_*) """
+    try:
+      while True:
+        # Flow control: the next frame is read once fewer than max_in_flight messages are being handled
+        await self.in_flight.acquire()
+        message = await self._receive()
+        if message is None:
+          self.in_flight.release()
+          await self._close(CLOSE_NORMAL)
+          return metrics.WEBSOCKET_CLOSE_IDLE
+        if message['type'] == 'websocket.disconnect':
+          self.closed = True
+          return metrics.WEBSOCKET_CLOSE_CLIENT
+
+        # The size limit applies to the frame in bytes, as inbox.max_body_size does to request bodies
+        packed_msg = message.get('text')
+        if packed_msg is not None:
+          frame_size = len(packed_msg.encode('utf-8'))
+        else:
+          frame = message.get('bytes') or b''
+          frame_size = len(frame)
+        if frame_size > self.inbox.max_message_size:
+          logging.warning(constants.INVALID_REQUEST_RECEIVED.format(
+            'WebSocket frame larger than {} bytes'.format(self.inbox.max_message_size)))
+          self.in_flight.release()
+          await self._close(CLOSE_MESSAGE_TOO_BIG)
+          return metrics.WEBSOCKET_CLOSE_TOO_BIG
+        if packed_msg is None:
+          packed_msg = frame.decode('utf-8', errors='replace')
+
+        self.seq += 1
+        task = asyncio.ensure_future(self._respond(self.seq, packed_msg))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    finally:
+      # Messages in flight are handled to the end (the webhook was notified), even if their responses are dropped
+      if self.tasks:
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+  async def _receive(self):
+    """ :return: The next ASGI message, or None if the connection was idle for idle_timeout seconds """
+    while True:
+      try:
+        return await asyncio.wait_for(self.receive(), self.inbox.idle_timeout)
+      except asyncio.TimeoutError:
+        if not self.tasks:
+          return None
+
+  async def _respond(self, seq, packed_msg):
+    try:
+      response_data, http_code = await self.inbox.respond(packed_msg)
+      await self._send_frame(dict(response_data, http_code=http_code, seq=seq))
+    except Exception:
+      logging.exception('Could not respond to a message received on a WebSocket connection')
+      await self._send_frame(dict(
+        utils.generate_err_resp('Internal Server Error', constants.HTTP_INTERNAL_ERROR)[0],
+        http_code=constants.HTTP_INTERNAL_ERROR, seq=seq))
+    finally:
+      self.in_flight.release()
+
+  async def _send_frame(self, frame):
+    if self.closed:
+      return
+    try:
+      await self.send({'type': 'websocket.send', 'text': json.dumps(frame)})
+    except Exception as error:
+      # The client closed the connection meanwhile
+      logging.debug('Could not send a WebSocket frame: {}'.format(str(error)))
+      self.closed = True
+
+  async def _close(self, code):
+    self.closed = True
+    await self.send({'type': 'websocket.close', 'code': code})
@@ -1,3 +1,13 @@
 #! /bin/sh
 
-gunicorn --preload --workers=2 --timeout 60 -k eventlet -b :${API_PORT} did_communication_api.__main__:flask_app
+# Metrics of all worker processes are aggregated in this directory; it must be empty when the service starts
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/did_comm_api_metrics}"
+rm -rf "${PROMETHEUS_MULTIPROC_DIR}"
+mkdir -p "${PROMETHEUS_MULTIPROC_DIR}"
+
+if [ "${SERVER_MODE}" = "asgi" ]; then
+  # Asynchronous serving mode: the inbox is served natively on the event loop of each worker
+  exec gunicorn -c python:did_communication_api.gunicorn_config --preload --workers=2 --timeout 60 -k uvicorn.workers.UvicornWorker -b :${API_PORT} did_communication_api.asgi:app
+fi
+
+gunicorn -c python:did_communication_api.gunicorn_config --preload --workers=2 --timeout 60 -k eventlet -b :${API_PORT} did_communication_api.__main__:flask_app
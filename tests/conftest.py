@@ -0,0 +1,31 @@
+import os
+
+import pytest
+
+from did_communication_api import configuration, constants
+
+SHIPPED_CONFIG_PATH = os.path.join(constants.PROJECT_DIRECTORY, 'config/config.yml')
+
+
+@pytest.fixture
+def config_file(tmp_path, monkeypatch):
+  """
+  Writes a copy of the shipped config.yml with the given replacements and makes it the configuration of the service
+  (loaded on next use, without waiting for the store to notice the changed file).
+
+  :return: Function (replacements: list of (old, new) strings) -> path of the written file
+  """
+  file_path = tmp_path / 'config.yml'
+
+  def write(replacements=()):
+    with open(SHIPPED_CONFIG_PATH, 'r') as file:
+      content = file.read()
+    for old, new in replacements:
+      assert old in content, old
+      content = content.replace(old, new)
+    file_path.write_text(content)
+    monkeypatch.setenv(constants.CONFIG_FILE_PATH_ENV_VARIABLE, str(file_path))
+    monkeypatch.setattr(configuration, '_store', None)
+    return str(file_path)
+
+  return write
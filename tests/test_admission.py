@@ -0,0 +1,93 @@
+import asyncio
+import threading
+import time
+
+from did_communication_api import admission
+from did_communication_api.admission import AdmissionController, SenderRateLimiter
+
+
+def test_requests_beyond_max_in_flight_are_shed_without_queue():
+  controller = AdmissionController(max_in_flight=2, max_queued=0, queue_timeout=1)
+
+  assert controller.acquire() is True
+  assert controller.acquire() is True
+  assert controller.acquire() is False
+
+  controller.release()
+  assert controller.acquire() is True
+  assert controller.in_flight == 2
+
+
+def test_queued_request_is_shed_after_queue_timeout():
+  controller = AdmissionController(max_in_flight=1, max_queued=1, queue_timeout=0.1)
+  controller.acquire()
+
+  started = time.monotonic()
+  assert controller.acquire() is False
+  assert time.monotonic() - started >= 0.1
+  assert controller.queued == 0
+
+
+def test_queued_request_is_admitted_on_release():
+  controller = AdmissionController(max_in_flight=1, max_queued=1, queue_timeout=5)
+  controller.acquire()
+  timer = threading.Timer(0.1, controller.release)
+  timer.start()
+
+  try:
+    assert controller.acquire() is True
+  finally:
+    timer.join()
+  assert controller.in_flight == 1
+  assert controller.queued == 0
+
+
+def test_requests_finding_queue_full_are_shed_immediately():
+  controller = AdmissionController(max_in_flight=1, max_queued=1, queue_timeout=5)
+  controller.acquire()
+  queued = threading.Thread(target=controller.acquire)
+  queued.start()
+  while controller.queued == 0:
+    time.sleep(0.01)
+
+  started = time.monotonic()
+  assert controller.acquire() is False
+  assert time.monotonic() - started < 1
+
+  controller.release()
+  queued.join()
+  assert controller.in_flight == 1
+
+
+def test_async_requests_are_shed_and_admitted():
+  controller = AdmissionController(max_in_flight=1, max_queued=1, queue_timeout=0.1)
+
+  async def handle_requests():
+    assert await controller.acquire_async() is True
+    # Shed after waiting queue_timeout
+    assert await controller.acquire_async() is False
+
+    async def release_later():
+      await asyncio.sleep(0.05)
+      await controller.release_async()
+
+    admitted, _ = await asyncio.gather(controller.acquire_async(), release_later())
+    return admitted
+
+  assert asyncio.run(handle_requests()) is True
+  assert controller.in_flight == 1
+  assert controller.queued == 0
+
+
+def test_sender_may_send_burst_then_rate(monkeypatch):
+  now = 1000.0
+  monkeypatch.setattr(admission.time, 'monotonic', lambda: now)
+  limiter = SenderRateLimiter(rate=2, burst=3)
+
+  assert [limiter.acquire('did:peer:2.a') for _ in range(4)] == [0, 0, 0, 1]
+  # Other senders have their own bucket
+  assert limiter.acquire('did:peer:2.b') == 0
+
+  now += 0.5
+  assert limiter.acquire('did:peer:2.a') == 0
+  assert limiter.acquire('did:peer:2.a') == 1
@@ -0,0 +1,92 @@
+import pytest
+
+from did_communication_api import circuit_breaker
+from did_communication_api.circuit_breaker import STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN, CircuitBreaker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+  """ Time of the circuit breakers, advanced by the tests """
+  now = [1000.0]
+  monkeypatch.setattr(circuit_breaker.time, 'monotonic', lambda: now[0])
+  return now
+
+
+def _open_breaker(breaker):
+  for _ in range(breaker.minimum_calls):
+    assert breaker.allow()
+    breaker.record(False, 0.1)
+  assert breaker.state == STATE_OPEN
+
+
+def test_breaker_opens_at_failure_rate(clock):
+  breaker = CircuitBreaker('webhook', window_size=10, minimum_calls=4, failure_rate_threshold=0.5)
+  for success in (True, False, True):
+    breaker.record(success, 0.1)
+  assert breaker.state == STATE_CLOSED
+
+  breaker.record(False, 0.1)
+
+  assert breaker.state == STATE_OPEN
+  assert breaker.allow() is False
+
+
+def test_breaker_opens_at_slow_call_rate(clock):
+  breaker = CircuitBreaker('webhook', minimum_calls=2, slow_call_duration=1.0, slow_call_rate_threshold=1.0)
+  breaker.record(True, 1.5)
+  breaker.record(True, 2.0)
+
+  assert breaker.state == STATE_OPEN
+
+
+def test_half_open_breaker_lets_one_trial_call_through(clock):
+  breaker = CircuitBreaker('webhook', minimum_calls=2, open_seconds=10)
+  _open_breaker(breaker)
+
+  clock[0] += 9
+  assert breaker.allow() is False
+  clock[0] += 1
+
+  assert breaker.allow() is True
+  assert breaker.state == STATE_HALF_OPEN
+  assert breaker.allow() is False
+
+
+def test_successful_trial_call_closes_breaker(clock):
+  breaker = CircuitBreaker('webhook', minimum_calls=2, open_seconds=10)
+  _open_breaker(breaker)
+  clock[0] += 10
+  breaker.allow()
+
+  breaker.record(True, 0.1)
+
+  assert breaker.state == STATE_CLOSED
+  assert breaker.allow() is True
+  assert breaker.allow() is True
+
+
+@pytest.mark.parametrize('success, duration', [(False, 0.1), (True, 10.0)])
+def test_failed_or_slow_trial_call_opens_breaker_again(clock, success, duration):
+  breaker = CircuitBreaker('webhook', minimum_calls=2, slow_call_duration=5.0, open_seconds=10)
+  _open_breaker(breaker)
+  clock[0] += 10
+  breaker.allow()
+
+  breaker.record(success, duration)
+
+  assert breaker.state == STATE_OPEN
+  assert breaker.allow() is False
+  clock[0] += 10
+  assert breaker.allow() is True
+
+
+def test_cancelled_trial_call_lets_next_trial_through(clock):
+  breaker = CircuitBreaker('webhook', minimum_calls=2, open_seconds=10)
+  _open_breaker(breaker)
+  clock[0] += 10
+  breaker.allow()
+
+  breaker.cancel()
+
+  assert breaker.state == STATE_HALF_OPEN
+  assert breaker.allow() is True
@@ -0,0 +1,95 @@
+import zlib
+
+import pytest
+
+from did_communication_api import compression, constants
+from did_communication_api.errors import DecompressedBodyTooLargeError, DecompressionError
+
+BODY = b'{"didcomm_msg": "' + b'eyJwcm90ZWN0ZWQiOi' * 200 + b'"}'
+
+
+@pytest.fixture
+def compression_enabled(config_file):
+  def enable(max_decompressed_size=10485760, max_ratio=100):
+    config_file([
+      ('enabled: false # Accept compressed', 'enabled: true # Accept compressed'),
+      ('max_decompressed_size: 10485760', 'max_decompressed_size: {}'.format(max_decompressed_size)),
+      ('max_ratio: 100', 'max_ratio: {}'.format(max_ratio)),
+    ])
+  return enable
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'deflate', 'zstd'])
+def test_decompress_round_trip(encoding):
+  if encoding == compression.ENCODING_ZSTD:
+    pytest.importorskip('zstandard')
+
+  assert compression.decompress(compression.compress(BODY, encoding, 6), encoding, len(BODY)) == BODY
+
+
+def test_decompress_raw_deflate():
+  compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+  assert compression.decompress(compressor.compress(BODY) + compressor.flush(), 'deflate', len(BODY)) == BODY
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'deflate', 'zstd'])
+def test_decompress_stops_at_max_size(encoding):
+  if encoding == compression.ENCODING_ZSTD:
+    pytest.importorskip('zstandard')
+
+  with pytest.raises(DecompressedBodyTooLargeError):
+    compression.decompress(compression.compress(BODY, encoding, 6), encoding, len(BODY) - 1)
+
+
+def test_decompress_rejects_truncated_body():
+  with pytest.raises(DecompressionError):
+    compression.decompress(compression.compress(BODY, 'gzip', 6)[:-20], 'gzip', len(BODY))
+
+
+def test_decode_request_body(compression_enabled):
+  compression_enabled()
+
+  assert compression.decode_request_body(compression.compress(BODY, 'gzip', 6), 'gzip') == (BODY, None)
+  assert compression.decode_request_body(BODY, 'identity') == (BODY, None)
+
+
+def test_decode_request_body_rejects_body_beyond_max_decompressed_size(compression_enabled):
+  compression_enabled(max_decompressed_size=len(BODY) - 1, max_ratio='null')
+
+  _, (_, http_code) = compression.decode_request_body(compression.compress(BODY, 'gzip', 6), 'gzip')
+
+  assert http_code == constants.HTTP_PAYLOAD_TOO_LARGE
+
+
+def test_decode_request_body_rejects_body_beyond_max_ratio(compression_enabled):
+  # A decompression bomb: 1 MB of zeros compresses to about 1 kB
+  bomb = compression.compress(b'\0' * 1048576, 'gzip', 9)
+  compression_enabled(max_ratio=100)
+
+  body, (_, http_code) = compression.decode_request_body(bomb, 'gzip')
+
+  assert body is None
+  assert http_code == constants.HTTP_PAYLOAD_TOO_LARGE
+  compression_enabled(max_ratio='null')
+  assert compression.decode_request_body(bomb, 'gzip')[0] == b'\0' * 1048576
+
+
+@pytest.mark.parametrize('content_encoding, http_code', [
+  ('br', constants.HTTP_UNSUPPORTED_MEDIA_TYPE),
+  ('gzip, gzip', constants.HTTP_UNSUPPORTED_MEDIA_TYPE),
+  ('gzip', constants.HTTP_BAD_REQUEST),
+])
+def test_decode_request_body_rejects_invalid_encodings(compression_enabled, content_encoding, http_code):
+  compression_enabled()
+
+  _, (_, error_http_code) = compression.decode_request_body(b'not compressed', content_encoding)
+
+  assert error_http_code == http_code
+
+
+def test_compressed_request_body_is_passed_through_if_compression_is_disabled(config_file):
+  config_file()
+  compressed_body = compression.compress(BODY, 'gzip', 6)
+
+  assert compression.decode_request_body(compressed_body, 'gzip') == (compressed_body, None)
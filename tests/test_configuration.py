@@ -0,0 +1,75 @@
+import logging
+import os
+
+import pytest
+
+from did_communication_api import configuration
+from did_communication_api.errors import ConfigurationError
+
+
+def _touch_later(file_path):
+  # The store detects changes by the mtime of the file, which may not advance within the resolution of the filesystem
+  stat = os.stat(file_path)
+  os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+
+def test_load_configuration_applies_defaults(config_file):
+  snapshot = configuration.load_configuration(config_file())
+
+  assert snapshot['compression']['max_ratio'] == 100
+  assert snapshot['async_delivery']['response_ttl'] == 604800
+  with pytest.raises(TypeError):
+    snapshot['compression']['max_ratio'] = 1
+
+
+def test_load_configuration_rejects_invalid_values(config_file):
+  with pytest.raises(ConfigurationError):
+    configuration.load_configuration(config_file([('pool_size: 10', "pool_size: 'abc'")]))
+
+
+def test_store_reloads_changed_file(config_file, monkeypatch):
+  monkeypatch.setattr(configuration, 'FILE_CHECK_INTERVAL', 0.0)
+  file_path = config_file()
+  store = configuration.ConfigurationStore(file_path)
+  assert store.get()['compression']['enabled'] is False
+
+  config_file([('enabled: false # Accept compressed', 'enabled: true # Accept compressed')])
+  _touch_later(file_path)
+
+  assert store.get()['compression']['enabled'] is True
+
+
+def test_store_keeps_previous_snapshot_if_reload_fails(config_file):
+  file_path = config_file()
+  store = configuration.ConfigurationStore(file_path)
+  snapshot = store.get()
+
+  config_file([('pool_size: 10', "pool_size: 'abc'")])
+
+  assert store.reload() is False
+  assert store.get() is snapshot
+
+
+def test_request_reload_reloads_on_next_get(config_file):
+  file_path = config_file()
+  store = configuration.ConfigurationStore(file_path)
+  snapshot = store.get()
+
+  # Within FILE_CHECK_INTERVAL of loading, changes of the file are only seen after a requested reload
+  config_file([('max_ratio: 100', 'max_ratio: 50')])
+  store.request_reload()
+
+  assert store.get() is not snapshot
+  assert store.get()['compression']['max_ratio'] == 50
+
+
+def test_reload_warns_about_restart_required_changes(config_file, caplog):
+  file_path = config_file()
+  store = configuration.ConfigurationStore(file_path)
+
+  config_file([('pool_size: 10', 'pool_size: 20'), ('max_ratio: 100', 'max_ratio: 50')])
+  with caplog.at_level(logging.WARNING):
+    assert store.reload() is True
+
+  assert 'webhooks.pool_size' in caplog.text
+  assert 'compression' not in caplog.text
@@ -0,0 +1,85 @@
+import pytest
+
+from did_communication_api.decision_cache import DecisionCache, decision_key, ttl_of
+
+RECIPIENT = 'did:peer:2.server'
+RESPONSE = {'msg_body': {'decision': 'permit'}, 'cache_ttl': 60}
+
+
+def _key(sender='did:peer:2.sender', msg_type='https://example.org/request', body=None):
+  message = {'frm': sender, 'msg_type': msg_type, 'msg_body': body or {'resource': 'a'}, 'attachments': []}
+  return decision_key(message, 'GET', RECIPIENT)
+
+
+@pytest.fixture
+def shared_path(tmp_path):
+  return str(tmp_path / 'decisions.db')
+
+
+def test_stored_decision_is_reused():
+  cache = DecisionCache(max_entries=100, max_ttl=300)
+  key = _key()
+  assert cache.get(key) is None
+
+  cache.put(key, RESPONSE, ttl_of(RESPONSE), cache.generation())
+
+  assert cache.get(_key()) == RESPONSE
+  assert cache.get(_key(body={'resource': 'b'})) is None
+
+
+def test_decision_without_ttl_is_not_stored():
+  cache = DecisionCache(max_entries=100, max_ttl=300)
+
+  cache.put(_key(), {'msg_body': {}}, ttl_of({'msg_body': {}}), cache.generation())
+
+  assert cache.get(_key()) is None
+
+
+def test_invalidate_removes_decisions_of_sender_or_message_type():
+  cache = DecisionCache(max_entries=100, max_ttl=300)
+  keys = [_key(), _key(sender='did:peer:2.other'), _key(msg_type='https://example.org/other')]
+  for key in keys:
+    cache.put(key, RESPONSE, 60, cache.generation())
+
+  cache.invalidate(sender='did:peer:2.sender')
+  assert [cache.get(key) is not None for key in keys] == [False, True, False]
+
+  cache.invalidate()
+  assert cache.get(keys[1]) is None
+
+
+def test_decision_of_request_looked_up_before_invalidation_is_not_stored():
+  cache = DecisionCache(max_entries=100, max_ttl=300)
+  generation = cache.generation()
+
+  # The webhook decides on the request while the decisions of its sender are invalidated
+  cache.invalidate(sender='did:peer:2.sender')
+  cache.put(_key(), RESPONSE, 60, generation)
+
+  assert cache.get(_key()) is None
+  cache.put(_key(), RESPONSE, 60, cache.generation())
+  assert cache.get(_key()) == RESPONSE
+
+
+def test_invalidations_are_shared_across_processes(shared_path):
+  # Two caches on the same invalidations database, as used by two worker processes
+  cache = DecisionCache(max_entries=100, max_ttl=300, invalidations_path=shared_path, invalidation_check_interval=0)
+  other_cache = DecisionCache(
+    max_entries=100, max_ttl=300, invalidations_path=shared_path, invalidation_check_interval=0)
+  generation = cache.generation()
+  cache.put(_key(), RESPONSE, 60, generation)
+
+  other_cache.invalidate(msg_type='https://example.org/request')
+
+  assert cache.get(_key()) is None
+  assert cache.generation() == generation + 1
+  cache.put(_key(), RESPONSE, 60, generation)
+  assert cache.get(_key()) is None
+
+
+def test_invalidations_of_earlier_runs_are_ignored(shared_path):
+  DecisionCache(max_entries=100, max_ttl=300, invalidations_path=shared_path).invalidate()
+
+  cache = DecisionCache(max_entries=100, max_ttl=300, invalidations_path=shared_path, invalidation_check_interval=0)
+
+  assert cache.generation() == 0
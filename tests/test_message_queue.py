@@ -0,0 +1,111 @@
+import time
+
+import pytest
+
+from did_communication_api import message_queue
+from did_communication_api.message_queue import MessageQueue
+
+SENDER = 'did:peer:2.sender'
+
+
+@pytest.fixture
+def queue(tmp_path):
+  return MessageQueue(str(tmp_path / 'message_queue.db'), lease_seconds=60)
+
+
+def _message(step):
+  return {'msg_id': 'm{}'.format(step), 'msg_body': {'step': step}}
+
+
+def test_claim_requests_in_order_of_arrival(queue):
+  request_ids = [queue.enqueue_request(SENDER, 'POST', _message(step)) for step in range(3)]
+
+  claimed = queue.claim_requests(2)
+
+  assert [request.id for request in claimed] == request_ids[:2]
+  assert claimed[0].sender == SENDER
+  assert claimed[0].http_method == 'POST'
+  assert claimed[0].message == _message(0)
+  assert claimed[0].attempts == 1
+
+
+def test_claimed_requests_are_leased(queue):
+  queue.enqueue_request(SENDER, 'POST', _message(0))
+  assert len(queue.claim_requests(10)) == 1
+
+  assert queue.claim_requests(10) == []
+  assert queue.count_requests() == 1
+
+
+def test_claim_after_expired_lease(queue, monkeypatch):
+  request_id = queue.enqueue_request(SENDER, 'POST', _message(0))
+  queue.claim_requests(10)
+
+  # A dispatcher which crashed while holding the lease
+  now = time.time()
+  monkeypatch.setattr(message_queue.time, 'time', lambda: now + queue.lease_seconds + 1)
+  claimed = queue.claim_requests(10)
+
+  assert [request.id for request in claimed] == [request_id]
+  assert claimed[0].attempts == 2
+
+
+def test_retry_request_after_delay(queue, monkeypatch):
+  request_id = queue.enqueue_request(SENDER, 'POST', _message(0))
+  queue.claim_requests(10)
+
+  queue.retry_request(request_id, 0)
+  claimed = queue.claim_requests(10)
+  assert [(request.id, request.attempts) for request in claimed] == [(request_id, 2)]
+
+  queue.retry_request(request_id, 30)
+  assert queue.claim_requests(10) == []
+  now = time.time()
+  monkeypatch.setattr(message_queue.time, 'time', lambda: now + 31)
+  assert [request.attempts for request in queue.claim_requests(10)] == [3]
+
+
+def test_discard_request(queue):
+  request_id = queue.enqueue_request(SENDER, 'POST', _message(0))
+
+  queue.discard_request(request_id)
+
+  assert queue.count_requests() == 0
+  assert queue.claim_requests(10) == []
+
+
+def test_complete_request_stores_response_for_pickup(queue):
+  request_id = queue.enqueue_request(SENDER, 'POST', _message(0))
+  queue.claim_requests(10)
+
+  assert queue.complete_request(request_id, SENDER, 'packed-response') == 0
+
+  assert queue.count_requests() == 0
+  responses = queue.fetch_responses(SENDER, 10)
+  assert [packed_msg for _, packed_msg in responses] == ['packed-response']
+  queue.delete_responses(SENDER, [response_id for response_id, _ in responses])
+  assert queue.count_responses(SENDER) == 0
+
+
+def test_complete_request_keeps_newest_responses_per_recipient(tmp_path):
+  queue = MessageQueue(str(tmp_path / 'message_queue.db'), max_responses_per_recipient=2)
+  dropped = []
+  for step in range(3):
+    request_id = queue.enqueue_request(SENDER, 'POST', _message(step))
+    dropped.append(queue.complete_request(request_id, SENDER, 'response {}'.format(step)))
+
+  assert dropped == [0, 0, 1]
+  assert [packed_msg for _, packed_msg in queue.fetch_responses(SENDER, 10)] == ['response 1', 'response 2']
+
+
+def test_prune_responses_older_than_ttl(tmp_path, monkeypatch):
+  queue = MessageQueue(str(tmp_path / 'message_queue.db'), response_ttl=60)
+  queue.complete_request(queue.enqueue_request(SENDER, 'POST', _message(0)), SENDER, 'old response')
+  now = time.time()
+  monkeypatch.setattr(message_queue.time, 'time', lambda: now + 50)
+  queue.complete_request(queue.enqueue_request(SENDER, 'POST', _message(1)), SENDER, 'new response')
+
+  monkeypatch.setattr(message_queue.time, 'time', lambda: now + 61)
+
+  assert queue.prune_responses() == 1
+  assert [packed_msg for _, packed_msg in queue.fetch_responses(SENDER, 10)] == ['new response']
@@ -0,0 +1,155 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from did_communication_api import replay_cache
+from did_communication_api.replay_cache import MemoryReplayStore, ReplayCache, SQLiteReplayStore
+
+KEY = ('did:peer:2.sender', 'm1')
+RESPONSE = {'didcomm_msg': 'packed-response'}
+
+
+def _is_cacheable(response):
+  return 'error' not in response
+
+
+class _Compute:
+  """ Handles a request slowly, counting its calls """
+
+  def __init__(self, response=RESPONSE, duration=0.0):
+    self.response = response
+    self.duration = duration
+    self.calls = 0
+
+  def __call__(self):
+    self.calls += 1
+    time.sleep(self.duration)
+    return self.response
+
+
+@pytest.fixture
+def sqlite_path(tmp_path):
+  return str(tmp_path / 'replay.db')
+
+
+def test_stored_response_is_replayed():
+  cache = ReplayCache(MemoryReplayStore(100), ttl_seconds=60)
+  compute = _Compute()
+
+  assert cache.get_or_compute(KEY, compute, _is_cacheable) == (RESPONSE, False)
+  assert cache.get_or_compute(KEY, compute, _is_cacheable) == (RESPONSE, True)
+  assert compute.calls == 1
+
+
+def test_response_which_is_not_cacheable_is_not_replayed():
+  cache = ReplayCache(MemoryReplayStore(100), ttl_seconds=60)
+  compute = _Compute(response={'error': 'Webhook unreachable'})
+
+  cache.get_or_compute(KEY, compute, _is_cacheable)
+  cache.get_or_compute(KEY, compute, _is_cacheable)
+
+  assert compute.calls == 2
+
+
+def test_concurrent_duplicates_are_coalesced():
+  cache = ReplayCache(MemoryReplayStore(100), ttl_seconds=60)
+  compute = _Compute(duration=0.2)
+  results = []
+  threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute(KEY, compute, _is_cacheable)))
+             for _ in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  assert compute.calls == 1
+  assert sorted(replayed for _, replayed in results) == [False, True, True, True]
+
+
+def test_concurrent_async_duplicates_are_coalesced():
+  cache = ReplayCache(MemoryReplayStore(100), ttl_seconds=60)
+  calls = []
+
+  async def compute():
+    calls.append(1)
+    await asyncio.sleep(0.1)
+    return RESPONSE
+
+  async def handle_duplicates():
+    return await asyncio.gather(*[cache.get_or_compute_async(KEY, compute, _is_cacheable) for _ in range(4)])
+
+  results = asyncio.run(handle_duplicates())
+
+  assert len(calls) == 1
+  assert sorted(replayed for _, replayed in results) == [False, True, True, True]
+
+
+def test_claim_is_exclusive_across_processes(sqlite_path):
+  # Two stores on the same file, as used by two worker processes
+  store, other_store = SQLiteReplayStore(sqlite_path, 100), SQLiteReplayStore(sqlite_path, 100)
+
+  assert store.try_claim(KEY, 30) is True
+  assert other_store.try_claim(KEY, 30) is False
+  assert other_store.get(KEY) is None
+
+  store.release(KEY)
+  assert other_store.try_claim(KEY, 30) is True
+
+
+def test_claim_of_stored_response_fails(sqlite_path):
+  store, other_store = SQLiteReplayStore(sqlite_path, 100), SQLiteReplayStore(sqlite_path, 100)
+  store.try_claim(KEY, 30)
+  store.put(KEY, RESPONSE, 60)
+
+  assert other_store.try_claim(KEY, 30) is False
+  assert other_store.get(KEY) == RESPONSE
+
+
+def test_claim_after_expired_lease(sqlite_path, monkeypatch):
+  store, other_store = SQLiteReplayStore(sqlite_path, 100), SQLiteReplayStore(sqlite_path, 100)
+  store.try_claim(KEY, 30)
+
+  # The process holding the claim crashed
+  now = time.time()
+  monkeypatch.setattr(replay_cache.time, 'time', lambda: now + 31)
+
+  assert other_store.try_claim(KEY, 30) is True
+
+
+def test_failed_request_releases_claim(sqlite_path):
+  store = SQLiteReplayStore(sqlite_path, 100)
+  cache = ReplayCache(store, ttl_seconds=60)
+
+  def fail():
+    raise RuntimeError('Webhook call failed')
+
+  with pytest.raises(RuntimeError):
+    cache.get_or_compute(KEY, fail, _is_cacheable)
+
+  assert SQLiteReplayStore(sqlite_path, 100).try_claim(KEY, 30) is True
+
+
+def test_duplicate_waits_for_response_of_other_process(sqlite_path):
+  other_store = SQLiteReplayStore(sqlite_path, 100)
+  other_store.try_claim(KEY, 30)
+  cache = ReplayCache(SQLiteReplayStore(sqlite_path, 100), ttl_seconds=60, wait_timeout=5, poll_interval=0.01)
+  compute = _Compute()
+  timer = threading.Timer(0.2, other_store.put, (KEY, RESPONSE, 60))
+  timer.start()
+
+  try:
+    assert cache.get_or_compute(KEY, compute, _is_cacheable) == (RESPONSE, True)
+  finally:
+    timer.join()
+  assert compute.calls == 0
+
+
+def test_duplicate_handles_request_if_other_process_does_not_respond_in_time(sqlite_path):
+  SQLiteReplayStore(sqlite_path, 100).try_claim(KEY, 30)
+  cache = ReplayCache(SQLiteReplayStore(sqlite_path, 100), ttl_seconds=60, wait_timeout=0.2, poll_interval=0.01)
+  compute = _Compute()
+
+  assert cache.get_or_compute(KEY, compute, _is_cacheable) == (RESPONSE, False)
+  assert compute.calls == 1